@@ -0,0 +1,157 @@
+'''
+Per-file pipeline checkpoints for the cleo2 project, so a retried file resumes after its last completed stage.
+2024 Christopher Orr
+'''
+
+import os
+import json
+import numpy as np
+from dbconnection import DBConnection
+from logger_config import get_logger
+
+# In pipeline order.  For movies, 'tensor' is the tbl_movie_hashes row and 'converted'/'faces' are not used.
+STAGES = ['converted', 'hashed', 'deduped', 'inserted', 'metadata', 'moved', 'faces', 'tensor']
+TENSOR_SHAPE = (50, 50, 3)
+
+
+class PipelineCheckpoints:
+    '''
+    Records in tbl_ingest_checkpoints the last stage each file completed, with what later stages need (the
+    converted path, hashes and tensors, media_object_id, new name and final path).  A file is identified by
+    its inbox path without the extension, because conversion renames it in place.  The row is deleted when
+    the file completes, so only interrupted files have one.  Checkpoint errors are logged but never stop
+    processing; without a checkpoint a file is simply processed from the start.
+    '''
+    def __init__(self):
+        self.logger = get_logger(self.__class__.__name__)
+        self.db_conn_instance = DBConnection.get_instance()
+
+    def create_table(self):
+        function_name = 'create_table'
+        query = """
+        CREATE TABLE IF NOT EXISTS tbl_ingest_checkpoints (
+            file_key TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            data JSONB NOT NULL DEFAULT '{}',
+            tensor_pil BYTEA,
+            tensor_cv2 BYTEA,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (file_key, file_type)
+        )
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error creating tbl_ingest_checkpoints: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            raise
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def file_key(self, file_path):
+        return os.path.splitext(file_path)[0]
+
+    def load(self, file_path, file_type):
+        '''Return {'stage', 'data', 'tensor_pil', 'tensor_cv2'} for the file, or None if it has no checkpoint.'''
+        function_name = 'load'
+        query = """
+        SELECT stage, data, tensor_pil, tensor_cv2 FROM tbl_ingest_checkpoints
+        WHERE file_key = %s AND file_type = %s
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (self.file_key(file_path), file_type))
+                row = cursor.fetchone()
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error loading checkpoint for {file_path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return None
+        finally:
+            self.db_conn_instance.return_connection(conn)
+        if row is None:
+            return None
+        stage, data, tensor_pil, tensor_cv2 = row
+        return {
+            'stage': stage,
+            'data': data,
+            'tensor_pil': np.frombuffer(tensor_pil, dtype=np.uint8).reshape(TENSOR_SHAPE) if tensor_pil is not None else None,
+            'tensor_cv2': np.frombuffer(tensor_cv2, dtype=np.uint8).reshape(TENSOR_SHAPE) if tensor_cv2 is not None else None
+        }
+
+    def save(self, file_path, file_type, stage, data=None, tensor_pil=None, tensor_cv2=None):
+        '''Record that the file completed stage, merging data into what earlier stages saved.'''
+        function_name = 'save'
+        query = """
+        INSERT INTO tbl_ingest_checkpoints (file_key, file_type, stage, data, tensor_pil, tensor_cv2)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (file_key, file_type) DO UPDATE
+        SET stage = EXCLUDED.stage,
+            data = tbl_ingest_checkpoints.data || EXCLUDED.data,
+            tensor_pil = COALESCE(EXCLUDED.tensor_pil, tbl_ingest_checkpoints.tensor_pil),
+            tensor_cv2 = COALESCE(EXCLUDED.tensor_cv2, tbl_ingest_checkpoints.tensor_cv2),
+            updated_at = now()
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (
+                    self.file_key(file_path),
+                    file_type,
+                    stage,
+                    json.dumps(data or {}, default=str),
+                    tensor_pil.tobytes() if tensor_pil is not None else None,
+                    tensor_cv2.tobytes() if tensor_cv2 is not None else None
+                ))
+            conn.commit()
+            self.logger.debug(f"Checkpoint {stage} for {file_path}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        except Exception as e:
+            self.logger.error(f"Error saving checkpoint {stage} for {file_path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def clear(self, file_path, file_type):
+        function_name = 'clear'
+        query = "DELETE FROM tbl_ingest_checkpoints WHERE file_key = %s AND file_type = %s"
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (self.file_key(file_path), file_type))
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error clearing checkpoint for {file_path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def stale(self, older_than_seconds):
+        '''
+        (source file_path, file_type) of files that were moved out of the inbox but not finished and have not
+        been touched for older_than_seconds.  Nothing in the inbox will trigger their retry, so they are
+        resumed with process_file.py --resume.
+        '''
+        function_name = 'stale'
+        query = """
+        SELECT data->>'source', file_type FROM tbl_ingest_checkpoints
+        WHERE stage = ANY(%s) AND updated_at < now() - %s * interval '1 second'
+        ORDER BY updated_at
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (STAGES[STAGES.index('moved'):], older_than_seconds))
+                rows = cursor.fetchall()
+            conn.commit()
+            return rows
+        except Exception as e:
+            self.logger.error(f"Error listing stale checkpoints: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return []
+        finally:
+            self.db_conn_instance.return_connection(conn)
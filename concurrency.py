@@ -0,0 +1,146 @@
+'''
+An adaptive (AIMD) concurrency controller for the cleo2 controller.
+2024 Christopher Orr
+'''
+
+import os
+import json
+import time
+from collections import deque
+from dbconnection import DBConnection
+from logger_config import get_logger
+
+
+class AdaptiveConcurrency:
+    '''
+    Chooses how many files to process in parallel.  Every `interval` seconds it samples the host load
+    average, available memory, database round-trip latency and the completion times of recent files,
+    then raises the target by one while there is headroom and throughput keeps up (additive increase)
+    or cuts it by `decrease_factor` when the host or database is overloaded (multiplicative decrease).
+    Every decision is kept with its reason in `decisions` and written to `status_file` if one is given.
+    '''
+    def __init__(self, min_workers=1, max_workers=13, initial=None, interval=30, cpu_high=0.9,
+                 mem_low=0.1, db_latency_high=0.5, decrease_factor=0.75, status_file=None):
+        self.logger = get_logger(self.__class__.__name__)
+        self.db_conn_instance = DBConnection.get_instance()
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target = initial if initial is not None else min(max_workers, max(min_workers, os.cpu_count() or 1))
+        self.interval = interval
+        self.cpu_high = cpu_high
+        self.mem_low = mem_low
+        self.db_latency_high = db_latency_high
+        self.decrease_factor = decrease_factor
+        self.status_file = status_file
+        self.completions = deque()  # (finished_at, duration) of files finished in the current window
+        self.window_start = time.time()
+        self.last_throughput = None
+        self.last_action = None
+        self.decisions = deque(maxlen=100)
+
+    def record_completion(self, duration):
+        self.completions.append((time.time(), duration))
+
+    def get_cpu_load(self):
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def get_available_memory_fraction(self):
+        meminfo = {}
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    key, value = line.split(':', 1)
+                    meminfo[key] = int(value.split()[0])
+            return meminfo['MemAvailable'] / meminfo['MemTotal']
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def get_db_latency(self):
+        function_name = 'get_db_latency'
+        start_time = time.time()
+        conn = self.db_conn_instance.get_connection()
+        if conn is None:
+            return None
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return time.time() - start_time
+        except Exception as e:
+            self.logger.error(f"Error measuring database latency: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return None
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def measure(self):
+        elapsed = max(time.time() - self.window_start, 1e-6)
+        durations = [duration for _, duration in self.completions]
+        return {
+            'cpu_load': self.get_cpu_load(),
+            'mem_available': self.get_available_memory_fraction(),
+            'db_latency': self.get_db_latency(),
+            'files_per_second': len(durations) / elapsed,
+            'mean_file_seconds': sum(durations) / len(durations) if durations else None,
+            'completed': len(durations)
+        }
+
+    def adjust(self, running, pending):
+        '''Re-evaluate the target if the interval has passed. running/pending are the current busy slots and queue depth.'''
+        function_name = 'adjust'
+        if time.time() - self.window_start < self.interval:
+            return self.target
+
+        metrics = self.measure()
+        metrics.update({'running': running, 'pending': pending})
+        previous = self.target
+
+        if metrics['cpu_load'] > self.cpu_high:
+            action, reason = 'decrease', f"CPU load {metrics['cpu_load']:.2f} per core is above {self.cpu_high}"
+        elif metrics['mem_available'] is not None and metrics['mem_available'] < self.mem_low:
+            action, reason = 'decrease', f"Available memory {metrics['mem_available']:.0%} is below {self.mem_low:.0%}"
+        elif metrics['db_latency'] is not None and metrics['db_latency'] > self.db_latency_high:
+            action, reason = 'decrease', f"Database latency {metrics['db_latency']:.3f}s is above {self.db_latency_high}s"
+        elif self.last_action == 'increase' and self.last_throughput and metrics['files_per_second'] < self.last_throughput * 0.9:
+            action, reason = 'backoff', f"Throughput fell from {self.last_throughput:.2f} to {metrics['files_per_second']:.2f} files/second after the last increase"
+        elif pending == 0 or running < self.target:
+            action, reason = 'hold', f"Not saturated ({running} running, {pending} pending)"
+        else:
+            action, reason = 'increase', f"Headroom available at {metrics['files_per_second']:.2f} files/second"
+
+        if action == 'decrease':
+            self.target = max(self.min_workers, int(self.target * self.decrease_factor))
+        elif action == 'backoff':
+            self.target = max(self.min_workers, self.target - 1)
+        elif action == 'increase':
+            self.target = min(self.max_workers, self.target + 1)
+
+        decision = {'time': time.time(), 'action': action, 'reason': reason, 'previous': previous, 'target': self.target, 'metrics': metrics}
+        self.decisions.append(decision)
+        self.logger.info(f"Concurrency {previous} -> {self.target} ({action}): {reason}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        self.write_status()
+
+        if action != 'hold':
+            self.last_action = action
+        self.last_throughput = metrics['files_per_second']
+        self.completions.clear()
+        self.window_start = time.time()
+        return self.target
+
+    def status(self):
+        return {
+            'target': self.target,
+            'min_workers': self.min_workers,
+            'max_workers': self.max_workers,
+            'last_decision': self.decisions[-1] if self.decisions else None,
+            'recent_decisions': list(self.decisions)[-10:]
+        }
+
+    def write_status(self):
+        function_name = 'write_status'
+        if not self.status_file:
+            return
+        try:
+            with open(self.status_file, 'w') as f:
+                json.dump(self.status(), f, indent=4)
+        except OSError as e:
+            self.logger.error(f"Error writing concurrency status to {self.status_file}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
@@ -0,0 +1,77 @@
+'''
+Whole-file content hashes of the images in the cleo2 library, to reject byte-identical copies before any decoding.
+2024 Christopher Orr
+'''
+
+from dbconnection import DBConnection
+from logger_config import get_logger
+
+
+class ContentHashIndex:
+    '''
+    Maps the BLAKE2b hash of each stored image's original bytes (before any conversion) to its media object in
+    tbl_content_hashes.  A re-exported or re-downloaded copy of an image already held has the same hash, so it
+    is recognised with one indexed lookup before it is converted, decoded or fingerprinted.
+    '''
+    def __init__(self):
+        self.logger = get_logger(self.__class__.__name__)
+        self.db_conn_instance = DBConnection.get_instance()
+
+    def create_table(self):
+        function_name = 'create_table'
+        query = """
+        CREATE TABLE IF NOT EXISTS tbl_content_hashes (
+            content_hash TEXT NOT NULL,
+            media_object_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (content_hash, media_object_id)
+        )
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error creating tbl_content_hashes: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            raise
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def lookup(self, content_hash):
+        '''(media_object_id, filename) of a stored image with this content hash, or None.'''
+        function_name = 'lookup'
+        query = "SELECT media_object_id, filename FROM tbl_content_hashes WHERE content_hash = %s ORDER BY created_at LIMIT 1"
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (content_hash,))
+                row = cursor.fetchone()
+            conn.commit()
+            return row
+        except Exception as e:
+            self.logger.error(f"Error looking up content hash {content_hash}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return None
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def record(self, content_hash, media_object_id, filename):
+        function_name = 'record'
+        query = """
+        INSERT INTO tbl_content_hashes (content_hash, media_object_id, filename)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (content_hash, media_object_id) DO UPDATE SET filename = EXCLUDED.filename
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (content_hash, media_object_id, filename))
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error recording content hash for media object {media_object_id}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
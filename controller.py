@@ -1,5 +1,7 @@
 import os
 import time
+import socket
+import queue
 import docker
 import signal
 import requests
@@ -7,21 +9,102 @@ from utilities import Utilities
 from settings import *
 from dotenv import load_dotenv
 from dbconnection import DBConnection
+from job_queue import JobQueueServer, IngestJobQueue
+from file_watcher import FileWatcher
+from concurrency import AdaptiveConcurrency
+from lanes import LaneScheduler, classify
+from checkpoints import PipelineCheckpoints
+from perceptual_hash import PerceptualHashIndex
+from content_hash import ContentHashIndex
+from known_hashes import KnownHashes
+from executors import DockerExecutor, LocalProcessExecutor, ZygoteExecutor
 
-MAX_CONTAINERS = 13  # Maximum number of containers to run in parallel
+EXECUTOR = os.getenv('EXECUTOR', 'docker')  # 'docker' (a container per batch), 'process' (local process pool) or 'zygote' (local fork server)
+MAX_CONTAINERS = int(os.getenv('MAX_CONTAINERS', 13))  # Maximum number of containers (or local processes) to run in parallel
+MIN_CONTAINERS = int(os.getenv('MIN_CONTAINERS', 1))  # The adaptive controller never drops below this
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'  # Otherwise always run MAX_CONTAINERS
+CONCURRENCY_INTERVAL = int(os.getenv('CONCURRENCY_INTERVAL', 30))  # Seconds between concurrency adjustments
+CONCURRENCY_STATUS_FILE = os.getenv('CONCURRENCY_STATUS_FILE')  # Optional JSON file with the current target and decisions
+CONTAINER_NANO_CPUS = int(os.getenv('CONTAINER_NANO_CPUS', 500000000))  # CPU quota per container (1e9 = one CPU)
+CONTAINER_MEM_LIMIT = os.getenv('CONTAINER_MEM_LIMIT', '1g')  # Memory limit per container
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 1))  # Files handed to each processing container
+MANIFEST_DIRECTORY = os.getenv('MANIFEST_DIRECTORY', '/mnt/MOM/Manifests')  # Batch manifests, visible inside the containers
 PROCESSING_IMAGE = 'cleo-backend:latest'  # Docker image name
 DOCKER_TIMEOUT = 120  # Increase the timeout duration
+WORKER_MODE = os.getenv('WORKER_MODE', 'container')  # 'container' (one container per file) or 'persistent'
+WORKER_QUEUE_PORT = int(os.getenv('WORKER_QUEUE_PORT', 50000))  # Port the persistent workers connect to
+WORKER_QUEUE_AUTHKEY = os.getenv('WORKER_QUEUE_AUTHKEY', 'cleo')
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'memory')  # 'memory' (in-process list) or 'db' (tbl_ingest_jobs)
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 1800))  # How long a claimed job stays leased
+FULL_RESCAN_SECONDS = int(os.getenv('FULL_RESCAN_SECONDS', 300))  # Full inbox rescan interval while inotify works
 
 class Controller:
-    def __init__(self):
+    def __init__(self, client=None, new_folder=None, executor=None):
         load_dotenv()  # Load environment variables from .env file
-        self.client = docker.from_env(timeout=DOCKER_TIMEOUT)
-        self.new_folder = FILES_TO_PROCESS_DIRECTORY
-        self.queue = []
-        self.active_containers = []
+        self.controller_id = socket.gethostname()
+        if WORKER_MODE == 'persistent' and (EXECUTOR != 'docker' if executor is None else not isinstance(executor, DockerExecutor)):
+            # Persistent workers are long-lived containers started and supervised through the Docker executor;
+            # checked before a local executor starts its processes
+            raise ValueError(f"WORKER_MODE=persistent needs EXECUTOR=docker, not {EXECUTOR if executor is None else type(executor).__name__}")
+        if executor is None:
+            if EXECUTOR == 'process':
+                executor = LocalProcessExecutor(max_workers=MAX_CONTAINERS)
+            elif EXECUTOR == 'zygote':
+                executor = ZygoteExecutor()
+            else:
+                # Any object with the docker SDK's containers.run() and events() API will do, e.g. fake_docker.FakeDockerClient
+                executor = DockerExecutor(
+                    client if client is not None else docker.from_env(timeout=DOCKER_TIMEOUT),
+                    self.controller_id,
+                    PROCESSING_IMAGE,
+                    MANIFEST_DIRECTORY,
+                    nano_cpus=CONTAINER_NANO_CPUS,
+                    mem_limit=CONTAINER_MEM_LIMIT
+                )
+        self.executor = executor
+        self.client = getattr(executor, 'client', None)
+        self.new_folder = new_folder if new_folder is not None else FILES_TO_PROCESS_DIRECTORY
+        self.queue = LaneScheduler()  # Queued files by lane, smallest first
         self.utils = Utilities()
         self.db_conn_instance = DBConnection.get_instance()
         self.running = True
+        self.queue_server = None
+        self.workers = {}  # worker_id -> container
+        self.worker_files = {}  # worker_id -> file currently being processed
+        self.job_queue = None
+        self.job_ids = {}  # file_path -> tbl_ingest_jobs.job_id for files claimed by this controller
+        self.queued_keys = set()  # Files discovered and queued but not yet dispatched
+        self.in_flight = {}  # file_path -> key for files currently being processed
+        self.start_times = {}  # file_path -> time the file was dispatched
+        self.queue_drained = False  # The last attempt to take a file found nothing to do
+        self.retiring_workers = set()  # Persistent workers asked to stop by the concurrency controller
+        self.worker_lanes = {}  # worker_id -> lane the worker serves first
+        self.concurrency = None
+        if ADAPTIVE_CONCURRENCY:
+            self.concurrency = AdaptiveConcurrency(
+                min_workers=MIN_CONTAINERS,
+                max_workers=MAX_CONTAINERS,
+                interval=CONCURRENCY_INTERVAL,
+                status_file=CONCURRENCY_STATUS_FILE
+            )
+        self.watcher = FileWatcher(self.new_folder, rescan_interval=FULL_RESCAN_SECONDS)
+        if QUEUE_BACKEND == 'db':
+            self.job_queue = IngestJobQueue(lease_seconds=JOB_LEASE_SECONDS)
+            self.job_queue.create_table()
+        try:
+            PipelineCheckpoints().create_table()
+        except Exception as e:
+            print(f"Pipeline checkpoints unavailable, interrupted files will restart from the beginning: {e}")
+        try:
+            PerceptualHashIndex().create_table()
+        except Exception as e:
+            print(f"Perceptual hash index unavailable, only exact duplicates will be found: {e}")
+        try:
+            ContentHashIndex().create_table()
+        except Exception as e:
+            print(f"Content hash index unavailable, every file will be decoded: {e}")
+        # A fresh snapshot, so each worker loads the known-hash filter from a file instead of scanning tbl_image_tensors
+        KnownHashes().build()
         signal.signal(signal.SIGINT, self.handle_exit)
         signal.signal(signal.SIGTERM, self.handle_exit)
 
@@ -30,72 +113,267 @@ class Controller:
         self.running = False
 
     def update_queue(self):
-        new_files, skipped_files = self.utils.get_new_files(self.new_folder)
-        print(f"New files found: {len(new_files)} and Skipped files found: {len(skipped_files)}")
-        self.queue.extend([(str(file), file_type) for file, file_type in new_files])
+        if self.watcher.rescan_due():
+            new_files, skipped_files = self.utils.get_new_files(self.new_folder)
+            self.watcher.mark_rescanned()
+            # Forget queued files that are gone from the inbox (e.g. processed by another host)
+            self.queued_keys &= {self.file_key(str(file), file_type) for file, file_type, _ in new_files}
+            if self.job_queue is not None:
+                for file_path in self.job_queue.fail_exhausted():
+                    print(f"Job for {file_path} used all its attempts")
+                    self.utils.move_to_error_directory(file_path)
+        else:
+            event_files, skipped_files = self.utils.validate_files(self.watcher.read_events())
+            new_files = [(file, file_type, self.get_file_size(file)) for file, file_type in event_files]
+
+        fresh_files = []
+        for file, file_type, size in new_files:
+            key = self.file_key(str(file), file_type)
+            if key in self.queued_keys or key in self.in_flight.values():
+                continue
+            self.queued_keys.add(key)
+            fresh_files.append((str(file), file_type, size))
+        if not fresh_files:
+            return
+        print(f"New files found: {len(fresh_files)} and Skipped files found: {len(skipped_files)}")
+
+        if self.job_queue is not None:
+            jobs = [(file, file_type, size, classify(file, file_type)) for file, file_type, size in fresh_files]
+            print(f"Enqueued {self.job_queue.enqueue(jobs)} new jobs")
+        else:
+            for file, file_type, size in fresh_files:
+                self.queue.push(file, file_type, size)
+
+    def file_key(self, file_path, file_type):
+        # Workers rename files to their real extension and convert them in place, so a file is
+        # identified by its stem; the type keeps a live photo's image and movie apart.
+        return os.path.splitext(file_path)[0], file_type
+
+    def mark_in_flight(self, file_info):
+        file_path, file_type = file_info
+        key = self.file_key(file_path, file_type)
+        self.queued_keys.discard(key)
+        self.in_flight[file_path] = key
+        self.start_times[file_path] = time.time()
+
+    def get_file_size(self, file):
+        try:
+            return os.path.getsize(file)
+        except OSError:
+            return None
+
+    def next_batch(self, slots, count):
+        # A batch always comes from a single lane and occupies one of that lane's slots
+        lane, batch = None, []
+        if self.job_queue is not None:
+            for lane in self.queue.preferred_lanes(slots):
+                jobs = self.job_queue.claim_batch(self.controller_id, lane, count)
+                if jobs:
+                    for job_id, file_path, file_type in jobs:
+                        self.job_ids[file_path] = job_id
+                        batch.append((file_path, file_type))
+                    break
+        else:
+            lane, batch = self.queue.pop_batch(slots, count)
+        self.queue_drained = not batch
+        if batch:
+            self.queue.start(batch[0][0], lane)
+            for file_info in batch:
+                self.mark_in_flight(file_info)
+        return batch
+
+    def next_file(self, slots):
+        batch = self.next_batch(slots, 1)
+        return batch[0] if batch else None
+
+    def finish_file(self, file_path, success):
+        # success is None when the file was never reached (its batch died first): it is queued again
+        self.in_flight.pop(file_path, None)
+        self.queue.finish(file_path)
+        start_time = self.start_times.pop(file_path, None)
+        if start_time is not None and self.concurrency is not None and success is not None:
+            self.concurrency.record_completion(time.time() - start_time)
+        job_id = self.job_ids.pop(file_path, None)
+        if job_id is not None:
+            if success is None:
+                self.job_queue.release(job_id)
+            else:
+                self.job_queue.complete(job_id, success)
+
+    def finish_files(self, results):
+        for file_path, success in results:
+            self.finish_file(file_path, success)
+
+    def pending_count(self):
+        if self.job_queue is not None:
+            return 0 if self.queue_drained else 1  # Only whether tbl_ingest_jobs had work last time is known cheaply
+        if self.queue_server is not None:
+            return len(self.queue) + self.queue_server.job_queue.qsize()
+        return len(self.queue)
+
+    def slot_limit(self, running):
+        if self.concurrency is None:
+            return MAX_CONTAINERS
+        return self.concurrency.adjust(running, self.pending_count())
 
     def manage_queue(self):
         while self.running:  # Keep the controller running indefinitely
             self.update_queue()
-            while (self.queue or self.active_containers) and self.running:
-                self.cleanup_containers()
-                if len(self.active_containers) < MAX_CONTAINERS and self.queue:
-                    new_file = self.queue.pop(0)
-                    self.start_container(new_file)
-                time.sleep(1)  # Adjust sleep time as necessary
-            time.sleep(5)  # Wait before checking for new files again
-
-    def start_container(self, file_info):
-        file_path, file_type = file_info
+            slots = self.slot_limit(self.executor.active())
+            while self.executor.active() < slots:
+                batch = self.next_batch(slots, BATCH_SIZE)
+                if not batch:
+                    break
+                self.executor.submit(batch)
+            self.finish_files(self.executor.results(timeout=1))
+
+    def manage_workers(self):
+        if self.job_queue is None:
+            # With the db backend workers lease from tbl_ingest_jobs, so only the memory backend needs the queue server
+            self.queue_server = JobQueueServer(('', WORKER_QUEUE_PORT), WORKER_QUEUE_AUTHKEY.encode())
+            self.queue_server.start()
+        while self.running:  # Keep the controller running indefinitely
+            self.scale_workers()
+            self.update_queue()
+            if self.job_queue is None:
+                # Hand out only as many files as there are idle workers so lane and size ordering decide what runs next
+                while self.queue_server.job_queue.qsize() < len(self.workers) - len(self.worker_files):
+                    file_info = self.next_file(len(self.workers))
+                    if file_info is None:
+                        break
+                    self.queue_server.job_queue.put(file_info)
+                self.collect_results()  # Waits up to a second for results
+            else:
+                # Workers lease jobs from tbl_ingest_jobs themselves; only supervise them here
+                time.sleep(1)
+            self.check_workers(self.executor.wait_for_exits(timeout=0))
+
+    def scale_workers(self):
+        busy = len(self.worker_files) if self.job_queue is None else len(self.workers)
+        target = self.slot_limit(busy)
+        active = [worker_id for worker_id in self.workers if worker_id not in self.retiring_workers]
+        index = 0
+        while len(active) < target:
+            worker_id = f"{self.controller_id}-worker-{index}"
+            if worker_id not in self.workers:
+                self.start_worker(worker_id, self.queue.worker_lane(index, target))
+                active.append(worker_id)
+            index += 1
+        # Retire the highest-numbered workers first, so the lanes of the lowest indexes stay filled
+        for worker_id in sorted(active, key=lambda worker_id: int(worker_id.rsplit('-', 1)[1]), reverse=True)[:max(0, len(active) - target)]:
+            # SIGTERM lets the worker finish its current file before exiting
+            print(f"Retiring worker {worker_id}")
+            self.retiring_workers.add(worker_id)
+            try:
+                self.workers[worker_id].kill(signal='SIGTERM')
+            except Exception as e:
+                print(f"Error stopping worker {worker_id}: {e}")
+
+    def start_worker(self, worker_id, lane=None):
         try:
             container = self.client.containers.run(
                 PROCESSING_IMAGE,
+                entrypoint=['python', 'worker.py'],
                 environment={
-                    'NEW_FILE': f"{file_path},{file_type}"
+                    'CONTROLLER_ADDRESS': f"127.0.0.1:{WORKER_QUEUE_PORT}",
+                    'CONTROLLER_AUTHKEY': WORKER_QUEUE_AUTHKEY,
+                    'QUEUE_BACKEND': QUEUE_BACKEND,
+                    'JOB_LEASE_SECONDS': str(JOB_LEASE_SECONDS),
+                    'WORKER_ID': worker_id,
+                    'WORKER_LANE': lane or ''
                 },
                 volumes={
                     '/mnt/MOM': {'bind': '/mnt/MOM', 'mode': 'rw'}
                 },
+                network_mode='host',
                 detach=True,
-                nano_cpus=500000000,
-                mem_limit="1g"
-
+                nano_cpus=CONTAINER_NANO_CPUS,
+                mem_limit=CONTAINER_MEM_LIMIT
             )
-            self.active_containers.append(container)
-            print(f"Started container {container.id} for file {file_path}")
+            self.workers[worker_id] = container
+            self.worker_lanes[worker_id] = lane
+            print(f"Started worker {worker_id} in container {container.id}")
         except Exception as e:
-            print(f"Error starting container for file {file_path}: {e}")
-            self.utils.move_to_error_directory(file_path)
-
-    def cleanup_containers(self):
-        for container in self.active_containers:
-            retries = 3
-            while retries > 0:
-                try:
+            print(f"Error starting worker {worker_id}: {e}")
+
+    def collect_results(self):
+        timeout = 1
+        while True:
+            try:
+                event, worker_id, file_path, success = self.queue_server.result_queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+            timeout = 0  # Drain whatever else is already waiting without blocking
+            if event == 'started':
+                self.worker_files[worker_id] = file_path
+            elif event == 'finished':
+                self.worker_files.pop(worker_id, None)
+                self.finish_file(file_path, success)
+                print(f"Worker {worker_id} finished {file_path} ({'ok' if success else 'failed'})")
+
+    def check_workers(self, exited_ids):
+        resync = self.executor.events_resynced.is_set()
+        self.executor.events_resynced.clear()
+        for worker_id, container in list(self.workers.items()):
+            if container.id not in exited_ids and not resync:
+                continue
+            try:
+                if resync:
                     container.reload()
-                    if container.status == 'exited':
-                        print(f"Container {container.id} finished")
-                        self.active_containers.remove(container)
-                        container.remove()
-                    break  # Break the retry loop if successful
-                except requests.exceptions.ReadTimeout:
-                    retries -= 1
-                    print(f"Timeout error while reloading container {container.id}. Retrying... ({3-retries}/3)")
-                except Exception as e:
-                    print(f"Error reloading container {container.id}: {e}")
-                    self.utils.move_to_error_directory(container.attrs['Config']['Env'][0].split('=')[1].split(',')[0])
-                    self.active_containers.remove(container)
-                    container.remove()
-                    break  # Break the loop on non-timeout errors
+                    if container.status != 'exited':
+                        continue
+                if worker_id not in self.retiring_workers:
+                    print(f"Worker {worker_id} exited unexpectedly, restarting")
+                container.remove()
+            except requests.exceptions.ReadTimeout:
+                continue
+            except Exception as e:
+                print(f"Error removing worker {worker_id}: {e}")
+            del self.workers[worker_id]
+            # The file the worker held never reported back, so count it as failed
+            file_path = self.worker_files.pop(worker_id, None)
+            if file_path is not None:
+                self.utils.move_to_error_directory(file_path)
+                self.finish_file(file_path, False)
+            if worker_id in self.retiring_workers:
+                self.retiring_workers.discard(worker_id)
+            elif self.running:
+                self.start_worker(worker_id, self.worker_lanes.get(worker_id))
+
+    def stop_workers(self):
+        if self.queue_server is not None:
+            for _ in self.workers:
+                self.queue_server.job_queue.put(None)  # One shutdown sentinel per worker
+        for worker_id, container in self.workers.items():
+            try:
+                if self.queue_server is not None:
+                    container.wait(timeout=DOCKER_TIMEOUT)
+                else:
+                    # Workers polling tbl_ingest_jobs never see a sentinel; SIGTERM lets them finish the file in hand
+                    container.stop(timeout=DOCKER_TIMEOUT)
+                container.remove()
+                print(f"Worker {worker_id} stopped")
+            except Exception as e:
+                print(f"Error stopping worker {worker_id}: {e}")
+        self.workers = {}
+        if self.queue_server is not None:
+            self.queue_server.stop()
 
 if __name__ == "__main__":
     controller = Controller()
     try:
-        controller.manage_queue()
+        if WORKER_MODE == 'persistent':
+            controller.manage_workers()
+        else:
+            controller.manage_queue()
     except KeyboardInterrupt:
         print("Controller interrupted and stopped.")
     finally:
         print("Cleaning up...")
-        controller.cleanup_containers()
+        if WORKER_MODE == 'persistent':
+            controller.stop_workers()
+        else:
+            controller.finish_files(controller.executor.shutdown())
+            print(controller.executor.startup_summary())
         print("Controller shut down.")
 
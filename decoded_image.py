@@ -0,0 +1,115 @@
+'''
+An image decoded once and shared by the tensor, face recognition and dimension steps of the cleo2 pipeline.
+2024 Christopher Orr
+'''
+
+import os
+import io
+import numpy as np
+import cv2
+from PIL import Image
+
+EXIF_ORIENTATION = 0x0112
+FINGERPRINT_MODE = os.getenv('FINGERPRINT_MODE', 'full')  # 'full' or 'fast' (tensors from a 1/8 scale JPEG decode)
+
+
+def reduced_tensor_pil(file, size=(50, 50)):
+    '''The PIL tensor from a DCT-domain downscaled decode (JPEG only; other formats decode in full).'''
+    with Image.open(io.BytesIO(file) if isinstance(file, bytes) else file) as img:
+        img.draft('RGB', size)
+        return np.array(img.convert('RGB').resize(size, Image.BICUBIC))
+
+
+def reduced_tensor_cv2(file, size=(50, 50)):
+    '''The cv2 tensor from cv2's 1/8 scale decode, which like cv2.imread applies the EXIF orientation.'''
+    if isinstance(file, bytes):
+        img = cv2.imdecode(np.frombuffer(file, dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+    else:
+        img = cv2.imread(file, cv2.IMREAD_REDUCED_COLOR_8)
+    if img is None:
+        raise ValueError(f"cv2 could not open the image: {file if not isinstance(file, bytes) else 'in-memory JPEG'}")
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return np.array(cv2.resize(img, size, interpolation=cv2.INTER_CUBIC))
+
+
+class DecodedImage:
+    '''
+    Decodes a file once with PIL and keeps the full-resolution RGB pixels.  Everything that used to decode the
+    file again reads from here instead:
+        tensor_pil()  - what Image.open(file).convert('RGB').resize(size, BICUBIC) produced
+        tensor_cv2()  - what cv2.imread(file) + cvtColor + resize(INTER_CUBIC) produced; cv2.imread applies
+                        the EXIF orientation, so the pixels are oriented first
+        array         - what face_recognition.load_image_file(file) produced
+        width, height - the stored (unrotated) size, as in tbl_media_objects
+    With fast=True (FINGERPRINT_MODE=fast) the tensors come from 1/8 scale decodes instead, and the full
+    decode is put off until the pixels are needed for face recognition, so duplicates never pay for it.
+    The fast tensors drift slightly from the full ones; validation/fingerprint_drift.py measures by how much.
+    A file converted in memory is decoded from its JPEG bytes (data) before it is written anywhere; file is
+    then the path it will have and converted_from the original, until Utilities.write_converted_file.
+    '''
+    def __init__(self, file, fast=None, data=None, converted_from=None):
+        self.file = file
+        self.data = data
+        self.converted_from = converted_from
+        self.fast = fast if fast is not None else FINGERPRINT_MODE == 'fast'
+        self._array = None
+        with Image.open(self.source()) as img:
+            self.format = img.format
+            self.width, self.height = img.size
+            self.orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+            if not self.fast:
+                self.load(img)
+
+    def source(self):
+        return io.BytesIO(self.data) if self.data is not None else self.file
+
+    def load(self, img=None):
+        # Only the array is kept: holding the PIL image as well would double the memory of a large photo
+        if img is None:
+            with Image.open(self.source()) as img:
+                self._array = np.asarray(img.convert('RGB'))
+        else:
+            self._array = np.asarray(img.convert('RGB'))
+
+    @property
+    def loaded(self):
+        '''Whether the full-resolution pixels are held (always after a full decode, until release).'''
+        return self._array is not None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self.load()
+        return self._array
+
+    def tensor_pil(self, size=(50, 50)):
+        if self.fast:
+            return reduced_tensor_pil(self.data if self.data is not None else self.file, size)
+        return np.array(Image.fromarray(self.array).resize(size, Image.BICUBIC))
+
+    def oriented_array(self):
+        '''The RGB pixels with the EXIF orientation applied, as cv2.imread returns them.  Not kept: a rotated
+        photo's copy is only needed for the cv2 tensor.'''
+        array = self.array
+        if self.orientation in (5, 7):
+            array = array.transpose(1, 0, 2)  # Transpose (5) and transverse (7) swap the axes
+        if self.orientation == 2:
+            array = array[:, ::-1]
+        elif self.orientation in (3, 7):
+            array = array[::-1, ::-1]
+        elif self.orientation == 4:
+            array = array[::-1]
+        elif self.orientation == 6:
+            array = np.rot90(array, -1)
+        elif self.orientation == 8:
+            array = np.rot90(array, 1)
+        return np.ascontiguousarray(array)
+
+    def tensor_cv2(self, size=(50, 50)):
+        if self.fast:
+            return reduced_tensor_cv2(self.data if self.data is not None else self.file, size)
+        return np.array(cv2.resize(self.oriented_array(), size, interpolation=cv2.INTER_CUBIC))
+
+    def release(self):
+        '''Drop the pixels once the last step that needs them is done; a 48 MP photo holds about 150 MB.'''
+        self._array = None
@@ -0,0 +1,431 @@
+'''
+Executors that run batches of files for the cleo2 controller: one Docker container per batch, or a pool of
+local processes forked from a parent that has already loaded the processing libraries.
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import threading
+import subprocess
+import multiprocessing
+import requests
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from utilities import Utilities
+from dbconnection import DBConnection
+
+_processor = None  # FileProcessor built in the parent before forking and inherited by every pool process
+
+
+class Executor:
+    '''
+    Runs batches of (file_path, file_type) for the controller.  submit() starts a batch, results() waits up
+    to timeout seconds and returns (file_path, success) for every file finished since the last call, with
+    success None for a file the batch never reached (it should be queued again).  A batch that cannot be
+    started is reported as failed by the next results().
+    '''
+    def __init__(self):
+        self.startup_times = deque(maxlen=1000)  # Seconds from dispatch until a batch was ready to process
+
+    def record_startup(self, seconds):
+        if seconds is not None:
+            self.startup_times.append(seconds)
+
+    def startup_summary(self):
+        if not self.startup_times:
+            return f"{self.__class__.__name__}: no startup times recorded"
+        times = sorted(self.startup_times)
+        return (f"{self.__class__.__name__} startup over {len(times)} batches: mean {sum(times) / len(times):.3f}s, "
+                f"median {times[len(times) // 2]:.3f}s, p95 {times[min(len(times) - 1, int(len(times) * 0.95))]:.3f}s")
+
+    def submit(self, batch):
+        raise NotImplementedError
+
+    def results(self, timeout):
+        raise NotImplementedError
+
+    def active(self):
+        '''Number of batches currently running.'''
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class DockerExecutor(Executor):
+    '''Starts one processing container per batch and learns about exits from the Docker events stream.'''
+    def __init__(self, client, controller_id, image, manifest_directory, nano_cpus=None, mem_limit=None):
+        # Any object with the docker SDK's containers.run() and events() API will do, e.g. fake_docker.FakeDockerClient
+        super().__init__()
+        self.client = client
+        self.controller_id = controller_id
+        self.image = image
+        self.manifest_directory = manifest_directory
+        self.nano_cpus = nano_cpus
+        self.mem_limit = mem_limit
+        self.utils = Utilities()
+        self.running = True
+        self.active_containers = []
+        self.container_batches = {}  # container.id -> (file_paths, manifest_path)
+        self.finished = []  # Files that failed to start, returned by the next results()
+        self.exited_containers = queue.Queue()  # Container ids reported by the Docker events stream
+        self.events_resynced = threading.Event()  # Set when the events stream (re)connects and a full reload is needed
+        self.start_event_listener()
+
+    def start_event_listener(self):
+        threading.Thread(target=self.listen_for_container_events, daemon=True).start()
+
+    def listen_for_container_events(self):
+        # Containers that die while the stream is down are caught by the full reload done after reconnecting
+        while self.running:
+            try:
+                events = self.client.events(decode=True, filters={'type': 'container', 'event': 'die'})
+                self.events_resynced.set()
+                for event in events:
+                    self.exited_containers.put(event.get('id') or event.get('Actor', {}).get('ID'))
+                    if not self.running:
+                        break
+            except Exception as e:
+                print(f"Docker events stream failed: {e}. Reconnecting...")
+                time.sleep(1)
+
+    def wait_for_exits(self, timeout):
+        # Block until a container exits (or the timeout passes), then return every exited container id
+        exited = set()
+        try:
+            exited.add(self.exited_containers.get(timeout=timeout))
+            while True:
+                exited.add(self.exited_containers.get_nowait())
+        except queue.Empty:
+            pass
+        return exited
+
+    def active(self):
+        return len(self.active_containers)
+
+    def write_manifest(self, batch):
+        os.makedirs(self.manifest_directory, exist_ok=True)
+        manifest_path = os.path.join(self.manifest_directory, f"batch-{self.controller_id}-{time.time_ns()}.txt")
+        with open(manifest_path, 'w') as f:
+            for file_path, file_type in batch:
+                f.write(f"{file_path},{file_type}\n")
+        return manifest_path
+
+    def read_batch_results(self, manifest_path):
+        results = {}
+        results_path = f"{manifest_path}.results.jsonl"
+        try:
+            with open(results_path) as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        results[result['file']] = result['success']
+                        self.record_startup(result.get('startup_seconds'))
+        except (OSError, ValueError) as e:
+            print(f"Error reading batch results {results_path}: {e}")
+        for path in (manifest_path, results_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return results
+
+    def submit(self, batch):
+        file_paths = [file_path for file_path, _ in batch]
+        manifest_path = None
+        try:
+            if len(batch) == 1:
+                file_path, file_type = batch[0]
+                environment = {'NEW_FILE': f"{file_path},{file_type}"}
+            else:
+                manifest_path = self.write_manifest(batch)
+                environment = {'NEW_FILES_MANIFEST': manifest_path}
+            container = self.client.containers.run(
+                self.image,
+                environment=environment,
+                volumes={
+                    '/mnt/MOM': {'bind': '/mnt/MOM', 'mode': 'rw'}
+                },
+                detach=True,
+                nano_cpus=self.nano_cpus,
+                mem_limit=self.mem_limit
+            )
+            self.active_containers.append(container)
+            self.container_batches[container.id] = (file_paths, manifest_path)
+            print(f"Started container {container.id} for {len(batch)} file(s) starting with {file_paths[0]}")
+        except Exception as e:
+            print(f"Error starting container for {len(batch)} file(s) starting with {file_paths[0]}: {e}")
+            self.finished.extend(self.fail_files(file_paths))
+
+    def fail_files(self, file_paths):
+        for file_path in file_paths:
+            self.utils.move_to_error_directory(file_path)
+        return [(file_path, False) for file_path in file_paths]
+
+    def finish_container(self, container):
+        file_paths, manifest_path = self.container_batches.pop(container.id, ([], None))
+        if manifest_path is None:
+            return [(file_path, container.attrs['State']['ExitCode'] == 0) for file_path in file_paths]
+        results = self.read_batch_results(manifest_path)
+        failed = [file_path for file_path in file_paths if results.get(file_path) is False]
+        missing = [file_path for file_path in file_paths if file_path not in results]
+        print(f"Batch in container {container.id}: {len(results) - len(failed)} succeeded, {len(failed)} failed, {len(missing)} not reached")
+        return [(file_path, results.get(file_path)) for file_path in file_paths]
+
+    def results(self, timeout):
+        finished, self.finished = self.finished, []
+        return finished + self.cleanup_containers(self.wait_for_exits(0 if finished else timeout))
+
+    def cleanup_containers(self, exited_ids=None):
+        # Only containers reported by the events stream are inspected.  A full reload of every active
+        # container happens when the stream (re)connects, or when called without ids at shutdown.
+        resync = exited_ids is None or self.events_resynced.is_set()
+        self.events_resynced.clear()
+        finished = []
+        for container in list(self.active_containers):
+            if not resync and container.id not in exited_ids:
+                continue
+            retries = 3
+            while retries > 0:
+                try:
+                    container.reload()
+                    if container.status == 'exited':
+                        print(f"Container {container.id} finished")
+                        self.active_containers.remove(container)
+                        finished.extend(self.finish_container(container))
+                        container.remove()
+                    break  # Break the retry loop if successful
+                except requests.exceptions.ReadTimeout:
+                    retries -= 1
+                    print(f"Timeout error while reloading container {container.id}. Retrying... ({3-retries}/3)")
+                except Exception as e:
+                    print(f"Error reloading container {container.id}: {e}")
+                    file_paths, _ = self.container_batches.pop(container.id, ([], None))
+                    finished.extend(self.fail_files(file_paths))
+                    self.active_containers.remove(container)
+                    container.remove()
+                    break  # Break the loop on non-timeout errors
+        return finished
+
+    def shutdown(self):
+        self.running = False
+        return self.cleanup_containers()
+
+
+def preload_processor():
+    '''Import dlib, cv2 and face_recognition and load the known faces once, in the parent, before forking.'''
+    global _processor
+    from file_processor import FileProcessor
+    _processor = FileProcessor()
+
+
+def init_pool_process():
+    # The controller handles Ctrl-C and shuts the pool down; the inherited PostgreSQL pool was closed
+    # before forking, so each process opens its own connections.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    DBConnection.get_instance().initialize_pool()
+
+
+def process_batch(batch):
+    _processor.prefetch_metadata(batch)
+    return [(file_path, _processor.process((file_path, file_type))) for file_path, file_type in batch]
+
+
+class LocalProcessExecutor(Executor):
+    '''
+    Runs batches in a concurrent.futures process pool on this host, without Docker.  The pool is forked
+    from the controller after preload() has imported the processing libraries and loaded the known face
+    encodings, so every process shares them copy-on-write instead of loading them per file.  target(batch)
+    must be a module level function returning [(file_path, success)].
+    '''
+    def __init__(self, max_workers, target=process_batch, preload=preload_processor):
+        super().__init__()
+        self.max_workers = max_workers
+        self.target = target
+        self.utils = Utilities()
+        self.db_conn_instance = DBConnection.get_instance()
+        self.futures = {}  # future -> batch
+        self.finished = []  # Files that failed to start, returned by the next results()
+        if preload is not None:
+            preload()
+        self.pool = None
+        self.start_pool()
+
+    def start_pool(self):
+        # PostgreSQL connections must not be shared across fork, so the parent's pool is closed while the
+        # processes are forked (all at once, by the warm-up tasks) and reopened afterwards.
+        self.db_conn_instance.close_pool()
+        try:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=init_pool_process
+            )
+            for future in [self.pool.submit(os.getpid) for _ in range(self.max_workers)]:
+                future.result()
+        finally:
+            self.db_conn_instance.initialize_pool()
+        print(f"Started {self.max_workers} local processing processes")
+
+    def active(self):
+        return len(self.futures)
+
+    def submit(self, batch):
+        try:
+            self.futures[self.pool.submit(self.target, batch)] = batch
+        except Exception as e:
+            print(f"Error submitting {len(batch)} file(s) starting with {batch[0][0]}: {e}")
+            self.finished.extend(self.fail_files(batch))
+
+    def fail_files(self, batch):
+        for file_path, _ in batch:
+            self.utils.move_to_error_directory(file_path)
+        return [(file_path, False) for file_path, _ in batch]
+
+    def collect(self, futures):
+        finished = []
+        broken = False
+        for future in futures:
+            batch = self.futures.pop(future)
+            try:
+                finished.extend(future.result())
+            except Exception as e:
+                # A process that dies (e.g. a crash in dlib) breaks the whole pool, and which file of its
+                # batch caused it is unknown, so the whole batch is failed
+                print(f"Batch of {len(batch)} file(s) starting with {batch[0][0]} failed: {e}")
+                finished.extend(self.fail_files(batch))
+                broken = True
+        return finished, broken
+
+    def results(self, timeout):
+        finished, self.finished = self.finished, []
+        if not self.futures:
+            if not finished:
+                time.sleep(timeout)
+            return finished
+        done, _ = wait(list(self.futures), timeout=0 if finished else timeout, return_when=FIRST_COMPLETED)
+        collected, broken = self.collect(done)
+        finished.extend(collected)
+        if broken:
+            # Every other batch in a broken pool fails too; collect them before forking a fresh pool
+            collected, _ = self.collect(list(self.futures))
+            finished.extend(collected)
+            self.pool.shutdown(wait=True)
+            self.start_pool()
+        return finished
+
+    def shutdown(self):
+        finished, self.finished = self.finished, []
+        collected, _ = self.collect(list(self.futures))
+        self.pool.shutdown(wait=True)
+        return finished + collected
+
+
+class ZygoteExecutor(Executor):
+    '''
+    Sends each batch to a zygote.py fork server, which has imported the processing libraries and loaded the
+    known faces once and forks a fresh child per batch.  Children are isolated from each other like
+    containers but start in milliseconds; their startup times are kept in startup_times.
+    '''
+    def __init__(self, command=None):
+        super().__init__()
+        self.command = command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zygote.py')]
+        self.utils = Utilities()
+        self.requests = {}  # request id -> (file_paths, paths reported so far)
+        self.finished = []  # Files that failed to start, returned by the next results()
+        self.next_id = 0
+        self.process = None
+        self.messages = None
+        self.start_zygote()
+
+    def start_zygote(self):
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.messages = queue.Queue()
+        threading.Thread(target=self.read_messages, args=(self.process, self.messages), daemon=True).start()
+        ready = self.messages.get()
+        if not ready.get('ready'):
+            raise RuntimeError("Zygote exited before it was ready")
+        print(f"Zygote {self.process.pid} ready, preload seconds: {ready.get('preload_seconds')}")
+
+    def read_messages(self, process, messages):
+        for line in process.stdout:
+            try:
+                messages.put(json.loads(line))
+            except ValueError:
+                print(f"Invalid zygote message: {line[:200]}")
+        messages.put({'eof': True})
+
+    def active(self):
+        return len(self.requests)
+
+    def submit(self, batch):
+        self.next_id += 1
+        request = {'id': self.next_id, 'batch': [list(file_info) for file_info in batch]}
+        try:
+            self.process.stdin.write((json.dumps(request) + '\n').encode())
+            self.process.stdin.flush()
+            self.requests[self.next_id] = ([file_path for file_path, _ in batch], set())
+        except (OSError, ValueError) as e:
+            print(f"Error sending {len(batch)} file(s) starting with {batch[0][0]} to the zygote: {e}")
+            for file_path, _ in batch:
+                self.utils.move_to_error_directory(file_path)
+            self.finished.extend((file_path, False) for file_path, _ in batch)
+
+    def finish_request(self, request_id, exit_code):
+        file_paths, reported = self.requests.pop(request_id, ([], set()))
+        missing = [file_path for file_path in file_paths if file_path not in reported]
+        if missing:
+            print(f"Batch {request_id} exited with code {exit_code}, {len(missing)} file(s) not reached")
+        return [(file_path, None) for file_path in missing]
+
+    def handle(self, message):
+        if message.get('eof'):
+            # The zygote died: every running batch is lost, so queue the files again and fork a new zygote
+            print("Zygote exited unexpectedly, restarting")
+            finished = []
+            for request_id in list(self.requests):
+                finished.extend(self.finish_request(request_id, None))
+            self.start_zygote()
+            return finished
+        if 'startup_seconds' in message:
+            self.record_startup(message['startup_seconds'])
+        elif 'file' in message:
+            if message['id'] in self.requests:
+                self.requests[message['id']][1].add(message['file'])
+            return [(message['file'], message['success'])]
+        elif message.get('done'):
+            return self.finish_request(message['id'], message.get('exit_code'))
+        return []
+
+    def results(self, timeout):
+        finished, self.finished = self.finished, []
+        try:
+            finished.extend(self.handle(self.messages.get(timeout=0 if finished else timeout)))
+            while True:
+                finished.extend(self.handle(self.messages.get_nowait()))
+        except queue.Empty:
+            pass
+        return finished
+
+    def shutdown(self):
+        # Closing stdin tells the zygote to wait for its children and exit
+        finished, self.finished = self.finished, []
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        while self.requests:
+            message = self.messages.get()
+            if message.get('eof'):
+                for request_id in list(self.requests):
+                    finished.extend(self.finish_request(request_id, None))
+                break
+            finished.extend(self.handle(message))
+        self.process.wait()
+        return finished
@@ -61,6 +61,7 @@ import os
 import json
 import warnings
 import codecs
+import select
 
 try:        # Py3k compatibility
     basestring
@@ -80,8 +81,10 @@ sentinel = b"{ready}"
 
 # The block size when reading from exiftool.  The standard value
 # should be fine, though other values might give better performance in
-# some cases.
+# some cases.  Each read that fills its block doubles the next one, up
+# to max_block_size, so large outputs take few reads.
 block_size = 4096
+max_block_size = 1 << 20
 
 # This code has been adapted from Lib/os.py in the Python source tree
 # (sha1 265e36e277f3)
@@ -148,11 +151,12 @@ class ExifTool(object):
        associated with a running subprocess.
     """
 
-    def __init__(self, executable_=None):
+    def __init__(self, executable_=None, timeout=None):
         if executable_ is None:
             self.executable = executable
         else:
             self.executable = executable_
+        self.timeout = timeout
         self.running = False
 
     def start(self):
@@ -187,6 +191,19 @@ class ExifTool(object):
         del self._process
         self.running = False
 
+    def kill(self):
+        """Kill the ``exiftool`` process of this instance without waiting
+        for it to finish, for a process that is hung or has died.
+
+        If the subprocess isn't running, this method will do nothing.
+        """
+        if not self.running:
+            return
+        self._process.kill()
+        self._process.communicate()
+        del self._process
+        self.running = False
+
     def __enter__(self):
         self.start()
         return self
@@ -207,7 +224,11 @@ class ExifTool(object):
         automatically; see the documentation of :py:meth:`start()` for
         the common options.  The ``exiftool`` output is read up to the
         end-of-output sentinel and returned as a raw ``bytes`` object,
-        excluding the sentinel.
+        excluding the sentinel.  If the instance was created with a
+        ``timeout``, ``TimeoutError`` is raised when no output arrives
+        for that many seconds; ``IOError`` is raised if the process
+        exits before the sentinel.  Either way the process is left in
+        an unknown state and should be killed.
 
         The parameters must also be raw ``bytes``, in whatever
         encoding exiftool accepts.  For filenames, this should be the
@@ -220,10 +241,27 @@ class ExifTool(object):
             raise ValueError("ExifTool instance not running.")
         self._process.stdin.write(b"\n".join(params + (b"-execute\n",)))
         self._process.stdin.flush()
-        output = b""
         fd = self._process.stdout.fileno()
-        while not output[-32:].strip().endswith(sentinel):
-            output += os.read(fd, block_size)
+        # Read straight into a buffer that grows by doubling, and only
+        # look for the sentinel in the last few bytes, so the work is
+        # linear in the size of the output
+        buffer = bytearray(block_size)
+        length = 0
+        size = block_size
+        while not buffer[max(0, length - 32):length].strip().endswith(sentinel):
+            if len(buffer) < length + size:
+                buffer.extend(bytes(max(len(buffer), length + size - len(buffer))))
+            if self.timeout is not None and not select.select([fd], [], [], self.timeout)[0]:
+                raise TimeoutError("No output from exiftool for %s seconds" % self.timeout)
+            with memoryview(buffer) as view, view[length:length + size] as block:
+                count = os.readv(fd, [block])
+            if not count:
+                raise IOError("exiftool exited before finishing the command")
+            length += count
+            if count == size and size < max_block_size:
+                size *= 2
+        with memoryview(buffer) as view:
+            output = bytes(view[:length])
         return output.strip()[:-len(sentinel)]
 
     def execute_json(self, *params):
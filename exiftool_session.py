@@ -0,0 +1,230 @@
+'''
+Long-lived exiftool processes per worker, shared by every metadata read.
+2024 Christopher Orr
+'''
+
+import os
+import queue
+import atexit
+import threading
+import multiprocessing.util
+from concurrent.futures import Future
+import exiftool
+from logger_config import get_logger
+
+EXIFTOOL_MAX_FILES = int(os.getenv('EXIFTOOL_MAX_FILES', 2000))  # Restart after this many files, to bound exiftool's memory
+EXIFTOOL_TIMEOUT = float(os.getenv('EXIFTOOL_TIMEOUT', 30))  # Seconds without output before exiftool is considered hung
+EXIFTOOL_PROCESSES = int(os.getenv('EXIFTOOL_PROCESSES', 1))  # exiftool processes per worker
+EXIFTOOL_BATCH_SIZE = int(os.getenv('EXIFTOOL_BATCH_SIZE', 50))  # Most files read by one exiftool -execute
+METADATA_PROFILE = os.getenv('METADATA_PROFILE', 'full')  # 'full' (every tag) or 'fast' (only the tags ingestion uses)
+
+# exiftool arguments per extraction profile.  'fast' reads just the capture date and GPS position, and with -fast2
+# stops at the end of the metadata instead of scanning the rest of the file or decoding maker notes
+PROFILES = {
+    'full': [],
+    'fast': ['-fast2', '-EXIF:DateTimeOriginal', '-EXIF:GPSLatitude', '-EXIF:GPSLatitudeRef', '-EXIF:GPSLongitude', '-EXIF:GPSLongitudeRef'],
+}
+
+
+def file_signature(path):
+    '''Identifies a file's current contents well enough to tell whether metadata read earlier still applies.'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ExifToolSession:
+    '''
+    A lazily started `exiftool -stay_open` process, so each file costs exiftool's parse time rather than a Perl
+    start-up.  The process is checked before every request and started again if it has died, after
+    EXIFTOOL_MAX_FILES files, or after a read times out or fails.  A process forked from a worker (the zygote,
+    the local pool) starts its own rather than sharing the parent's pipes.
+    '''
+    def __init__(self, max_files=EXIFTOOL_MAX_FILES, timeout=EXIFTOOL_TIMEOUT):
+        self.logger = get_logger(self.__class__.__name__)
+        self.max_files = max_files
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.et = None
+        self.pid = None
+        self.files = 0
+        self.restarts = 0
+
+    def healthy(self):
+        return self.et is not None and self.et.running and self.et._process.poll() is None
+
+    def start(self):
+        function_name = 'start'
+        if self.et is not None and self.pid != os.getpid():
+            # Inherited across fork: the pipes belong to the parent's process, so leave it alone
+            self.et.running = False
+            self.et = None
+        elif self.et is not None:
+            self.et.kill()
+            self.restarts += 1
+        self.et = exiftool.ExifTool(timeout=self.timeout)
+        self.et.start()
+        self.pid = os.getpid()
+        self.files = 0
+        self.logger.debug(f"Started exiftool (pid {self.et._process.pid})", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+    def stop(self):
+        function_name = 'stop'
+        with self.lock:
+            if self.et is None or self.pid != os.getpid():
+                return
+            try:
+                self.et.terminate()
+            except Exception as e:
+                self.logger.warning(f"exiftool did not stop cleanly, killing it: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                self.et.kill()
+            self.et = None
+
+    def get_metadata_batch(self, paths, profile='full'):
+        '''One metadata dict per file exiftool could read, each with its path in SourceFile.'''
+        function_name = 'get_metadata_batch'
+        with self.lock:
+            if self.pid != os.getpid() or not self.healthy() or self.files >= self.max_files:
+                self.start()
+            try:
+                metadata = self.et.execute_json(*PROFILES[profile], *paths)
+            except (TimeoutError, OSError) as e:
+                # The process is hung or gone, and any late output would be read as the next request's
+                self.logger.warning(f"exiftool failed on {len(paths)} files, restarting it: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                self.et.kill()
+                raise
+            self.files += len(paths)
+            return metadata
+
+    def get_metadata(self, path, profile='full'):
+        return self.get_metadata_batch([path], profile)[0]
+
+
+class ExifToolPool:
+    '''
+    EXIFTOOL_PROCESSES exiftool sessions behind one request queue.  Each session's thread takes whatever requests
+    are waiting, up to EXIFTOOL_BATCH_SIZE, reads them with a single -j execute and hands each caller its own
+    file's metadata (requests for different profiles share a wakeup but not an execute); if the batch fails the files are retried one at a time, so a bad file only fails itself.
+    prefetch reads a whole batch of files up front and keeps the results, until the next prefetch, for the files
+    that are asked for unchanged.  Stopped when the worker exits.
+    '''
+    _instance = None
+
+    @staticmethod
+    def get_instance():
+        if ExifToolPool._instance is None:
+            ExifToolPool._instance = ExifToolPool()
+            atexit.register(ExifToolPool._instance.stop)
+            # Pool processes leave through os._exit, which skips atexit but not multiprocessing's finalizers
+            multiprocessing.util.Finalize(ExifToolPool._instance, ExifToolPool._instance.stop, exitpriority=10)
+        return ExifToolPool._instance
+
+    def __init__(self, processes=EXIFTOOL_PROCESSES, batch_size=EXIFTOOL_BATCH_SIZE):
+        self.logger = get_logger(self.__class__.__name__)
+        self.processes = max(1, processes)
+        self.batch_size = max(1, batch_size)
+        self.sessions = [ExifToolSession() for _ in range(self.processes)]
+        self.lock = threading.Lock()
+        self.requests = None
+        self.threads = []
+        self.pid = None
+        self.prefetched = {}  # (path, profile) -> (stat signature, metadata)
+
+    def ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # Threads do not survive fork, so a forked worker starts its own; the sessions restart themselves
+            self.requests = queue.Queue()
+            self.threads = [threading.Thread(target=self.dispatch, args=(session, self.requests), daemon=True) for session in self.sessions]
+            for thread in self.threads:
+                thread.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            for _ in self.threads:
+                self.requests.put(None)
+            for thread in self.threads:
+                thread.join(timeout=EXIFTOOL_TIMEOUT)
+            self.pid = None
+        for session in self.sessions:
+            session.stop()
+
+    def dispatch(self, session, requests):
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            batch = [request]
+            while len(batch) < self.batch_size:
+                try:
+                    request = requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    requests.put(None)  # Finish this batch first
+                    break
+                batch.append(request)
+            for profile in {profile for _, profile, _ in batch}:
+                self.run_batch(session, [request for request in batch if request[1] == profile])
+
+    def run_batch(self, session, batch):
+        function_name = 'run_batch'
+        try:
+            results = session.get_metadata_batch([path for path, _, _ in batch], batch[0][1])
+        except Exception as e:
+            if len(batch) > 1:
+                self.logger.warning(f"exiftool batch of {len(batch)} files failed, reading them one at a time: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                for request in batch:
+                    self.run_batch(session, [request])
+            else:
+                batch[0][2].set_exception(e)
+            return
+        by_path = {metadata.get('SourceFile'): metadata for metadata in results}
+        for path, _, future in batch:
+            future.set_result(by_path.get(path, {}))
+
+    def submit(self, path, profile=METADATA_PROFILE):
+        self.ensure_started()
+        future = Future()
+        self.requests.put((path, profile, future))
+        return future
+
+    def get_metadata_batch(self, paths, profile=METADATA_PROFILE):
+        '''One metadata dict per path, in order; {} for a file exiftool could not read, so it fails only itself.'''
+        function_name = 'get_metadata_batch'
+        futures = [self.submit(path, profile) for path in paths]
+        results = []
+        for path, future in zip(paths, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                self.logger.error(f"Failed to extract metadata with EXIFtool for {path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                results.append({})
+        return results
+
+    def get_metadata(self, path, profile=METADATA_PROFILE):
+        with self.lock:
+            signature, metadata = self.prefetched.pop((path, profile), (None, None))
+        if metadata is not None and signature == file_signature(path):
+            return metadata
+        return self.submit(path, profile).result()
+
+    def prefetch(self, paths, profile=METADATA_PROFILE):
+        '''Read the metadata of all the files in as few exiftool executes as possible, for later get_metadata calls.'''
+        paths = [path for path in paths if os.path.isfile(path)]
+        signatures = [file_signature(path) for path in paths]
+        results = self.get_metadata_batch(paths, profile)
+        with self.lock:
+            # Only the current batch is kept: files that turned out to be duplicates, failed early or were renamed
+            # are never asked for, and would otherwise pile up in a long-lived worker
+            self.prefetched = {}
+            for path, signature, metadata in zip(paths, signatures, results):
+                if metadata:
+                    self.prefetched[(path, profile)] = (signature, metadata)
+        return len(self.prefetched)
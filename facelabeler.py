@@ -62,13 +62,15 @@ class FaceLabeler:
         finally:
             self.db_conn_instance.return_connection(conn)
 
-    def label_faces_in_image(self, image_path, media_object_id):
+    def label_faces_in_image(self, image_path, media_object_id, image=None):
+        '''image is the already decoded RGB array of image_path, if the caller has one.'''
         function_name = 'label_faces_in_image'
         self.media_object_id = media_object_id  # Store media_object_id as an instance variable
         self.logger.info("Labelling faces in the image.", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
         try:
-            image = face_recognition.load_image_file(image_path)
+            if image is None:
+                image = face_recognition.load_image_file(image_path)
         except UnidentifiedImageError as e:
             self.logger.error(f"Failed to load image file {image_path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             return []
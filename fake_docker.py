@@ -0,0 +1,160 @@
+'''
+An in-process stand-in for the docker SDK client used by the cleo2 controller.  Containers "run" in
+threads and a 'die' event is emitted on events() when they finish, so the controller can be tested and
+benchmarked without a Docker daemon.
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import uuid
+import shutil
+import tempfile
+import threading
+
+
+class FakeContainer:
+    def __init__(self, client, image, environment, work):
+        self.client = client
+        self.id = uuid.uuid4().hex
+        self.image = image
+        self.status = 'running'
+        self.attrs = {'Config': {'Env': [f"{k}={v}" for k, v in (environment or {}).items()]}, 'State': {'ExitCode': None}}
+        self.environment = environment or {}
+        self.done = threading.Event()
+        threading.Thread(target=self._run, args=(work,), daemon=True).start()
+
+    def _run(self, work):
+        exit_code = 0
+        try:
+            work(self.environment)
+        except Exception:
+            exit_code = 1
+        self.attrs['State']['ExitCode'] = exit_code
+        self.status = 'exited'
+        self.done.set()
+        self.client.emit({'status': 'die', 'id': self.id, 'Actor': {'ID': self.id, 'Attributes': {'exitCode': str(exit_code)}}})
+
+    def reload(self):
+        self.client.api_calls += 1
+
+    def wait(self, timeout=None):
+        self.client.api_calls += 1
+        self.done.wait(timeout)
+        return {'StatusCode': self.attrs['State']['ExitCode']}
+
+    def remove(self):
+        self.client.api_calls += 1
+        self.client.containers.removed += 1
+
+
+class FakeContainerCollection:
+    def __init__(self, client):
+        self.client = client
+        self.started = 0
+        self.removed = 0
+
+    def run(self, image, environment=None, detach=True, **kwargs):
+        self.client.api_calls += 1
+        self.started += 1
+        return FakeContainer(self.client, image, environment, self.client.work)
+
+
+class FakeDockerClient:
+    '''
+    Mimics docker.DockerClient.containers.run() and events().  work(environment) is run in each
+    container's thread; by default it just sleeps for `duration` seconds.
+    '''
+    def __init__(self, work=None, duration=0.05):
+        self.duration = duration
+        self.work = work if work is not None else self.sleep
+        self.containers = FakeContainerCollection(self)
+        self.api_calls = 0
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def sleep(self, environment):
+        time.sleep(self.duration)
+
+    def emit(self, event):
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.put(event)
+
+    def events(self, decode=True, filters=None):
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.append(subscriber)
+
+        def stream():
+            while True:
+                yield subscriber.get()
+
+        return stream()
+
+
+def fake_process_batch(batch, duration=0.05):
+    '''Stand-in for executors.process_batch: "processes" each file by removing it from the inbox.'''
+    results = []
+    for file_path, file_type in batch:
+        time.sleep(duration)
+        os.remove(file_path)
+        results.append((file_path, True))
+    return results
+
+
+def benchmark(file_count=200, duration=0.05, executor='docker'):
+    '''
+    Run the controller until file_count dummy files have been processed, against FakeDockerClient or, with
+    executor='process', against a LocalProcessExecutor running fake_process_batch.
+    '''
+    from controller import Controller, MAX_CONTAINERS
+    from executors import LocalProcessExecutor
+
+    inbox = tempfile.mkdtemp(prefix='cleo_fake_inbox_')
+    for index in range(file_count):
+        with open(os.path.join(inbox, f"IMG_{index:05d}.jpg"), 'wb') as f:
+            f.write(b'\xff\xd8')
+
+    def work(environment):
+        # The real container moves each file out of the inbox and, for a batch, appends its results
+        if 'NEW_FILES_MANIFEST' in environment:
+            manifest_path = environment['NEW_FILES_MANIFEST']
+            with open(manifest_path) as manifest, open(f"{manifest_path}.results.jsonl", 'a') as results:
+                for line in manifest:
+                    file_path, file_type = line.strip().rsplit(',', 1)
+                    time.sleep(duration)
+                    os.remove(file_path)
+                    results.write(json.dumps({'file': file_path, 'type': file_type, 'success': True}) + '\n')
+            return
+        time.sleep(duration)
+        os.remove(environment['NEW_FILE'].split(',')[0])
+
+    client = FakeDockerClient(work=work)
+    if executor == 'process':
+        controller = Controller(new_folder=inbox, executor=LocalProcessExecutor(MAX_CONTAINERS, target=fake_process_batch, preload=None))
+    else:
+        controller = Controller(client=client, new_folder=inbox)
+
+    def stop_when_done():
+        while os.listdir(inbox) or controller.executor.active():
+            time.sleep(0.05)
+        controller.running = False
+
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    start_time = time.time()
+    controller.manage_queue()
+    elapsed = time.time() - start_time
+    controller.executor.shutdown()
+    shutil.rmtree(inbox, ignore_errors=True)
+
+    print(f"Processed {file_count} files in {elapsed:.2f} seconds ({file_count / elapsed:.1f} files/second)")
+    print(f"Docker API calls: {client.api_calls} ({client.api_calls / file_count:.1f} per file)")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    benchmark(file_count=count, executor=sys.argv[2] if len(sys.argv) > 2 else 'docker')
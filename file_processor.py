@@ -5,23 +5,123 @@ from dotenv import load_dotenv
 from facelabeler import FaceLabeler
 from settings import *
 from utilities import Utilities
+from checkpoints import PipelineCheckpoints, STAGES
+from perceptual_hash import PerceptualHashIndex
+from content_hash import ContentHashIndex
 from logger_config import setup_logging, get_logger
 
 # Load environment variables from .env file
 load_dotenv()
 
 class FileProcessor:
-    def __init__(self, file):
+    def __init__(self, file=None):
         setup_logging()
         self.logger = get_logger('main')
 
+        # The utilities, face encodings and database pool are built once and reused for every file
+        self.util = Utilities()
+        self.face_labeler = FaceLabeler()
+        self.checkpoints = PipelineCheckpoints()
+        self.phash_index = PerceptualHashIndex()
+        self.content_hashes = ContentHashIndex()
+
+        if file is not None:
+            self.process(file)
+
+    def process(self, file):
+        '''True once the file is stored or set aside as a duplicate.  Any step that leaves the file unprocessed
+        raises, so the file is moved to the error directory and reported as failed rather than done.'''
         self.initialize_variables(file)
 
         try:
+            self.checkpoint = self.resume_checkpoint()
             self.process_file()
+            self.checkpoints.clear(self.file_to_process, self.file_type_to_process)
+            return True
         except Exception as e:
             self.logger.error(f"Error processing file {self.file_to_process}: {e}")
             self.util.move_to_error_directory(self.file_to_process)
+            return False
+        finally:
+            # Early returns and errors leave the pixels held; never keep them until the next file
+            if self.decoded is not None:
+                self.decoded.release()
+
+    def prefetch_metadata(self, file_infos):
+        '''Extract the metadata of a batch's images up front, in batched exiftool calls rather than one per file.'''
+        images = [file_path for file_path, file_type in file_infos if file_type == 'image']
+        if len(images) > 1:
+            self.util.prefetch_image_metadata(images)
+
+    def resume_checkpoint(self):
+        function_name = 'resume_checkpoint'
+        checkpoint = self.checkpoints.load(self.file_to_process, self.file_type_to_process)
+        if checkpoint is None:
+            return None
+        data = checkpoint['data']
+        if STAGES.index(checkpoint['stage']) < STAGES.index('moved'):
+            # Still in the inbox: resume if the checkpointed (possibly converted) file is the one being retried.  A file
+            # converted in memory is only written when it is moved, so until then its original is what remains
+            file = data.get('file') if data.get('file') and os.path.exists(data['file']) else data.get('converted_from')
+            if file and os.path.exists(file) and (file == self.file_to_process or not os.path.exists(self.file_to_process)):
+                self.logger.info(f"Resuming {self.file_to_process} after stage {checkpoint['stage']}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                return checkpoint
+            self.logger.info(f"Discarding stale checkpoint {checkpoint['stage']} for {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            self.checkpoints.clear(self.file_to_process, self.file_type_to_process)
+            return None
+        if not os.path.exists(self.file_to_process):
+            self.logger.info(f"Resuming {self.file_to_process} from {data.get('updated_file')} after stage {checkpoint['stage']}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return checkpoint
+        # A new file with the same name arrived after the earlier one left the inbox: finish the earlier one first
+        self.logger.info(f"Finishing interrupted {data.get('updated_file')} before processing {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        file = (self.file_to_process, self.file_type_to_process)
+        self.checkpoint = checkpoint
+        self.process_file()
+        self.checkpoints.clear(*file)
+        self.initialize_variables(file)
+        return None
+
+    def stage_done(self, stage):
+        return self.checkpoint is not None and STAGES.index(self.checkpoint['stage']) >= STAGES.index(stage)
+
+    def save_checkpoint(self, stage, tensor_pil=None, tensor_cv2=None, **data):
+        self.checkpoints.save(self.file_to_process, self.file_type_to_process, stage, data, tensor_pil, tensor_cv2)
+        if self.checkpoint is None:
+            self.checkpoint = {'stage': stage, 'data': {}, 'tensor_pil': None, 'tensor_cv2': None}
+        self.checkpoint['stage'] = stage
+        self.checkpoint['data'].update(data)
+
+    def restore_original_details(self):
+        data = self.checkpoint['data']
+        self.original_file_name = data.get('original_file_name')
+        self.original_file_extension = data.get('original_file_extension')
+        self.original_file_type = data.get('original_file_type')
+
+    def save_original_details(self, stage, file, **data):
+        self.original_file_name = os.path.basename(self.file_to_process)  # Store the original filename
+        self.original_file_extension = Path(self.file_to_process).suffix[1:] # Store the original file extension
+        self.original_file_type = self.file_type_to_process # Store the original file type
+        self.save_checkpoint(
+            stage,
+            source=self.file_to_process,
+            file=file,
+            original_file_name=self.original_file_name,
+            original_file_extension=self.original_file_extension,
+            original_file_type=self.original_file_type,
+            **data
+        )
+
+    def readable_file(self, file):
+        '''The path to read the file from: its original until a file converted in memory has been written.'''
+        if self.decoded is not None and self.decoded.converted_from is not None:
+            return self.decoded.converted_from
+        return file
+
+    def move_file(self, file, new_file):
+        '''Move the file, or write it there if it was converted in memory, so it is written only once.'''
+        if self.decoded is not None and self.decoded.converted_from is not None:
+            return self.util.write_converted_file(self.decoded, new_file)
+        return self.util.move_file(file, new_file)
 
     def process_file(self):
         if self.file_type_to_process == 'movie':
@@ -54,9 +154,9 @@ class FileProcessor:
         self.location_country = None
         self.media_object_id = None
         self.new_file_name = None
-        
-        self.util = Utilities()
-        self.face_labeler = FaceLabeler()
+        self.checkpoint = None  # Stages this file completed in an earlier, interrupted attempt
+        self.decoded = None  # The image decoded once for the tensors, dimensions and faces
+        self.content_hash = None  # BLAKE2b of the file as it arrived
 
     def process_image(self):
         function_name = 'process_image'
@@ -64,38 +164,74 @@ class FileProcessor:
 
         self.logger.info(f"Processing file {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
-        # Step 1: Generate tensors
-        step_start_time = time.time()
-        result = self.util.generate_tensor(self.file_to_process)
-        self.logger.detail(f"Step 1: Generate tensor took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-        
-        if isinstance(result, tuple):
+        # Step 1: Convert the file to JPG if needed
+        if self.stage_done('converted'):
+            file = self.checkpoint['data']['file']
+            self.restore_original_details()
+            self.content_hash = self.checkpoint['data'].get('content_hash')
+            converted_from = self.checkpoint['data'].get('converted_from')
+            if converted_from and not os.path.exists(file) and not self.stage_done('moved'):
+                # Converted in memory but never written: convert it again
+                file, self.decoded = self.util.check_and_decode_file(converted_from)
+        else:
+            # A byte-identical copy of a stored image is a duplicate before any conversion or decoding
+            step_start_time = time.time()
+            actual_extension, self.content_hash = self.util.identify_file_and_hash(self.file_to_process)
+            existing = self.content_hashes.lookup(self.content_hash)
+            self.logger.detail(f"Step 0: Hash file took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            if existing is not None:
+                self.logger.info(f"{self.file_to_process} is byte-identical to {existing[1]}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                self.handle_duplicate(self.file_to_process, [(existing[1], 0.0)])
+                return
+
+            step_start_time = time.time()
+            # Formats that need converting are converted in memory and written once, when the file is moved
+            file, self.decoded = self.util.check_and_decode_file(self.file_to_process, actual_extension)
+            self.save_original_details('converted', file, converted_from=self.decoded.converted_from if self.decoded is not None else None, content_hash=self.content_hash)
+            self.logger.detail(f"Step 1: Convert file took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+        # Step 2: Generate tensors
+        if self.stage_done('hashed'):
+            data = self.checkpoint['data']
+            tensor_pil, hash_pil, tensor_cv2, hash_cv2 = self.checkpoint['tensor_pil'], data['hash_pil'], self.checkpoint['tensor_cv2'], data['hash_cv2']
+        else:
+            step_start_time = time.time()
+            if self.decoded is None:
+                self.decoded = self.util.decode_image(file)
+            result = self.util.generate_tensor(file, self.decoded)
+            self.logger.detail(f"Step 2: Generate tensor took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            if not isinstance(result, tuple):
+                self.logger.error(f"Failed to generate tensor for {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                raise RuntimeError(f"Failed to generate tensor for {self.file_to_process}")
             file, tensor_pil, hash_pil, tensor_cv2, hash_cv2 = result
+            self.save_checkpoint('hashed', tensor_pil=tensor_pil, tensor_cv2=tensor_cv2, file=file, hash_pil=hash_pil, hash_cv2=hash_cv2)
 
-            self.original_file_name = os.path.basename(self.file_to_process)  # Store the original filename
-            self.original_file_extension = Path(self.file_to_process).suffix[1:] # Store the original file extension
-            self.original_file_type = self.file_type_to_process # Store the original file type
-            
-            # Step 2: Fetch potential duplicates using PIL and cv2 hashes
+        if self.stage_done('deduped'):
+            duplicates = self.checkpoint['data']['duplicates']
+        else:
+            # Step 3: Fetch potential duplicates using PIL and cv2 hashes, and near duplicates by perceptual hash
             step_start_time = time.time()
-            potential_duplicates = self.util.fetch_potential_duplicates(hash_pil, hash_cv2)
-            self.logger.detail(f"Step 2: Fetch potential duplicates took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            near_duplicates = self.phash_index.search(tensor_pil)
+            potential_duplicates = self.util.fetch_potential_duplicates(hash_pil, hash_cv2, [tensor_id for tensor_id, _ in near_duplicates])
+            self.logger.detail(f"Step 3: Fetch potential duplicates took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
-            # Step 3: Compare tensor with potential duplicates
+            # Step 4: Compare tensor with potential duplicates
             step_start_time = time.time()
             duplicates = self.util.compare_with_potential_duplicates(tensor_pil, tensor_cv2, potential_duplicates, self.mse_threshold)
-            self.logger.detail(f"Step 3: Compare tensor with potential duplicates took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-            # Step 4: If duplicate, rename and move to duplicate folder
-            if duplicates:
-                self.handle_duplicate(file, duplicates)
-            else:
-                self.logger.debug(f"No duplicate found for {file}...processing...", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-                # Step 5: Process the non-duplicate image
-                self.process_non_duplicate_image(file, tensor_pil, hash_pil, tensor_cv2, hash_cv2)
+            duplicates = [(filename, float(mse)) for filename, mse in duplicates]
+            self.save_checkpoint('deduped', duplicates=duplicates)
+            self.logger.detail(f"Step 4: Compare tensor with potential duplicates took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+        # Step 5: If duplicate, rename and move to duplicate folder
+        if duplicates:
+            if self.decoded is not None:
+                self.decoded.release()  # Only the stored image's faces need the pixels
+            self.handle_duplicate(file, duplicates)
         else:
-            self.logger.error(f"Failed to generate tensor for {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            self.logger.debug(f"No duplicate found for {file}...processing...", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+            # Step 6: Process the non-duplicate image
+            self.process_non_duplicate_image(file, tensor_pil, hash_pil, tensor_cv2, hash_cv2)
 
         self.logger.detail(f"Total duration of process_image: {time.time() - start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
@@ -123,20 +259,68 @@ class FileProcessor:
         self.logger.debug(f"File: {fn} is a duplicate and is moved to the duplicates folder.", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
         updated_file = os.path.join(self.duplicates_folder, fn)
         step_start_time = time.time()
-        self.util.move_file(file, updated_file)
+        move_file_result = self.move_file(file, updated_file)
+        if move_file_result != 'Success':
+            raise RuntimeError(f"Failed to move duplicate {file} to {updated_file}: {move_file_result}")
         self.logger.detail(f"Move file to duplicates folder took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
     def process_non_duplicate_image(self, file, tensor_pil, hash_pil, tensor_cv2, hash_cv2):
         function_name = 'process_non_duplicate_image'
-        
+
+        if self.stage_done('metadata'):
+            self.media_object_id = self.checkpoint['data']['media_object_id']
+            self.new_file_name = self.checkpoint['data']['new_file_name']
+        else:
+            self.store_media_object(file, self.image_folder, self.util.get_image_metadata_from_file, self.util.get_file_create_date_for_image, self.original_file_type,
+                                    lambda metadata: self.util.get_file_location_from_metadata(metadata, user_agent="image_locator"),
+                                    dimensions=(self.decoded.width, self.decoded.height) if self.decoded is not None else None)
+
+        # Move the file to the image directory
+        updated_file = os.path.join(self.image_folder, self.new_file_name)
+        if not self.stage_done('moved'):
+            step_start_time = time.time()
+            move_file_result = self.move_file(file, updated_file)
+            self.logger.detail(f"Move file to image directory took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            if move_file_result != 'Success':
+                self.logger.error(f"Failed to move file {self.new_file_name} to {updated_file}: {move_file_result}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                raise RuntimeError(f"Failed to move file {self.new_file_name} to {updated_file}: {move_file_result}")
+            self.save_checkpoint('moved', updated_file=updated_file)
+
+        # Look for names in the image and update the known_names, invalid_name, tags, and other name tables
+        if not self.stage_done('faces'):
+            step_start_time = time.time()
+            # A resumed file has no decoded image; the labeler then decodes the moved file itself
+            # A fast-mode image never decoded in full, and its file has moved, so the labeler reads the moved file
+            image = self.decoded.array if self.decoded is not None and self.decoded.loaded else None
+            identified_names = self.face_labeler.label_faces_in_image(updated_file, self.media_object_id, image)
+            if self.decoded is not None:
+                self.decoded.release()
+            for name in identified_names:
+                self.logger.detail(f'The name: {name} was found in the image: {updated_file}', extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            if self.stage_done('moved'):
+                self.save_checkpoint('faces')
+            self.logger.detail(f"Look for names in the image and update tables took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+        # Insert the tensor into the tensor table
+        step_start_time = time.time()
+        tensor_id = self.util.insert_image_tensor(updated_file, tensor_pil, hash_pil, tensor_cv2, hash_cv2, self.media_object_id)
+        self.phash_index.insert(tensor_id, tensor_pil)
+        if self.content_hash is not None:
+            self.content_hashes.record(self.content_hash, self.media_object_id, updated_file)
+        self.logger.detail(f"Insert the tensor into the tensor table took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+    def store_media_object(self, file, folder, get_metadata, get_create_date, media_type, get_location, dimensions=None):
+        '''The inserted and metadata stages: the tbl_media_objects row, its new name, location and metadata.'''
+        function_name = 'store_media_object'
+
         # Generate the metadata
         step_start_time = time.time()
-        metadata = self.util.get_image_metadata_from_file(file)
+        metadata = get_metadata(self.readable_file(file))
         self.logger.detail(f"Generate metadata took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
         # Get the original file details
         step_start_time = time.time()
-        self.file_create_date = self.util.get_file_create_date_for_image(file, metadata)
+        self.file_create_date = get_create_date(file, metadata)
         self.logger.detail(f"Get file create date took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
         # Get location data details from metadata
@@ -151,18 +335,19 @@ class FileProcessor:
             self.location_city, 
             self.location_province, 
             self.location_country
-        ) = self.util.get_file_location_from_metadata(
-            metadata, 
-            user_agent="image_locator"
-        )
+        ) = get_location(metadata)
         self.logger.detail(f"Get location data details took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
-        # Create initial tbl_media_object entry
-        step_start_time = time.time()
-        self.media_object_id = self.util.file_insert(self.original_file_name, self.original_file_type)
-        
-        self.logger.debug(f"Initial insert of {self.original_file_name} into the database.", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-        self.logger.detail(f"Create initial tbl_media_object entry took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        # Create initial tbl_media_object entry, unless an earlier attempt already did
+        if self.stage_done('inserted'):
+            self.media_object_id = self.checkpoint['data']['media_object_id']
+        else:
+            step_start_time = time.time()
+            self.media_object_id = self.util.file_insert(self.original_file_name, media_type)
+            if self.media_object_id is not None:
+                self.save_checkpoint('inserted', media_object_id=self.media_object_id)
+            self.logger.debug(f"Initial insert of {self.original_file_name} into the database.", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            self.logger.detail(f"Create initial tbl_media_object entry took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
         # Calculate the new name
         step_start_time = time.time()
@@ -177,7 +362,7 @@ class FileProcessor:
         step_start_time = time.time()
         self.util.file_update(
             self.new_file_name,
-            self.image_folder, 
+            folder, 
             self.file_create_date, 
             self.latitude, 
             self.longitude, 
@@ -192,28 +377,13 @@ class FileProcessor:
         )
         self.logger.detail(f"Update the database took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
+        if dimensions is not None:
+            self.util.update_dimensions(*dimensions, self.media_object_id)
+
         flattened_metadata = self.util.flatten_dict(metadata)
         self.util.insert_metadata(flattened_metadata, self.media_object_id)
-
-        # Move the file to the image directory
-        step_start_time = time.time()
-        updated_file = os.path.join(self.image_folder, self.new_file_name)
-        move_file_result = self.util.move_file(file, updated_file)
-        self.logger.detail(f"Move file to image directory took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-        if move_file_result != 'Success':
-            self.logger.error(f"Failed to move file {self.new_file_name} to {updated_file}: {move_file_result}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        # Look for names in the image and update the known_names, invalid_name, tags, and other name tables
-        step_start_time = time.time()
-        identified_names = self.face_labeler.label_faces_in_image(updated_file, self.media_object_id)
-        for name in identified_names:
-            self.logger.detail(f'The name: {name} was found in the image: {updated_file}', extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-        self.logger.detail(f"Look for names in the image and update tables took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        # Insert the tensor into the tensor table
-        step_start_time = time.time()
-        self.util.insert_image_tensor(updated_file, tensor_pil, hash_pil, tensor_cv2, hash_cv2, self.media_object_id)
-        self.logger.detail(f"Insert the tensor into the tensor table took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        if self.media_object_id is not None:
+            self.save_checkpoint('metadata', new_file_name=self.new_file_name)
 
     def process_movie(self):
         function_name = 'process_movie'
@@ -222,108 +392,59 @@ class FileProcessor:
         self.logger.info(f"Processing movie file {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
         # Step 1: Generate hash
-        step_start_time = time.time()
-        results = self.util.generate_movie_hash(self.file_to_process)
-        self.logger.detail(f"Step 1: Generate movie hash took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        if isinstance(results, tuple):
+        if self.stage_done('hashed'):
+            file, movie_hash = self.checkpoint['data']['file'], self.checkpoint['data']['movie_hash']
+            self.restore_original_details()
+        else:
+            step_start_time = time.time()
+            results = self.util.generate_movie_hash(self.file_to_process)
+            self.logger.detail(f"Step 1: Generate movie hash took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            if not isinstance(results, tuple):
+                self.logger.error(f"Failed to generate movie hash for {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                raise RuntimeError(f"Failed to generate movie hash for {self.file_to_process}")
             file, movie_hash = results
+            self.save_original_details('hashed', file, movie_hash=movie_hash)
 
-            self.original_file_name = os.path.basename(self.file_to_process)  # Store the original filename
-            self.original_file_extension = Path(self.file_to_process).suffix[1:] # Store the original file extension
-            self.original_file_type = self.file_type_to_process # Store the original file type                  
-
-            # Step 2: Fetch potential duplicates using PIL and cv2 hashes
+        # Step 2: Fetch potential duplicates using the movie hash
+        if self.stage_done('deduped'):
+            movie_duplicates = self.checkpoint['data']['duplicates']
+        else:
             step_start_time = time.time()
             movie_duplicates = self.util.fetch_potential_movie_duplicates(movie_hash)
+            self.save_checkpoint('deduped', duplicates=movie_duplicates)
             self.logger.detail(f"Step 2: Fetch potential duplicates took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
-            # Step 3: If duplicate, rename and move to duplicate folder
-            if movie_duplicates:
-                self.handle_duplicate(file, movie_duplicates)
-            else:
-                self.logger.debug(f"No duplicate found for {file}...processing...", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-                # Step 4: Process the non-duplicate movie
-                self.process_non_duplicate_movie(file, movie_hash)
+        # Step 3: If duplicate, rename and move to duplicate folder
+        if movie_duplicates:
+            self.handle_duplicate(file, movie_duplicates)
         else:
-            self.logger.error(f"Failed to generate movie hash for {self.file_to_process}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            self.logger.debug(f"No duplicate found for {file}...processing...", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+            # Step 4: Process the non-duplicate movie
+            self.process_non_duplicate_movie(file, movie_hash)
 
         self.logger.detail(f"Total duration of process_movie: {time.time() - start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
     def process_non_duplicate_movie(self, file, movie_hash):
         function_name = 'process_non_duplicate_movie'
 
-        # Generate metadata
-        step_start_time = time.time()
-        metadata = self.util.get_movie_metadata_from_file(file)
-        self.logger.detail(f"Step 1: Generate metadata took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        # Get the original file details
-        step_start_time = time.time()
-        self.file_create_date = self.util.get_file_create_date_for_movie(file, metadata)
-        self.logger.detail(f"Step 2: Get file create date took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        # Get location data details from metadata
-        step_start_time = time.time()
-        (
-            self.latitude,
-            self.longitude, 
-            self.location_class, 
-            self.location_type, 
-            self.location_name, 
-            self.location_display_name, 
-            self.location_city, 
-            self.location_province, 
-            self.location_country
-        ) = self.util.get_file_location_from_movie_metadata(metadata)
-        self.logger.detail(f"Step 3: Get location data details took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        # Create initial tbl_media_object entry
-        step_start_time = time.time()
-        self.media_object_id = self.util.file_insert(self.original_file_name, self.file_type_to_process)
-        
-        self.logger.debug(f"Initial insert of {self.original_file_name} into the database.", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-        self.logger.detail(f"Step 4: Create initial tbl_media_object entry took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        # Calculate the new name
-        step_start_time = time.time()
-        file_extension = os.path.splitext(file)[1]
-        self.new_file_name = self.util.get_new_file_name(self.file_create_date, self.media_object_id)
-        self.logger.detail(f"Step 5: Calculate the new name took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        self.new_file_name += file_extension
-        self.new_file_name = os.path.basename(self.new_file_name)  # Use the filename after conversion (if converted)
-        
-        # Update the database
-        step_start_time = time.time()
-        self.util.file_update(
-            self.new_file_name,
-            self.movies_folder, 
-            self.file_create_date, 
-            self.latitude, 
-            self.longitude, 
-            self.location_class, 
-            self.location_type, 
-            self.location_name, 
-            self.location_display_name, 
-            self.location_city, 
-            self.location_province, 
-            self.location_country, 
-            self.media_object_id
-        )
-        self.logger.detail(f"Step 6: Update the database took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-        flattened_metadata = self.util.flatten_dict(metadata)
-        self.util.insert_metadata(flattened_metadata, self.media_object_id)
+        if self.stage_done('metadata'):
+            self.media_object_id = self.checkpoint['data']['media_object_id']
+            self.new_file_name = self.checkpoint['data']['new_file_name']
+        else:
+            self.store_media_object(file, self.movies_folder, self.util.get_movie_metadata_from_file, self.util.get_file_create_date_for_movie, self.file_type_to_process,
+                                    self.util.get_file_location_from_movie_metadata)
 
         # Move the file to the movies directory
-        step_start_time = time.time()
         updated_file = os.path.join(self.movies_folder, self.new_file_name)
-        move_file_result = self.util.move_file(self.file_to_process, updated_file)
-        self.logger.detail(f"Move file to movies directory took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-        if move_file_result != 'Success':
-            self.logger.error(f"Failed to move file {self.new_file_name} to {updated_file}: {move_file_result}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        if not self.stage_done('moved'):
+            step_start_time = time.time()
+            move_file_result = self.move_file(file, updated_file)
+            self.logger.detail(f"Move file to movies directory took {time.time() - step_start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            if move_file_result != 'Success':
+                self.logger.error(f"Failed to move file {self.new_file_name} to {updated_file}: {move_file_result}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                raise RuntimeError(f"Failed to move file {self.new_file_name} to {updated_file}: {move_file_result}")
+            self.save_checkpoint('moved', updated_file=updated_file)
 
         # Insert the movie hash into the hash table
         step_start_time = time.time()
@@ -0,0 +1,107 @@
+'''
+An inotify based watcher for the cleo2 inbox, with a periodic full rescan as a fallback.
+2024 Christopher Orr
+'''
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from logger_config import get_logger
+
+IN_CLOSE_WRITE = 0x00000008  # File opened for writing was closed
+IN_MOVED_TO = 0x00000080  # File moved into the watched directory
+IN_Q_OVERFLOW = 0x00004000  # Event queue overflowed, events were lost
+IN_IGNORED = 0x00008000  # Watch was removed (directory deleted or unmounted)
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class FileWatcher:
+    '''
+    Reports files that finish arriving in a directory.  inotify is used when the C library provides it;
+    otherwise, and every rescan_interval seconds regardless (inotify does not see writes made by other
+    hosts on a network share), rescan_due() tells the caller to fall back to a full directory listing.
+    '''
+    def __init__(self, directory, rescan_interval=300, fallback_interval=5):
+        self.logger = get_logger(self.__class__.__name__)
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+        self.fallback_interval = fallback_interval
+        self.fd = None
+        self.last_rescan = None
+        self.force_rescan = True
+        self.start()
+
+    def start(self):
+        function_name = 'start'
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                error = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(error, os.strerror(error))
+            self.fd = fd
+            self.logger.info(f"Watching {self.directory} with inotify", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        except (OSError, AttributeError) as e:
+            self.fd = None
+            self.logger.warning(f"inotify unavailable for {self.directory}, falling back to rescans: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+    def stop(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def rescan_due(self):
+        interval = self.rescan_interval if self.fd is not None else self.fallback_interval
+        return self.force_rescan or self.last_rescan is None or time.time() - self.last_rescan >= interval
+
+    def mark_rescanned(self):
+        self.force_rescan = False
+        self.last_rescan = time.time()
+
+    def read_events(self, timeout=0):
+        '''Return the paths of files that were closed after writing or moved into the directory.'''
+        function_name = 'read_events'
+        if self.fd is None:
+            return []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        paths = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    self.logger.warning("inotify queue overflowed, scheduling a full rescan", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                    self.force_rescan = True
+                elif mask & IN_IGNORED:
+                    self.logger.warning(f"inotify watch on {self.directory} was removed, falling back to rescans", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                    self.stop()
+                    self.force_rescan = True
+                    return paths
+                elif name:
+                    paths.append(os.path.join(self.directory, os.fsdecode(name)))
+        return paths
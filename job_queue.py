@@ -0,0 +1,305 @@
+'''
+Work queues shared between the controller and its persistent workers in the cleo2 project.
+2024 Christopher Orr
+'''
+
+import time
+import queue
+import threading
+from multiprocessing.managers import BaseManager
+from psycopg2.extras import execute_values
+from dbconnection import DBConnection
+from logger_config import get_logger
+
+
+class _ServerQueueManager(BaseManager):
+    pass
+
+
+class _ClientQueueManager(BaseManager):
+    pass
+
+
+_ClientQueueManager.register('get_job_queue')
+_ClientQueueManager.register('get_result_queue')
+
+
+class JobQueueServer:
+    '''
+    Serves a job queue and a result queue over TCP from inside the controller process.
+    The controller uses the local queues directly; workers connect with JobQueueClient.
+    '''
+    def __init__(self, address, authkey):
+        self.logger = get_logger(self.__class__.__name__)
+        self.address = address
+        self.authkey = authkey
+        self.job_queue = queue.Queue()
+        self.result_queue = queue.Queue()
+        self.server = None
+
+    def start(self):
+        function_name = 'start'
+        _ServerQueueManager.register('get_job_queue', callable=lambda: self.job_queue)
+        _ServerQueueManager.register('get_result_queue', callable=lambda: self.result_queue)
+        manager = _ServerQueueManager(address=self.address, authkey=self.authkey)
+        self.server = manager.get_server()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info(f"Job queue server listening on {self.address}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop_event.set()
+            self.server = None
+
+
+class JobQueueClient:
+    '''
+    Connects a worker to the queues served by the controller's JobQueueServer.
+    '''
+    def __init__(self, address, authkey):
+        manager = _ClientQueueManager(address=address, authkey=authkey)
+        manager.connect()
+        self.job_queue = manager.get_job_queue()
+        self.result_queue = manager.get_result_queue()
+
+    def get_job(self, worker_id):
+        return self.job_queue.get()
+
+    def report(self, event, worker_id, file_path, success=None):
+        self.result_queue.put((event, worker_id, file_path, success))
+
+
+class IngestJobQueue:
+    '''
+    A durable job queue stored in tbl_ingest_jobs.  Any number of controllers can enqueue files and any
+    number of workers, on any host sharing /mnt/MOM, can lease jobs with SELECT ... FOR UPDATE SKIP LOCKED.
+    A lease that is not completed or renewed before it expires is handed out again, up to max_attempts times.
+    '''
+    def __init__(self, lease_seconds=1800, max_attempts=3, poll_interval=5, max_wait=900, lane=None):
+        self.logger = get_logger(self.__class__.__name__)
+        self.db_conn_instance = DBConnection.get_instance()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.lane = lane  # Lane a worker serves first before helping the others
+        self.current_job_id = None
+        self.heartbeat_stop = None
+
+    def create_table(self):
+        function_name = 'create_table'
+        query = """
+        CREATE TABLE IF NOT EXISTS tbl_ingest_jobs (
+            job_id BIGSERIAL PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_size BIGINT,
+            lane TEXT NOT NULL DEFAULT 'image',
+            state TEXT NOT NULL DEFAULT 'queued',
+            lease_owner TEXT,
+            lease_expires_at TIMESTAMPTZ,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_ingest_jobs_active_path
+            ON tbl_ingest_jobs (file_path) WHERE state IN ('queued', 'leased');
+        ALTER TABLE tbl_ingest_jobs ADD COLUMN IF NOT EXISTS lane TEXT NOT NULL DEFAULT 'image';
+        CREATE INDEX IF NOT EXISTS idx_ingest_jobs_claim
+            ON tbl_ingest_jobs (state, lane, file_size, job_id);
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error creating tbl_ingest_jobs: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            raise
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def enqueue(self, files):
+        '''Queue (file_path, file_type, file_size, lane) tuples, ignoring files that already have an active job.'''
+        function_name = 'enqueue'
+        if not files:
+            return 0
+        query = """
+        INSERT INTO tbl_ingest_jobs (file_path, file_type, file_size, lane)
+        VALUES %s
+        ON CONFLICT (file_path) WHERE state IN ('queued', 'leased') DO NOTHING
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                execute_values(cursor, query, files, page_size=len(files))
+                inserted = cursor.rowcount
+            conn.commit()
+            self.logger.debug(f"Enqueued {inserted} of {len(files)} files", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return inserted
+        except Exception as e:
+            self.logger.error(f"Error enqueuing files: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return 0
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def claim(self, worker_id, lane=None):
+        '''Lease a single job for worker_id. Returns (job_id, file_path, file_type) or None.'''
+        jobs = self.claim_batch(worker_id, lane, 1)
+        return jobs[0] if jobs else None
+
+    def claim_batch(self, worker_id, lane=None, limit=1):
+        '''
+        Lease up to limit of the smallest available jobs, optionally from one lane, for worker_id.  Jobs
+        waiting longer than max_wait go first so large files are not starved.  Returns a list of
+        (job_id, file_path, file_type).
+        '''
+        function_name = 'claim_batch'
+        query = """
+        UPDATE tbl_ingest_jobs
+        SET state = 'leased', lease_owner = %s, lease_expires_at = now() + %s * interval '1 second',
+            attempts = attempts + 1, updated_at = now()
+        WHERE job_id IN (
+            SELECT job_id FROM tbl_ingest_jobs
+            WHERE (state = 'queued' OR (state = 'leased' AND lease_expires_at < now()))
+            AND attempts < %s
+            AND (%s::text IS NULL OR lane = %s)
+            ORDER BY created_at < now() - %s * interval '1 second' DESC, file_size NULLS LAST, job_id
+            FOR UPDATE SKIP LOCKED
+            LIMIT %s
+        )
+        RETURNING job_id, file_path, file_type, file_size
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (worker_id, self.lease_seconds, self.max_attempts, lane, lane, self.max_wait, limit))
+                rows = cursor.fetchall()
+            conn.commit()
+            # RETURNING does not keep the subquery's order, so restore smallest first
+            rows.sort(key=lambda row: (row[3] is None, row[3] or 0, row[0]))
+            return [(job_id, file_path, file_type) for job_id, file_path, file_type, _ in rows]
+        except Exception as e:
+            self.logger.error(f"Error claiming jobs for {worker_id}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return []
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def renew(self, job_id):
+        function_name = 'renew'
+        query = """
+        UPDATE tbl_ingest_jobs
+        SET lease_expires_at = now() + %s * interval '1 second', updated_at = now()
+        WHERE job_id = %s AND state = 'leased'
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (self.lease_seconds, job_id))
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error renewing lease for job {job_id}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def complete(self, job_id, success, error=None):
+        function_name = 'complete'
+        query = """
+        UPDATE tbl_ingest_jobs
+        SET state = %s, last_error = %s, lease_owner = NULL, lease_expires_at = NULL, updated_at = now()
+        WHERE job_id = %s
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, ('done' if success else 'failed', error, job_id))
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error completing job {job_id}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def release(self, job_id):
+        '''Put a leased job back in the queue, e.g. when its batch died before reaching it.  The file was never
+        attempted, so the lease's attempt is given back; otherwise a job released on its last attempt could never
+        be leased again.'''
+        function_name = 'release'
+        query = """
+        UPDATE tbl_ingest_jobs
+        SET state = 'queued', attempts = GREATEST(attempts - 1, 0), lease_owner = NULL, lease_expires_at = NULL, updated_at = now()
+        WHERE job_id = %s AND state = 'leased'
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (job_id,))
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error releasing job {job_id}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def fail_exhausted(self):
+        '''Mark expired leases that have used up their attempts as failed and return their file paths.'''
+        function_name = 'fail_exhausted'
+        query = """
+        UPDATE tbl_ingest_jobs
+        SET state = 'failed', last_error = 'Lease expired after maximum attempts', updated_at = now()
+        WHERE state = 'leased' AND lease_expires_at < now() AND attempts >= %s
+        RETURNING file_path
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, (self.max_attempts,))
+                rows = cursor.fetchall()
+            conn.commit()
+            return [row[0] for row in rows]
+        except Exception as e:
+            self.logger.error(f"Error failing exhausted jobs: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return []
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    # The two methods below give IngestJobQueue the same interface as JobQueueClient so a Worker
+    # can pull straight from the database instead of from a controller.
+
+    def get_job(self, worker_id):
+        while True:
+            job = self.claim(worker_id, self.lane) if self.lane is not None else None
+            if job is None:
+                job = self.claim(worker_id)
+            if job is not None:
+                job_id, file_path, file_type = job
+                self.current_job_id = job_id
+                self.start_heartbeat(job_id)
+                return file_path, file_type
+            time.sleep(self.poll_interval)
+
+    def report(self, event, worker_id, file_path, success=None):
+        if event == 'finished' and self.current_job_id is not None:
+            self.stop_heartbeat()
+            self.complete(self.current_job_id, success)
+            self.current_job_id = None
+
+    def start_heartbeat(self, job_id):
+        self.heartbeat_stop = threading.Event()
+
+        def heartbeat(stop):
+            while not stop.wait(self.lease_seconds / 3):
+                self.renew(job_id)
+
+        threading.Thread(target=heartbeat, args=(self.heartbeat_stop,), daemon=True).start()
+
+    def stop_heartbeat(self):
+        if self.heartbeat_stop is not None:
+            self.heartbeat_stop.set()
+            self.heartbeat_stop = None
@@ -0,0 +1,185 @@
+'''
+A Bloom filter of the tensor hashes in tbl_image_tensors, so a worker can skip the duplicate query for files that
+certainly have no exact match.
+2024 Christopher Orr
+'''
+
+import os
+import math
+import time
+import hashlib
+import numpy as np
+from dbconnection import DBConnection
+from logger_config import get_logger
+from tensor_store import TENSOR_STORE_DIRECTORY
+
+KNOWN_HASHES_PATH = os.getenv('KNOWN_HASHES_PATH', os.path.join(TENSOR_STORE_DIRECTORY, 'known_hashes.npz'))
+BLOOM_ERROR_RATE = float(os.getenv('BLOOM_ERROR_RATE', 0.001))
+BLOOM_REFRESH_SECONDS = float(os.getenv('BLOOM_REFRESH_SECONDS', 10))  # How stale the filter may get before catching up
+MIN_CAPACITY = 1000000
+REFRESH_OVERLAP = 1000  # Ids are allocated before commit, so recent ones are read again in case they committed late
+
+
+class BloomFilter:
+    '''
+    A bit array with k positions per item.  Every item added is reported as present; an item never added is
+    reported as present with probability about error_rate, as long as no more than capacity items are added.
+    count only counts items that set a new bit, so adding an item again, as a refresh does with the ids it reads
+    twice, leaves it unchanged.
+    '''
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE, bits=None, hash_count=None, count=0):
+        self.capacity = capacity
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)) if bits is None else len(bits) * 8
+        self.hash_count = hash_count or max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bits if bits is not None else np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = count
+
+    def positions(self, item):
+        # Double hashing: k positions from two independent 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.size for index in range(self.hash_count)]
+
+    def add(self, item):
+        added = False
+        for position in self.positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                self.bits[position >> 3] |= 1 << (position & 7)
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    def false_positive_rate(self):
+        '''The expected rate for the items added so far.'''
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class KnownHashes:
+    '''
+    The hash_pil and hash_cv2 values of every stored tensor, in a Bloom filter.  It is loaded once per worker
+    from a snapshot file, or built from the database if there is none, and kept current: this worker's own
+    inserts are added immediately, and other workers' are read (id > the last id seen) at most every
+    BLOOM_REFRESH_SECONDS.  A file inserted by another worker within that window may be missed as an exact
+    duplicate, much as two workers processing copies of the same photo at once already miss each other.
+    '''
+    def __init__(self, path=KNOWN_HASHES_PATH):
+        self.logger = get_logger(self.__class__.__name__)
+        self.db_conn_instance = DBConnection.get_instance()
+        self.path = path
+        self.filter = None
+        self.last_id = 0
+        self.refreshed_at = 0
+        self.checks = 0
+        self.skipped = 0
+
+    def load(self):
+        function_name = 'load'
+        if self.path and os.path.exists(self.path):
+            try:
+                with np.load(self.path) as data:
+                    capacity, hash_count, count, self.last_id = (int(value) for value in data['meta'])
+                    self.filter = BloomFilter(capacity, bits=data['bits'].copy(), hash_count=hash_count, count=count)
+                snapshot = self.filter
+                self.refresh(force=True)  # Rebuilds the filter if the snapshot is over capacity
+                if self.filter is snapshot:
+                    self.log_summary('Loaded')
+                return
+            except Exception as e:
+                self.logger.error(f"Error loading the known-hash snapshot {self.path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        self.build()
+
+    def build(self):
+        '''Build the filter from tbl_image_tensors and save it as the snapshot other workers load.'''
+        function_name = 'build'
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT count(*), coalesce(max(id), 0) FROM tbl_image_tensors")
+                rows, last_id = cursor.fetchone()
+                self.filter = BloomFilter(max(MIN_CAPACITY, 4 * rows))  # Two hashes per row, with room to grow
+                self.last_id = 0
+                self.add_rows(cursor, 0)
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error building the known-hash filter: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            self.filter = None
+            return
+        finally:
+            self.db_conn_instance.return_connection(conn)
+        self.refreshed_at = time.time()
+        self.save()
+        self.log_summary('Built')
+
+    def add_rows(self, cursor, after_id):
+        cursor.execute("SELECT id, hash_pil, hash_cv2 FROM tbl_image_tensors WHERE id > %s", (after_id,))
+        for tensor_id, hash_pil, hash_cv2 in cursor:
+            self.add(hash_pil, hash_cv2)
+            self.last_id = max(self.last_id, tensor_id)
+
+    def save(self):
+        function_name = 'save'
+        if not self.path or self.filter is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + '.part.npz'
+            meta = np.array([self.filter.capacity, self.filter.hash_count, self.filter.count, self.last_id], dtype=np.int64)
+            np.savez(temp_path, bits=self.filter.bits, meta=meta)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            self.logger.error(f"Error saving the known-hash snapshot {self.path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+    def refresh(self, force=False):
+        '''Add the hashes other workers inserted since the last refresh, and rebuild the filter once it is full.'''
+        function_name = 'refresh'
+        if self.filter is None or (not force and time.time() - self.refreshed_at < BLOOM_REFRESH_SECONDS):
+            return
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                self.add_rows(cursor, max(0, self.last_id - REFRESH_OVERLAP))
+            conn.commit()
+            self.refreshed_at = time.time()
+        except Exception as e:
+            self.logger.error(f"Error refreshing the known-hash filter: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+        if self.filter.count > self.filter.capacity:
+            # Past capacity the false positive rate climbs, so the filter would skip fewer and fewer queries
+            self.logger.info(f"The known-hash filter is over capacity ({self.filter.count} > {self.filter.capacity}); rebuilding it", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            self.build()
+
+    def add(self, *hashes):
+        if self.filter is None:
+            return
+        for value in hashes:
+            if value:
+                self.filter.add(value)
+
+    def definitely_absent(self, *hashes):
+        '''True only if none of the hashes can be in tbl_image_tensors; False if any might be, or if unsure.'''
+        if self.filter is None:
+            self.load()
+            if self.filter is None:
+                return False
+        self.refresh()
+        if self.filter is None:  # A rebuild failed
+            return False
+        self.checks += 1
+        if any(value and value in self.filter for value in hashes):
+            return False
+        self.skipped += 1
+        return True
+
+    def log_summary(self, action):
+        function_name = 'log_summary'
+        self.logger.info(
+            f"{action} the known-hash filter: {self.filter.count} hashes in {self.filter.bits.nbytes / 1024 / 1024:.1f} MB, "
+            f"{self.filter.hash_count} hash functions, expected false positive rate {self.filter.false_positive_rate():.5f}",
+            extra={'class_name': self.__class__.__name__, 'function_name': function_name}
+        )
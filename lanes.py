@@ -0,0 +1,154 @@
+'''
+Per-type scheduling lanes for the cleo2 controller.
+2024 Christopher Orr
+'''
+
+import os
+import time
+import heapq
+from collections import deque
+
+CONVERSION_EXTENSIONS = {'heic', 'heif', 'pcd'}  # Images that are converted before processing
+
+
+def parse_lane_setting(value):
+    '''Parse "image=0.6,conversion=0.2,movie=0.2" into a dict of floats.'''
+    result = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, number = item.split('=', 1)
+            result[name.strip()] = float(number)
+    return result
+
+
+LANE_SHARES = parse_lane_setting(os.getenv('LANE_SHARES', 'image=0.6,conversion=0.2,movie=0.2'))  # Guaranteed share of the slots
+LANE_CAPS = parse_lane_setting(os.getenv('LANE_CAPS', 'image=1.0,conversion=1.0,movie=0.5'))  # Most a lane may take by borrowing
+LANE_MAX_WAIT = int(os.getenv('LANE_MAX_WAIT', 900))  # Seconds before a large file jumps ahead of smaller ones
+
+
+def classify(file_path, file_type):
+    if file_type == 'movie':
+        return 'movie'
+    if file_path.rsplit('.', 1)[-1].lower() in CONVERSION_EXTENSIONS:
+        return 'conversion'
+    return 'image'
+
+
+class Lane:
+    '''
+    Shortest-job-first queue by file size.  Files waiting longer than max_wait go ahead of the rest, smallest
+    first as in the tbl_ingest_jobs backend, so big files never starve and a backlog that has all aged is still
+    served smallest first.
+    '''
+    def __init__(self, name, max_wait):
+        self.name = name
+        self.max_wait = max_wait
+        self.heap = []  # (size, seq, file_info) of every queued file
+        self.aged = []  # (size, seq, file_info) of the files waiting longer than max_wait
+        self.arrivals = deque()  # (enqueued_at, size, seq, file_info) in arrival order, until aged
+        self.taken = set()  # seqs popped from heap before they aged
+        self.promoted = set()  # seqs moved to aged but still in heap
+        self.queued = 0
+        self.running = 0
+
+    def __len__(self):
+        return self.queued
+
+    def push(self, seq, file_info, size):
+        size = size if size is not None else 0
+        heapq.heappush(self.heap, (size, seq, file_info))
+        self.arrivals.append((time.time(), size, seq, file_info))
+        self.queued += 1
+
+    def age(self):
+        '''Move the files that have waited longer than max_wait to the aged heap.'''
+        cutoff = time.time() - self.max_wait
+        while self.arrivals and self.arrivals[0][0] < cutoff:
+            _, size, seq, file_info = self.arrivals.popleft()
+            if seq in self.taken:
+                self.taken.discard(seq)
+            else:
+                heapq.heappush(self.aged, (size, seq, file_info))
+                self.promoted.add(seq)
+
+    def pop(self):
+        self.age()
+        if self.aged:
+            _, seq, file_info = heapq.heappop(self.aged)
+            self.queued -= 1
+            return file_info
+        while self.heap:
+            _, seq, file_info = heapq.heappop(self.heap)
+            if seq in self.promoted:
+                self.promoted.discard(seq)
+                continue
+            self.taken.add(seq)
+            self.queued -= 1
+            return file_info
+        return None
+
+
+class LaneScheduler:
+    '''
+    Holds queued files in image, conversion and movie lanes.  Each lane is guaranteed its share of the
+    slots; when a lane has no work, the others may borrow its slots up to their cap, so a burst of large
+    movies can never take every slot while small JPEGs wait.
+    '''
+    def __init__(self, shares=None, caps=None, max_wait=LANE_MAX_WAIT):
+        self.shares = shares if shares is not None else LANE_SHARES
+        self.caps = caps if caps is not None else LANE_CAPS
+        self.lanes = {name: Lane(name, max_wait) for name in self.shares}
+        self.running_lanes = {}  # first file_path of a running batch -> lane name
+        self.seq = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def push(self, file_path, file_type, size):
+        self.seq += 1
+        self.lanes[classify(file_path, file_type)].push(self.seq, (file_path, file_type), size)
+
+    def budget(self, name, slots):
+        return max(1, int(round(slots * self.shares[name])))
+
+    def cap(self, name, slots):
+        return max(1, int(slots * self.caps.get(name, 1.0)))
+
+    def preferred_lanes(self, slots):
+        '''Lane names in the order they should be served given the total number of slots.'''
+        under_budget = [name for name, lane in self.lanes.items() if lane.running < self.budget(name, slots)]
+        under_budget.sort(key=lambda name: self.lanes[name].running / self.budget(name, slots))
+        borrowers = [name for name, lane in self.lanes.items() if name not in under_budget and lane.running < self.cap(name, slots)]
+        borrowers.sort(key=lambda name: self.lanes[name].running / self.cap(name, slots))
+        return under_budget + borrowers
+
+    def pop_batch(self, slots, count):
+        '''Take up to count files from the lane that should be served next. Returns (lane name, file_infos).'''
+        for name in self.preferred_lanes(slots):
+            batch = []
+            while len(batch) < count:
+                file_info = self.lanes[name].pop()
+                if file_info is None:
+                    break
+                batch.append(file_info)
+            if batch:
+                return name, batch
+        return None, []
+
+    def worker_lane(self, index, slots):
+        '''The lane persistent worker number `index` of `slots` should serve first, following the shares.'''
+        boundary = 0
+        for name in self.lanes:
+            boundary += self.budget(name, slots)
+            if index < boundary:
+                return name
+        return next(iter(self.lanes))
+
+    def start(self, batch_key, name):
+        self.lanes[name].running += 1
+        self.running_lanes[batch_key] = name
+
+    def finish(self, batch_key):
+        name = self.running_lanes.pop(batch_key, None)
+        if name is not None:
+            self.lanes[name].running -= 1
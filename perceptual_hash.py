@@ -0,0 +1,181 @@
+'''
+64-bit perceptual hashes (dHash) and a multi-index hashing table for near-duplicate candidate search in cleo2.
+2024 Christopher Orr
+'''
+
+import os
+from itertools import combinations
+import numpy as np
+from PIL import Image
+from psycopg2.extras import execute_values
+from dbconnection import DBConnection
+from logger_config import get_logger
+
+PHASH_DISTANCE = int(os.getenv('PHASH_DISTANCE', 3))  # Largest Hamming distance between near-duplicate dHashes
+CHUNKS = 4  # The hash is indexed as four 16 bit chunks
+CHUNK_BITS = 64 // CHUNKS
+
+# Used with psycopg2's execute_values
+INSERT_QUERY = """
+INSERT INTO tbl_image_phash (tensor_id, dhash, chunk0, chunk1, chunk2, chunk3, canonical, canonical_chunk0, canonical_chunk1, canonical_chunk2, canonical_chunk3)
+VALUES %s
+ON CONFLICT (tensor_id) DO UPDATE
+SET dhash = EXCLUDED.dhash, chunk0 = EXCLUDED.chunk0, chunk1 = EXCLUDED.chunk1, chunk2 = EXCLUDED.chunk2, chunk3 = EXCLUDED.chunk3,
+    canonical = EXCLUDED.canonical, canonical_chunk0 = EXCLUDED.canonical_chunk0, canonical_chunk1 = EXCLUDED.canonical_chunk1,
+    canonical_chunk2 = EXCLUDED.canonical_chunk2, canonical_chunk3 = EXCLUDED.canonical_chunk3
+"""
+
+
+def dhash(tensor):
+    '''
+    The 64-bit difference hash of an RGB tensor: shrink the greyscale image to 9x8 and set a bit for every pixel
+    brighter than its right-hand neighbour.  Re-encoding or resizing an image changes every byte of its tensor,
+    and so its MD5 hash, but only a bit or two of its dHash; a crop of a few percent moves it by around 8.
+    '''
+    grey = Image.fromarray(np.asarray(tensor, dtype=np.uint8)).convert('L').resize((9, 8), Image.BICUBIC)
+    pixels = np.asarray(grey, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).reshape(-1)
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def canonical_dhash(tensor):
+    '''
+    The smallest dHash of the tensor's four 90 degree rotations, so a copy that was rotated, by a phone or by
+    EXIF orientation handling, has (nearly) the same canonical hash.  Mirrored copies are not included, since
+    the MSE check only tries rotations.
+    '''
+    return min(dhash(np.rot90(tensor, k)) for k in range(4))
+
+
+def hamming_distance(hash_A, hash_B):
+    return bin(hash_A ^ hash_B).count('1')
+
+
+def to_signed(value):
+    '''A 64-bit unsigned hash as the signed value a PostgreSQL BIGINT can hold.'''
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def split_chunks(value):
+    return [(value >> (CHUNK_BITS * index)) & ((1 << CHUNK_BITS) - 1) for index in range(CHUNKS)]
+
+
+def chunk_neighbours(chunk, radius):
+    '''Every chunk value within Hamming distance radius of chunk.'''
+    values = [chunk]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            flipped = chunk
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+class PerceptualHashIndex:
+    '''
+    Stores each image's dHash and canonical (rotation-invariant) dHash in tbl_image_phash, each with its four
+    16 bit chunks in indexed columns.  Two hashes within Hamming distance k differ by at most k // 4 bits in at
+    least one chunk (pigeonhole), so a search looks up the chunk values within that radius of both hashes
+    through the indexes, in one query, and checks the full distance of the few rows that come back.  With the
+    default k of 3 that is eight exact B-tree lookups.
+    '''
+    def __init__(self, max_distance=PHASH_DISTANCE):
+        self.logger = get_logger(self.__class__.__name__)
+        self.db_conn_instance = DBConnection.get_instance()
+        self.max_distance = max_distance
+
+    def create_table(self):
+        function_name = 'create_table'
+        query = """
+        CREATE TABLE IF NOT EXISTS tbl_image_phash (
+            tensor_id INTEGER PRIMARY KEY,
+            dhash BIGINT NOT NULL,
+            chunk0 INTEGER NOT NULL,
+            chunk1 INTEGER NOT NULL,
+            chunk2 INTEGER NOT NULL,
+            chunk3 INTEGER NOT NULL
+        );
+        -- Tables created before canonical hashes were recorded get the columns here
+        ALTER TABLE tbl_image_phash
+            ADD COLUMN IF NOT EXISTS canonical BIGINT,
+            ADD COLUMN IF NOT EXISTS canonical_chunk0 INTEGER,
+            ADD COLUMN IF NOT EXISTS canonical_chunk1 INTEGER,
+            ADD COLUMN IF NOT EXISTS canonical_chunk2 INTEGER,
+            ADD COLUMN IF NOT EXISTS canonical_chunk3 INTEGER;
+        CREATE INDEX IF NOT EXISTS idx_image_phash_chunk0 ON tbl_image_phash (chunk0);
+        CREATE INDEX IF NOT EXISTS idx_image_phash_chunk1 ON tbl_image_phash (chunk1);
+        CREATE INDEX IF NOT EXISTS idx_image_phash_chunk2 ON tbl_image_phash (chunk2);
+        CREATE INDEX IF NOT EXISTS idx_image_phash_chunk3 ON tbl_image_phash (chunk3);
+        CREATE INDEX IF NOT EXISTS idx_image_phash_canonical_chunk0 ON tbl_image_phash (canonical_chunk0);
+        CREATE INDEX IF NOT EXISTS idx_image_phash_canonical_chunk1 ON tbl_image_phash (canonical_chunk1);
+        CREATE INDEX IF NOT EXISTS idx_image_phash_canonical_chunk2 ON tbl_image_phash (canonical_chunk2);
+        CREATE INDEX IF NOT EXISTS idx_image_phash_canonical_chunk3 ON tbl_image_phash (canonical_chunk3);
+        """
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error creating tbl_image_phash: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            raise
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def row(self, tensor_id, tensor):
+        '''The tbl_image_phash values for a tensor, in INSERT_QUERY's column order.'''
+        value = dhash(tensor)
+        canonical = canonical_dhash(tensor)
+        return (tensor_id, to_signed(value), *split_chunks(value), to_signed(canonical), *split_chunks(canonical))
+
+    def insert(self, tensor_id, tensor):
+        function_name = 'insert'
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                execute_values(cursor, INSERT_QUERY, [self.row(tensor_id, tensor)])
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error storing the perceptual hash of tensor {tensor_id}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
+    def search(self, tensor, max_distance=None):
+        '''
+        (tensor_id, distance) of every stored image within max_distance of the tensor, nearest first.  The
+        distance is the smaller of the dHash and canonical dHash distances, so rotated copies are found too.
+        '''
+        function_name = 'search'
+        max_distance = self.max_distance if max_distance is None else max_distance
+        radius = max_distance // CHUNKS
+        value = dhash(tensor)
+        canonical = canonical_dhash(tensor)
+        conditions = ' OR '.join(f"{prefix}chunk{index} = ANY(%s)" for prefix in ('', 'canonical_') for index in range(CHUNKS))
+        query = f"SELECT tensor_id, dhash, canonical FROM tbl_image_phash WHERE {conditions}"
+        chunk_values = [chunk_neighbours(chunk, radius) for chunk in split_chunks(value) + split_chunks(canonical)]
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, chunk_values)
+                rows = cursor.fetchall()
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error searching perceptual hashes: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return []
+        finally:
+            self.db_conn_instance.return_connection(conn)
+        matches = [
+            (tensor_id, min(hamming_distance(value, to_unsigned(stored)), hamming_distance(canonical, to_unsigned(stored_canonical)) if stored_canonical is not None else 64))
+            for tensor_id, stored, stored_canonical in rows
+        ]
+        matches = [match for match in matches if match[1] <= max_distance]
+        self.logger.debug(f"{len(matches)} of {len(rows)} chunk matches are within distance {max_distance}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        return sorted(matches, key=lambda match: match[1])
@@ -1,32 +1,92 @@
+import time
+PROCESS_START = time.time()  # Before the heavy imports below, so they count towards startup
+
 import os
+import sys
+import json
 from file_processor import FileProcessor
+from checkpoints import PipelineCheckpoints
+
+RESUME_AFTER_SECONDS = int(os.getenv('RESUME_AFTER_SECONDS', 3600))  # Idle time before an interrupted file counts as abandoned
+
+def parse_file_info(value):
+    # Split on the last comma so file paths containing commas still work
+    parts = value.strip().rsplit(',', 1)
+    if len(parts) != 2:
+        return None
+    return parts[0].strip(), parts[1].strip()
+
+def read_manifest(lines):
+    file_infos = []
+    for line in lines:
+        if not line.strip():
+            continue
+        file_info = parse_file_info(line)
+        if file_info is None:
+            print(f"Invalid manifest line: {line.strip()}. Expected format: '<file_path>,<file_type>'. Skipping.")
+            continue
+        file_infos.append(file_info)
+    return file_infos
+
+def process_batch(file_infos, results_path=None):
+    # One FileProcessor (and so one set of models, face encodings and DB pool) for the whole batch
+    processor = FileProcessor()
+    startup_seconds = round(time.time() - PROCESS_START, 3)
+    print(f"Startup took {startup_seconds}s before the first file")
+    processor.prefetch_metadata(file_infos)
+    results = []
+    for file_path, file_type in file_infos:
+        print(f"Starting processing for file {file_path} of type {file_type}")
+        start_time = time.time()
+        success = processor.process((file_path, file_type))
+        result = {'file': file_path, 'type': file_type, 'success': success, 'seconds': round(time.time() - start_time, 3)}
+        if not results:
+            result['startup_seconds'] = startup_seconds
+        results.append(result)
+        # Results are written as each file finishes so a crash mid-batch still reports the completed files
+        if results_path:
+            with open(results_path, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+        else:
+            print(f"RESULT {json.dumps(result)}", flush=True)
+    return results
 
 def main():
+    if '--resume' in sys.argv[1:]:
+        # Files interrupted after leaving the inbox are never rediscovered there, so finish them from their checkpoints
+        file_infos = PipelineCheckpoints().stale(RESUME_AFTER_SECONDS)
+        print(f"Resuming {len(file_infos)} interrupted files")
+        results = process_batch(file_infos) if file_infos else []
+        return all(result['success'] for result in results)
+
+    if '--stdin' in sys.argv[1:]:
+        # A list of '<file_path>,<file_type>' lines on stdin; results are printed as RESULT lines
+        results = process_batch(read_manifest(sys.stdin))
+        return all(result['success'] for result in results)
+
+    manifest_path = os.getenv('NEW_FILES_MANIFEST')
+    if manifest_path:
+        with open(manifest_path) as f:
+            file_infos = read_manifest(f)
+        results_path = os.getenv('NEW_FILES_RESULTS', f"{manifest_path}.results.jsonl")
+        print(f"Processing batch of {len(file_infos)} files from {manifest_path}")
+        results = process_batch(file_infos, results_path)
+        return all(result['success'] for result in results)
+
     # Get the file path from the environment variable
     new_file_env = os.getenv('NEW_FILE')
     if not new_file_env:
-        print("No file path provided in the environment variable 'NEW_FILE'. Exiting.")
-        return
-    
+        print("No file path provided in 'NEW_FILE', 'NEW_FILES_MANIFEST', --stdin or --resume. Exiting.")
+        return False
+
     # Split the environment variable if it is a tuple-like string
-    new_file_parts = new_file_env.split(',')
-    if len(new_file_parts) != 2:
+    file_info = parse_file_info(new_file_env)
+    if file_info is None:
         print(f"Invalid NEW_FILE format: {new_file_env}. Expected format: '<file_path>,<file_type>'. Exiting.")
-        return
-    
-    file_path = new_file_parts[0].strip()
-    file_type = new_file_parts[1].strip()
-    print(f"Starting processing for file {file_path} of type {file_type}")
-    
-    # Create a tuple with the file path and file type
-    file_info = (file_path, file_type)
-    
-    # Create an instance of FileProcessor with the file info
-    processor = FileProcessor(file_info)
-    
-    # Call the method to start processing the file
-    processor.process_image()
+        return False
 
-if __name__ == "__main__":
-    main()
+    results = process_batch([file_info])
+    return results[0]['success']
 
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,182 @@
+'''
+An approximate nearest-neighbour index (PCA + IVF) over the image tensors, for "find visually similar" in cleo2.
+2024 Christopher Orr
+'''
+
+import os
+import time
+import numpy as np
+from logger_config import get_logger
+from tensor_store import TensorStore, TENSOR_STORE_DIRECTORY, ROW_BYTES
+
+SIMILARITY_INDEX_PATH = os.getenv('SIMILARITY_INDEX_PATH', os.path.join(TENSOR_STORE_DIRECTORY, 'similarity.npz'))
+PCA_DIMENSIONS = 64
+TRAINING_SAMPLE = 10000  # Rows used to fit the PCA and the clusters; 300 MB as float32
+KMEANS_ITERATIONS = 10
+NPROBE = 8  # Clusters searched per query
+RERANK_FACTOR = 10  # k * RERANK_FACTOR of the nearest PCA vectors are re-ranked by their exact MSE
+MAX_CANDIDATES = 20000  # Bounds the work, and so the latency, of a query however unbalanced the clusters are
+CHUNK_SIZE = 8192
+
+
+def squared_distances(vectors, centres):
+    '''(len(vectors), len(centres)) squared Euclidean distances.'''
+    return (np.einsum('ij,ij->i', vectors, vectors)[:, None] - 2 * vectors @ centres.T + np.einsum('ij,ij->i', centres, centres)[None, :])
+
+
+class SimilarityIndex:
+    '''
+    Every tensor is reduced to PCA_DIMENSIONS by a PCA fitted on a sample of the library, and the reduced vectors
+    are split into about sqrt(N) clusters by k-means (an inverted file, IVF).  A query is projected the same way
+    and compared only with the vectors in its NPROBE nearest clusters; the best of those are re-ranked by their
+    exact MSE, read from the tensor store.
+
+    The tensors come from the TensorStore, which insert_image_tensor already appends to, so new images are added
+    by refresh(), which projects the store rows the index has not seen into their nearest cluster.  rebuild()
+    refits the PCA and the clusters, which drift as the library grows, and is meant to run periodically.
+    '''
+    def __init__(self, store=None, path=SIMILARITY_INDEX_PATH, nprobe=NPROBE, max_candidates=MAX_CANDIDATES):
+        self.logger = get_logger(self.__class__.__name__)
+        self.store = store if store is not None else TensorStore()
+        self.path = path
+        self.nprobe = nprobe
+        self.max_candidates = max_candidates
+        self.mean = None
+        self.components = None
+        self.centroids = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, PCA_DIMENSIONS), dtype=np.float32)
+        self.lists = np.empty(0, dtype=np.int32)  # The cluster of each vector
+        self.order = np.empty(0, dtype=np.int64)  # Vector indexes grouped by cluster
+        self.offsets = np.zeros(1, dtype=np.int64)  # Cluster c is order[offsets[c]:offsets[c + 1]]
+        self.tensors = None
+        self.store_ids = np.empty(0, dtype=np.int64)
+        self.rows = {}  # tensor id -> row in the store
+
+    def project(self, tensors):
+        '''PCA-reduce (N, 7500) uint8 tensors, in chunks to bound the float copies.'''
+        result = np.empty((len(tensors), self.components.shape[0]), dtype=np.float32)
+        for start in range(0, len(tensors), CHUNK_SIZE):
+            chunk = np.asarray(tensors[start:start + CHUNK_SIZE], dtype=np.float32) - self.mean
+            result[start:start + len(chunk)] = chunk @ self.components.T
+        return result
+
+    def principal_axes(self, centred, dimensions, rng, oversampling=10, power_iterations=2):
+        '''
+        The leading right singular vectors of the centred sample, by randomized SVD: a full SVD of a
+        10000 x 7500 matrix takes minutes, while the range of a few random projections of it takes seconds.
+        '''
+        width = min(dimensions + oversampling, min(centred.shape))
+        basis, _ = np.linalg.qr(centred @ rng.standard_normal((centred.shape[1], width)).astype(np.float32))
+        for _ in range(power_iterations):
+            basis, _ = np.linalg.qr(centred @ (centred.T @ basis))
+        _, _, vt = np.linalg.svd(basis.T @ centred, full_matrices=False)
+        return vt[:dimensions].astype(np.float32)
+
+    def assign(self, vectors):
+        lists = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), CHUNK_SIZE):
+            lists[start:start + CHUNK_SIZE] = squared_distances(vectors[start:start + CHUNK_SIZE], self.centroids).argmin(axis=1)
+        return lists
+
+    def rebuild(self, seed=0):
+        '''Fit the PCA and clusters on a sample of the tensor store and index every stored tensor.'''
+        function_name = 'rebuild'
+        start_time = time.time()
+        ids, tensors, _ = self.store.open()
+        if len(ids) == 0:
+            self.logger.warning("The tensor store is empty; nothing to index", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return 0
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(ids), size=min(len(ids), TRAINING_SAMPLE), replace=False))
+        training = np.asarray(tensors[sample], dtype=np.float32)
+
+        self.mean = training.mean(axis=0)
+        training -= self.mean
+        self.components = self.principal_axes(training, min(PCA_DIMENSIONS, len(training)), rng)
+
+        reduced = self.project(training)
+        clusters = max(1, min(len(reduced), int(np.sqrt(len(ids)))))
+        self.centroids = reduced[rng.choice(len(reduced), size=clusters, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            labels = self.assign(reduced)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, labels, reduced)
+            counts = np.bincount(labels, minlength=clusters)
+            filled = counts > 0
+            self.centroids[filled] = sums[filled] / counts[filled, None]
+
+        self.ids = ids.copy()
+        self.vectors = self.project(tensors)
+        self.lists = self.assign(self.vectors)
+        self.group_lists()
+        self.attach(ids, tensors)
+        self.save()
+        self.logger.info(f"Indexed {len(ids)} tensors in {clusters} clusters in {time.time() - start_time:.1f}s", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        return len(ids)
+
+    def group_lists(self):
+        self.order = np.argsort(self.lists, kind='stable')
+        self.offsets = np.searchsorted(self.lists[self.order], np.arange(len(self.centroids) + 1))
+
+    def attach(self, ids, tensors):
+        self.tensors = tensors
+        self.store_ids = ids
+        self.rows = {tensor_id: row for row, tensor_id in enumerate(ids.tolist())}
+
+    def refresh(self):
+        '''Add the tensors appended to the store since the index was built or last refreshed. Returns how many.'''
+        function_name = 'refresh'
+        ids, tensors, _ = self.store.open()
+        self.attach(ids, tensors)
+        new = np.flatnonzero(~np.isin(ids, self.ids))
+        if len(new) == 0:
+            return 0
+        vectors = self.project(tensors[new])
+        self.ids = np.concatenate([self.ids, ids[new]])
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.lists = np.concatenate([self.lists, self.assign(vectors)])
+        self.group_lists()
+        self.save()
+        self.logger.info(f"Added {len(new)} tensors to the similarity index", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        return len(new)
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.part.npz'
+        np.savez(temp_path, mean=self.mean, components=self.components, centroids=self.centroids, ids=self.ids, vectors=self.vectors, lists=self.lists)
+        os.replace(temp_path, self.path)
+
+    def load(self):
+        '''Load the saved index and add any tensors stored since. Returns False if there is no saved index.'''
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as data:
+            self.mean, self.components, self.centroids = data['mean'], data['components'], data['centroids']
+            self.ids, self.vectors, self.lists = data['ids'], data['vectors'], data['lists']
+        self.group_lists()
+        self.refresh()
+        return True
+
+    def search(self, tensor, k=10, nprobe=None, rerank=True):
+        '''
+        The k images nearest the tensor, as (tensor_id, mse) pairs, nearest first.  The mse is exact when
+        rerank is set, and otherwise estimated from the PCA vectors.
+        '''
+        nprobe = self.nprobe if nprobe is None else nprobe
+        query = self.project(np.asarray(tensor, dtype=np.uint8).reshape(1, -1))
+        probes = np.argsort(squared_distances(query, self.centroids)[0])[:nprobe]
+        candidates = np.concatenate([self.order[self.offsets[probe]:self.offsets[probe + 1]] for probe in probes])[:self.max_candidates]
+        if len(candidates) == 0:
+            return []
+        estimates = squared_distances(self.vectors[candidates], query)[:, 0]
+        shortlist = candidates[np.argsort(estimates)[:k * RERANK_FACTOR if rerank else k]]
+        if not rerank or self.tensors is None:
+            distances = squared_distances(self.vectors[shortlist], query)[:, 0] / ROW_BYTES
+            return [(int(self.ids[index]), float(distance)) for index, distance in zip(shortlist, distances)][:k]
+        rows = [self.rows[tensor_id] for tensor_id in self.ids[shortlist].tolist() if tensor_id in self.rows]
+        exact = np.asarray(self.tensors[rows], dtype=np.float32) - np.asarray(tensor, dtype=np.float32).reshape(1, -1)
+        mse = np.einsum('ij,ij->i', exact, exact) / ROW_BYTES
+        order = np.argsort(mse)[:k]
+        return [(int(self.store_ids[rows[index]]), float(mse[index])) for index in order]
@@ -0,0 +1,70 @@
+'''
+Vectorized MSE comparison of an image tensor against many candidate tensors for the cleo2 project.
+2024 Christopher Orr
+'''
+
+import numpy as np
+from logger_config import get_logger
+
+TENSOR_SHAPE = (50, 50, 3)
+ROTATIONS = 4
+CHUNK_SIZE = 1024  # Candidates per matrix product; 1024 of them take about 60 MB as float64
+
+
+class TensorComparator:
+    '''
+    Computes the MSE between a tensor and every candidate, taking the best of the candidate's four 90 degree
+    rotations, in one matrix product instead of a Python loop per candidate and rotation.
+
+    Rotating the candidate by k is the same permutation of pixels as rotating the tensor by -k, so only the
+    four rotations of the tensor are built.  With a the tensor and b a candidate, both flattened,
+        mse = (a.a + b.b - 2 a.b) / size
+    and because every term is an integer sum below 2**53, float64 gives it exactly; uint8 values never wrap.
+    '''
+    def __init__(self, shape=TENSOR_SHAPE, chunk_size=CHUNK_SIZE):
+        self.logger = get_logger(self.__class__.__name__)
+        self.shape = tuple(shape)
+        self.size = int(np.prod(self.shape))
+        self.chunk_size = chunk_size
+
+    def rotations(self, tensor):
+        '''The tensor rotated by 0, -90, -180 and -270 degrees, flattened to a (4, size) float64 array.'''
+        return np.stack([np.rot90(tensor, -k).reshape(-1) for k in range(ROTATIONS)]).astype(np.float64)
+
+    def stack(self, buffers):
+        '''
+        Stack candidate tensors, given as arrays or the bytes stored in tbl_image_tensors, into an (N, *shape)
+        uint8 array.  Returns (stack, indexes of the buffers used); buffers of the wrong size are skipped.
+        '''
+        function_name = 'stack'
+        valid = []
+        arrays = []
+        for index, buffer in enumerate(buffers):
+            if buffer is None:
+                continue
+            array = np.frombuffer(buffer, dtype=np.uint8) if isinstance(buffer, (bytes, bytearray, memoryview)) else np.asarray(buffer, dtype=np.uint8)
+            if array.size != self.size:
+                self.logger.error(f"Buffer size mismatch for candidate {index}: expected {self.size}, got {array.size}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                continue
+            arrays.append(array.reshape(self.shape))
+            valid.append(index)
+        if not arrays:
+            return np.empty((0,) + self.shape, dtype=np.uint8), []
+        return np.stack(arrays), valid
+
+    def mse(self, tensor, candidates, rotate=True):
+        '''The MSE between tensor and each of the (N, *shape) candidates, as an (N,) float64 array.'''
+        candidates = np.asarray(candidates).reshape(len(candidates), -1)
+        if rotate:
+            queries = self.rotations(tensor)
+        else:
+            queries = np.asarray(tensor).reshape(1, -1).astype(np.float64)
+        query_squares = np.einsum('ij,ij->i', queries, queries)
+        result = np.empty(len(candidates), dtype=np.float64)
+        for start in range(0, len(candidates), self.chunk_size):
+            chunk = candidates[start:start + self.chunk_size].astype(np.float64)
+            chunk_squares = np.einsum('ij,ij->i', chunk, chunk)
+            # (n, rotations) squared distances; the best rotation of each candidate
+            distances = chunk_squares[:, None] + query_squares[None, :] - 2 * (chunk @ queries.T)
+            result[start:start + len(chunk)] = distances.min(axis=1) / self.size
+        return result
@@ -0,0 +1,224 @@
+'''
+An on-disk, memory-mapped copy of the tbl_image_tensors tensors for library-wide scans in the cleo2 project.
+2024 Christopher Orr
+'''
+
+import os
+import fcntl
+import numpy as np
+from contextlib import contextmanager
+from dbconnection import DBConnection
+from logger_config import get_logger
+
+TENSOR_STORE_DIRECTORY = os.getenv('TENSOR_STORE_DIRECTORY', '/mnt/MOM/Tensors')  # Empty to disable the store
+TENSOR_SHAPE = (50, 50, 3)
+ROW_BYTES = int(np.prod(TENSOR_SHAPE))
+COLUMNS = ('pil', 'cv2')
+
+
+class TensorStore:
+    '''
+    Keeps every image tensor in append-only files next to the library:
+        ids.i64      - the tbl_image_tensors id of each row, as int64
+        pil.u8       - the PIL tensors, as an (N, 7500) uint8 array
+        cv2.u8       - the cv2 tensors, likewise
+    insert_image_tensor appends each new tensor, and rebuild() recreates the files from the database.  open()
+    maps them read-only, so a scan of the whole library is one NumPy pass over a zero-copy buffer instead of a
+    query and an np.frombuffer per row.
+
+    Writers hold an exclusive POSIX lock on store.lock, which unlike flock also works over NFS, and readers a
+    shared one while they map the files.  A row only counts once all three files hold it, so a writer that
+    crashed part way leaves nothing a reader can see.  A row may appear twice if a file is retried after its
+    tensor was appended; open() then compacts the files to the last copy of each id before mapping them.
+    '''
+    def __init__(self, directory=TENSOR_STORE_DIRECTORY):
+        self.logger = get_logger(self.__class__.__name__)
+        self.directory = directory
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def locked(self, shared=False):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path('store.lock'), 'a+') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    def count(self):
+        '''Rows that are completely written.'''
+        try:
+            rows = os.path.getsize(self.path('ids.i64')) // 8
+        except FileNotFoundError:
+            return 0
+        for column in COLUMNS:
+            rows = min(rows, os.path.getsize(self.path(f'{column}.u8')) // ROW_BYTES)
+        return rows
+
+    def append(self, tensor_id, tensor_pil, tensor_cv2):
+        function_name = 'append'
+        if not self.enabled:
+            return
+        try:
+            with self.locked():
+                self.append_rows([tensor_id], np.ascontiguousarray(tensor_pil, dtype=np.uint8).tobytes(), np.ascontiguousarray(tensor_cv2, dtype=np.uint8).tobytes())
+        except Exception as e:
+            self.logger.error(f"Error appending tensor {tensor_id} to the tensor store: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+    def append_rows(self, tensor_ids, pil_bytes, cv2_bytes):
+        '''Append rows, given as their ids and the concatenated tensor bytes. The caller holds the lock.'''
+        rows = self.count()
+        self.write_at('pil.u8', rows * ROW_BYTES, pil_bytes)
+        self.write_at('cv2.u8', rows * ROW_BYTES, cv2_bytes)
+        self.write_at('ids.i64', rows * 8, np.asarray(tensor_ids, dtype=np.int64).tobytes())
+
+    def write_at(self, name, offset, data):
+        '''Write data at offset, first dropping anything a crashed writer left beyond the last complete row.'''
+        fd = os.open(self.path(name), os.O_RDWR | os.O_CREAT, 0o664)
+        try:
+            os.ftruncate(fd, offset)
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+    def open(self):
+        '''
+        (ids, tensors_pil, tensors_cv2) with one row per tensor id: ids as an int64 array and the tensors as
+        read-only (N, 7500) memory maps.  Indexing the maps to drop a duplicate would copy every tensor into
+        memory, so duplicates are compacted out of the files instead.
+        '''
+        while True:
+            # The maps keep the files they were opened on, so a rebuild replacing them afterwards does not matter
+            with self.locked(shared=True):
+                rows = self.count()
+                if rows == 0:
+                    return np.empty(0, dtype=np.int64), np.empty((0, ROW_BYTES), dtype=np.uint8), np.empty((0, ROW_BYTES), dtype=np.uint8)
+                ids = np.fromfile(self.path('ids.i64'), dtype=np.int64, count=rows)
+                tensors = [np.memmap(self.path(f'{column}.u8'), dtype=np.uint8, mode='r', shape=(rows, ROW_BYTES)) for column in COLUMNS]
+            if len(np.unique(ids)) == rows:
+                return ids, tensors[0], tensors[1]
+            del tensors
+            self.compact()
+
+    def compact(self, batch_size=10000):
+        '''
+        Rewrite the files keeping only the last copy of each id, a batch of rows at a time. Returns the number of
+        rows dropped.  The lock is held throughout so no append is lost; duplicates are rare, so this is too.
+        '''
+        function_name = 'compact'
+        names = ['ids.i64'] + [f'{column}.u8' for column in COLUMNS]
+        try:
+            with self.locked():
+                rows = self.count()
+                ids = np.fromfile(self.path('ids.i64'), dtype=np.int64, count=rows)
+                unique_ids, last = np.unique(ids[::-1], return_index=True)
+                if len(unique_ids) == rows:
+                    return 0
+                keep = np.sort(rows - 1 - last)
+                for column in COLUMNS:
+                    tensors = np.memmap(self.path(f'{column}.u8'), dtype=np.uint8, mode='r', shape=(rows, ROW_BYTES))
+                    with open(self.path(f'{column}.u8.compact'), 'wb') as f:
+                        for start in range(0, len(keep), batch_size):
+                            f.write(tensors[keep[start:start + batch_size]].tobytes())
+                    del tensors
+                ids[keep].tofile(self.path('ids.i64.compact'))
+                # With no ids the store counts no rows, so a crash while swapping leaves it empty rather than
+                # misaligned, and the next sync refills it
+                os.truncate(self.path('ids.i64'), 0)
+                for name in reversed(names):
+                    os.replace(self.path(f'{name}.compact'), self.path(name))
+            self.logger.info(f"Compacted {rows - len(keep)} duplicate rows out of the tensor store", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return rows - len(keep)
+        except Exception as e:
+            self.logger.error(f"Error compacting the tensor store: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            raise
+
+    def sync(self, conn=None, batch_size=10000):
+        '''
+        Append the tensors in tbl_image_tensors that the store is missing, such as those whose append failed or
+        that were inserted while the store was being rebuilt.  Returns the number of rows added.
+        '''
+        function_name = 'sync'
+        if conn is None:
+            db_conn_instance = DBConnection.get_instance()
+            conn = db_conn_instance.get_connection()
+            try:
+                with self.locked():
+                    return self.sync(conn, batch_size)
+            finally:
+                db_conn_instance.return_connection(conn)
+
+        try:
+            rows = self.count()
+            stored_ids = np.fromfile(self.path('ids.i64'), dtype=np.int64, count=rows) if rows else np.empty(0, dtype=np.int64)
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT id FROM tbl_image_tensors WHERE length(tensor_pil) = %s AND length(tensor_cv2) = %s", (ROW_BYTES, ROW_BYTES))
+                database_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+                missing = np.setdiff1d(database_ids, stored_ids)
+                for start in range(0, len(missing), batch_size):
+                    cursor.execute(
+                        "SELECT id, tensor_pil, tensor_cv2 FROM tbl_image_tensors WHERE id = ANY(%s) ORDER BY id",
+                        (missing[start:start + batch_size].tolist(),)
+                    )
+                    batch = cursor.fetchall()
+                    self.append_rows([row[0] for row in batch], b''.join(bytes(row[1]) for row in batch), b''.join(bytes(row[2]) for row in batch))
+            conn.commit()
+            if len(missing):
+                self.logger.info(f"Added {len(missing)} missing tensors to the tensor store", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return len(missing)
+        except Exception as e:
+            self.logger.error(f"Error syncing the tensor store: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            raise
+
+    def rebuild(self, batch_size=10000):
+        '''
+        Recreate the store from tbl_image_tensors. Returns the number of rows written.  The files are written
+        beside the old ones without holding the lock, so ingest is never blocked for long; the lock is only
+        taken to swap them in and sync the tensors inserted in the meantime.
+        '''
+        function_name = 'rebuild'
+        db_conn_instance = DBConnection.get_instance()
+        conn = db_conn_instance.get_connection()
+        names = ['ids.i64'] + [f'{column}.u8' for column in COLUMNS]
+        total = 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            files = {name: open(self.path(f'{name}.rebuild'), 'wb') for name in names}
+            try:
+                # A named cursor streams the rows from the server instead of loading the whole table
+                with conn.cursor(name='tensor_store_rebuild') as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute("""
+                    SELECT id, tensor_pil, tensor_cv2 FROM tbl_image_tensors
+                    WHERE length(tensor_pil) = %s AND length(tensor_cv2) = %s
+                    ORDER BY id
+                    """, (ROW_BYTES, ROW_BYTES))
+                    for tensor_id, tensor_pil, tensor_cv2 in cursor:
+                        files['pil.u8'].write(tensor_pil)
+                        files['cv2.u8'].write(tensor_cv2)
+                        files['ids.i64'].write(np.int64(tensor_id).tobytes())
+                        total += 1
+                conn.commit()
+            finally:
+                for f in files.values():
+                    f.close()
+            with self.locked():
+                for name in names:
+                    os.replace(self.path(f'{name}.rebuild'), self.path(name))
+                total += self.sync(conn, batch_size)
+            self.logger.info(f"Rebuilt the tensor store with {total} tensors", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return total
+        except Exception as e:
+            self.logger.error(f"Error rebuilding the tensor store: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            raise
+        finally:
+            db_conn_instance.return_connection(conn)
@@ -9,14 +9,14 @@ from pathlib import Path
 from logger_config import get_logger
 from time import time
 import numpy as np
-from glob import glob
 import os
+import io
 from settings import *
 from dbconnection import DBConnection
 import hashlib
 import psycopg2
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import exiftool
+from exiftool_session import ExifToolPool, METADATA_PROFILE, file_signature
+from exif_header import parse_jpeg_exif, EXIF_HEADER_BYTES
 import datetime as dt
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderUnavailable
@@ -24,18 +24,32 @@ import socket
 import requests
 from wand.image import Image as WandImage
 from wand.exceptions import WandException
+from decoded_image import DecodedImage
+from tensor_comparator import TensorComparator
+from tensor_store import TensorStore
+from known_hashes import KnownHashes
 import cv2
 import subprocess
 import json
 import pwd
 import shutil
 
+HEIC_DECODER = os.getenv('HEIC_DECODER', 'wand')  # 'pillow_heif' decodes HEIC with libheif; its pixels, and so the hashes, differ from ImageMagick's
+if HEIC_DECODER == 'pillow_heif':
+    pillow_heif.register_heif_opener()
+HEIC_JPEG_QUALITY = int(os.getenv('HEIC_JPEG_QUALITY', 92))  # ImageMagick's default JPEG quality
+HASH_BLOCK_SIZE = 1024 * 1024
+
 
 class Utilities:
     def __init__(self):
         self.logger = get_logger(__name__)
         self.max_workers = 10
         self.db_conn_instance = DBConnection.get_instance()
+        self.comparator = TensorComparator()
+        self.tensor_store = TensorStore()
+        self.known_hashes = KnownHashes()
+        self.file_header = None  # (file, signature, first bytes) of the last file hashed, for the EXIF fast path
 
     def get_new_files(self, directory):
         function_name = 'get_new_files'
@@ -46,7 +60,17 @@ class Utilities:
             self.logger.error(f"Directory does not exist: {directory}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             return [], []
 
-        files = glob(os.path.join(directory, '*'))
+        # scandir hands back each file's size from the same directory read, so the scheduler can order by size for free
+        file_sizes = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                try:
+                    file_sizes[entry.path] = entry.stat().st_size
+                except OSError:
+                    file_sizes[entry.path] = None
+        files = list(file_sizes)
         self.logger.debug(f"Files found: {files}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
         
         if not files:
@@ -57,7 +81,7 @@ class Utilities:
         skipped_files_all = []
 
         valid_files, skip_files = self.validate_files(files)
-        valid_files_all.extend(valid_files)
+        valid_files_all.extend((file, file_type, file_sizes[file]) for file, file_type in valid_files)
         skipped_files_all.extend(skip_files)
 
         duration = time() - start_time
@@ -110,15 +134,18 @@ class Utilities:
         except Exception as e:
             self.logger.error(f"Error moving file {file} to error directory: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
-    def generate_tensor(self, file):
+    def generate_tensor(self, file, decoded=None):
         function_name = 'generate_tensor'
         self.logger.debug(f"Generating tensor for file: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
         try:
-            file = self.check_and_convert_file(file)
-
-            tensor_pil = self.generate_tensor_pil(file)
-            tensor_cv2 = self.generate_tensor_cv2(file)
+            # Both tensors come from a single decode of the file.  A caller passing the decoded image has already
+            # converted it, possibly only in memory
+            if decoded is None:
+                file = self.check_and_convert_file(file)
+                decoded = self.decode_image(file)
+            tensor_pil = self.generate_tensor_pil(file, decoded)
+            tensor_cv2 = self.generate_tensor_cv2(file, decoded)
 
             if tensor_pil is not None and tensor_cv2 is not None:
                 hash_pil = self.compute_tensor_hash(tensor_pil)
@@ -137,10 +164,23 @@ class Utilities:
             self.logger.error(f"Error generating tensor for file {file}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             return {str(Path(file)): str(e)}
 
-    def identify_file_extension(self, file):
+    def identify_file_and_hash(self, file):
+        '''(actual_extension, BLAKE2b hex digest of the whole file), from a single read of the file.'''
+        content_hash = hashlib.blake2b(digest_size=32)
+        actual_extension = self.identify_file_extension(file, content_hash)
+        return actual_extension, content_hash.hexdigest()
+
+    def identify_file_extension(self, file, content_hash=None):
+        '''The extension the file's first bytes indicate. When content_hash (a hashlib object) is given, the whole file is streamed through it in the same read.'''
         function_name = 'identify_file_extension'
         with open(file, 'rb') as f:
-            file_header = f.read(10)
+            block = f.read(HASH_BLOCK_SIZE if content_hash is not None else 10)
+            file_header = block[:10]
+            if content_hash is not None:
+                self.file_header = (file, file_signature(file), block[:EXIF_HEADER_BYTES])
+            while content_hash is not None and block:
+                content_hash.update(block)
+                block = f.read(HASH_BLOCK_SIZE)
         
         actual_extension = None
         # List of possible ftyp sizes and corresponding HEIC/HEIF markers
@@ -202,94 +242,154 @@ class Utilities:
 
 
 
+    def check_file_extension(self, file, actual_extension=None):
+        '''
+        Rename the file if its extension does not match its contents. Returns (file, actual_extension).  A caller
+        that already read the file, with identify_file_and_hash, passes the extension it found.
+        '''
+        function_name = 'check_file_extension'
+        self.logger.info(f"Checking file type for: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+        # Identify actual file extension
+        if actual_extension is None:
+            actual_extension = self.identify_file_extension(file)
+
+        if actual_extension is None:
+            self.logger.error(f"Unknown or invalid file type for file: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return file, None
+
+        current_extension = os.path.splitext(file)[1].lower()
+
+        if current_extension != actual_extension:
+            new_file = os.path.splitext(file)[0] + actual_extension
+            os.rename(file, new_file)
+            self.logger.info(f"Renamed file to correct extension: {new_file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            file = new_file
+
+        return file, actual_extension
+
     def check_and_convert_file(self, file):
         function_name = 'check_and_convert_file'
         try:
-            self.logger.info(f"Checking file type for: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            file, decoded = self.check_and_decode_file(file)
+            if decoded is not None and decoded.converted_from is not None:
+                result = self.write_converted_file(decoded, decoded.file)
+                if result != "Success":
+                    raise OSError(result)
+            return file
+        except Exception as e:
+            self.logger.error(f"Error checking or converting file type for {file}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            raise
 
-            # Identify actual file extension
-            actual_extension = self.identify_file_extension(file)
+    def check_and_decode_file(self, file, actual_extension=None):
+        '''
+        Like check_and_convert_file, but a file that needs converting is converted in memory.  Returns
+        (file, decoded): for a converted file, file is the .jpg path it will have and decoded holds the JPEG,
+        which is written once, straight to its final destination, by write_converted_file.  For any other
+        file decoded is None and the file is decoded as usual.
+        '''
+        function_name = 'check_and_decode_file'
+        try:
+            file, actual_extension = self.check_file_extension(file, actual_extension)
 
             if actual_extension is None:
-                self.logger.error(f"Unknown or invalid file type for file: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-                return file  # Return the file as is, or handle it as needed
-
-            current_extension = os.path.splitext(file)[1].lower()
-            
-            if actual_extension and current_extension != actual_extension:
-                new_file = os.path.splitext(file)[0] + actual_extension
-                os.rename(file, new_file)
-                self.logger.info(f"Renamed file to correct extension: {new_file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-                file = new_file
-            
-            if actual_extension == '.heic':
-                self.logger.info(f"Converting HEIC file to JPG: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-                file = self.convert_heic_to_jpg(file)
-            elif actual_extension == '.pcd':
-                self.logger.info(f"Converting PCD file to JPG: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-                file = self.convert_pcd_to_jpg(file)
-            elif actual_extension in ['.png', '.gif']:
+                return file, None  # Return the file as is, or handle it as needed
+            if actual_extension in ['.png', '.gif']:
                 self.logger.info(f"File is a PNG or GIF and will not be converted: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-            elif actual_extension != '.jpg':
-                self.logger.info(f"Converting non-JPG file to JPG: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-                file = self.convert_to_jpg(file)
-            
-            return file
+                return file, None
+            if actual_extension == '.jpg':
+                return file, None
+
+            self.logger.info(f"Converting {actual_extension[1:].upper()} file to JPG in memory: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            if actual_extension in ['.heic', '.heif'] and HEIC_DECODER == 'pillow_heif':
+                data = self.convert_heic_to_jpg(file)
+            elif actual_extension in ['.heic', '.heif', '.pcd']:
+                data = self.convert_with_imagemagick(file)
+            else:
+                data = self.convert_to_jpg(file)
+            return str(Path(file).with_suffix('.jpg')), DecodedImage(str(Path(file).with_suffix('.jpg')), data=data, converted_from=file)
         except Exception as e:
             self.logger.error(f"Error checking or converting file type for {file}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             raise
 
     def convert_heic_to_jpg(self, file):
+        '''The HEIC/HEIF file as JPEG bytes, keeping its EXIF, XMP and colour profile.  Only with HEIC_DECODER=pillow_heif.'''
         function_name = 'convert_heic_to_jpg'
         try:
-            new_file = str(Path(file).with_suffix('.jpg'))
-            with WandImage(filename=file) as img:
-                img.format = 'jpeg'
-                img.save(filename=new_file)
-            self.logger.info(f"Converted HEIC {file} to JPG {new_file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})            
-            
-            # Remove the original HEIC file
-            os.remove(file)
-            self.logger.info(f"Deleted original HEIC file: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-
-            return new_file
-        except WandException as e:
+            with Image.open(file) as img:
+                buffer = io.BytesIO()
+                options = {key: img.info[key] for key in ('exif', 'xmp', 'icc_profile') if img.info.get(key)}
+                # libheif applies the rotation when decoding, and pillow_heif resets the EXIF orientation to match
+                img.convert('RGB').save(buffer, format='JPEG', quality=HEIC_JPEG_QUALITY, **options)
+            self.logger.info(f"Converted HEIC {file} to JPG in memory", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return buffer.getvalue()
+        except (UnidentifiedImageError, OSError) as e:
             self.logger.error(f"Error converting HEIC {file} to JPG: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             raise
 
-    def convert_pcd_to_jpg(self, file):
-        function_name = 'convert_pcd_to_jpg'
+    def convert_with_imagemagick(self, file):
+        '''The file (PCD, or HEIC unless HEIC_DECODER=pillow_heif) as JPEG bytes encoded by ImageMagick, as `convert` wrote it.'''
+        function_name = 'convert_with_imagemagick'
         try:
-            new_file = str(Path(file).with_suffix('.jpg'))
-            subprocess.run(['convert', file, new_file], check=True)
-            self.logger.info(f"Converted PCD {file} to JPG {new_file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})            
-            os.remove(file)
-            self.logger.info(f"Deleted original PCD file: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-            return new_file
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Error converting PCD {file} to JPG: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            with WandImage(filename=file) as img:
+                img.format = 'jpeg'
+                data = img.make_blob()
+            self.logger.info(f"Converted {file} to JPG in memory", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return data
+        except WandException as e:
+            self.logger.error(f"Error converting {file} to JPG: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             raise
 
     def convert_to_jpg(self, file):
         function_name = 'convert_to_jpg'
         try:
             with Image.open(file) as img:
-                rgb_img = img.convert('RGB')
-                new_file = str(Path(file).with_suffix('.jpg'))
-                rgb_img.save(new_file, format='JPEG')
-                self.logger.info(f"Converted {file} to {new_file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-            
-            # Remove the original file
-            os.remove(file)
-            self.logger.info(f"Deleted original file: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
-            
-            return new_file
+                buffer = io.BytesIO()
+                img.convert('RGB').save(buffer, format='JPEG')
+            self.logger.info(f"Converted {file} to JPG in memory", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return buffer.getvalue()
         except Exception as e:
             self.logger.error(f"Error converting {file} to JPG: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             raise
 
-    def generate_tensor_pil(self, file):
+    def write_converted_file(self, decoded, new_file):
+        '''Write a file converted in memory to new_file and delete the original, in place of move_file.'''
+        function_name = 'write_converted_file'
+
+        self.logger.debug(f"Writing {decoded.converted_from} converted to JPG as {new_file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        try:
+            target_dir = os.path.dirname(new_file)
+            if target_dir and not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+                self.logger.debug(f"Created target directory: {target_dir}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
+            # Write under a temporary name so an interrupted write never leaves a truncated image behind
+            temp_file = new_file + '.part'
+            with open(temp_file, 'wb') as f:
+                f.write(decoded.data)
+            os.replace(temp_file, new_file)
+            os.remove(decoded.converted_from)
+            self.logger.info(f"Wrote {new_file} and deleted original file: {decoded.converted_from}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            decoded.file = new_file
+            decoded.converted_from = None
+            return "Success"
+        except OSError as error:
+            self.logger.error(f"Error writing {new_file} converted from {decoded.converted_from}: {error}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return str(error)
+
+    def decode_image(self, file):
+        function_name = 'decode_image'
+        try:
+            self.logger.info(f"Decoding image: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return DecodedImage(file)
+        except (UnidentifiedImageError, OSError) as e:
+            self.logger.error(f"Error: {file} could not be decoded: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return None
+
+    def generate_tensor_pil(self, file, decoded=None):
         function_name = 'generate_tensor_pil'
+        if decoded is not None:
+            return decoded.tensor_pil()
         try:
             self.logger.info(f"Opening image with PIL: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             img = Image.open(file).convert('RGB')
@@ -306,8 +406,10 @@ class Utilities:
             self.logger.error(error_message, extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             return None
 
-    def generate_tensor_cv2(self, file):
+    def generate_tensor_cv2(self, file, decoded=None):
         function_name = 'generate_tensor_cv2'
+        if decoded is not None:
+            return decoded.tensor_cv2()
         try:
             self.logger.info(f"Opening image with cv2: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             img = cv2.imread(file)
@@ -329,19 +431,15 @@ class Utilities:
     
     def compute_mse(self, tensor_A, tensor_B, rotate=True):
         function_name = 'compute_mse'
+        return float(self.comparator.mse(tensor_A, np.asarray(tensor_B)[None], rotate=rotate)[0])
 
-        if rotate:
-            mse_list = []
-            for rot in range(4):
-                mse = np.square(np.subtract(tensor_A, tensor_B)).mean()
-                mse_list.append(mse)
-                tensor_B = np.rot90(tensor_B)
-            return min(mse_list)
-        else:
-            return np.square(np.subtract(tensor_A, tensor_B)).mean()
-    
-    def fetch_potential_duplicates(self, tensor_hash_pil, tensor_hash_cv2):
+    def fetch_potential_duplicates(self, tensor_hash_pil, tensor_hash_cv2, tensor_ids=None):
+        '''Rows with either exact tensor hash, plus the tensor_ids of near duplicates found by perceptual hash.'''
         function_name = 'fetch_potential_duplicates'
+        # With no perceptual hash candidates the query can only find exact hash matches, which the filter rules out
+        if not tensor_ids and self.known_hashes.definitely_absent(tensor_hash_pil, tensor_hash_cv2):
+            self.logger.debug("No stored tensor has either hash; skipping the duplicate query", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return []
         try:
             conn = self.db_conn_instance.get_connection()
             cur = conn.cursor()
@@ -349,9 +447,9 @@ class Utilities:
             select_query = """
             SELECT filename, tensor_pil, tensor_cv2, hash_pil, hash_cv2 
             FROM tbl_image_tensors
-            WHERE hash_pil = %s OR hash_cv2 = %s
+            WHERE hash_pil = %s OR hash_cv2 = %s OR id = ANY(%s)
             """
-            cur.execute(select_query, (tensor_hash_pil, tensor_hash_cv2))
+            cur.execute(select_query, (tensor_hash_pil, tensor_hash_cv2, list(tensor_ids or [])))
             results = cur.fetchall()
             return results
         except Exception as e:
@@ -362,47 +460,27 @@ class Utilities:
             self.db_conn_instance.return_connection(conn)
 
     def compare_with_potential_duplicates(self, tensor_pil, tensor_cv2, potential_duplicates, mse_threshold):
+        '''
+        (filename, mse) of the candidates within mse_threshold, best first.  A candidate matches on its PIL
+        tensor, or failing that its cv2 tensor, in any of four rotations.  All candidates are compared at once.
+        '''
         function_name = 'compare_with_potential_duplicates'
-        duplicates = []
-
-        def compare_single(db_entry):
-            db_filename, db_tensor_pil, db_tensor_cv2, db_hash_pil, db_hash_cv2 = db_entry
-            required_shape = (50, 50, 3)
+        duplicates = {}
 
+        for tensor, column in ((tensor_pil, 1), (tensor_cv2, 2)):
+            candidates, valid = self.comparator.stack([db_entry[column] for db_entry in potential_duplicates])
+            if not valid:
+                continue
             try:
-                if db_tensor_pil is not None:
-                    db_tensor_pil = np.frombuffer(db_tensor_pil, dtype=tensor_pil.dtype)
-                    if db_tensor_pil.size == np.prod(required_shape):
-                        db_tensor_pil = db_tensor_pil.reshape(required_shape)
-                        mse_pil = self.compute_mse(tensor_pil, db_tensor_pil)
-                        if mse_pil <= mse_threshold:
-                            return db_filename, mse_pil
-                    else:
-                        self.logger.error(f"Buffer size mismatch for db_tensor_pil: expected {np.prod(required_shape)}, got {db_tensor_pil.size}")
-
-                if db_tensor_cv2 is not None:
-                    db_tensor_cv2 = np.frombuffer(db_tensor_cv2, dtype=tensor_cv2.dtype)
-                    if db_tensor_cv2.size == np.prod(required_shape):
-                        db_tensor_cv2 = db_tensor_cv2.reshape(required_shape)
-                        mse_cv2 = self.compute_mse(tensor_cv2, db_tensor_cv2)
-                        if mse_cv2 <= mse_threshold:
-                            return db_filename, mse_cv2
-                    else:
-                        self.logger.error(f"Buffer size mismatch for db_tensor_cv2: expected {np.prod(required_shape)}, got {db_tensor_cv2.size}")
-
+                mse = self.comparator.mse(tensor, candidates)
             except Exception as e:
-                self.logger.error(f"Error processing tensor for {db_filename}: {e}")
+                self.logger.error(f"Error comparing tensors: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                continue
+            for index in np.flatnonzero(mse <= mse_threshold):
+                duplicates.setdefault(valid[index], (potential_duplicates[valid[index]][0], float(mse[index])))
 
-            return None
-
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_entry = {executor.submit(compare_single, entry): entry for entry in potential_duplicates}
-            for future in as_completed(future_to_entry):
-                result = future.result()
-                if result:
-                    duplicates.append(result)
-
-        return duplicates
+        self.logger.debug(f"{len(duplicates)} of {len(potential_duplicates)} candidates are within MSE {mse_threshold}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        return sorted(duplicates.values(), key=lambda duplicate: duplicate[1])
     
     def process_file(self, file_info):
         file, file_type = file_info
@@ -440,18 +518,52 @@ class Utilities:
             self.logger.error(f"Error moving file from {old_file} to {new_file}: {error}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             return str(error)
 
-    def get_image_metadata_from_file(self, path):
+    def get_image_metadata_from_file(self, path, profile=METADATA_PROFILE):
         function_name = 'get_image_metadata_from_file'
-        self.logger.debug(f"Extracting metadata from image file: {path}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        self.logger.debug(f"Extracting {profile} metadata from image file: {path}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
         try:
-            with exiftool.ExifTool() as et:
-                metadata = et.get_metadata(path)
+            metadata = self.read_exif_header(path) if profile == 'fast' else None
+            if metadata is None:
+                metadata = ExifToolPool.get_instance().get_metadata(path, profile)
+            if profile != 'full':
+                # Stored with the tags, so backfill_full_metadata.py can find the images still to extract in full
+                metadata['Cleo:MetadataProfile'] = profile
             self.logger.detail(f"Image metadata extracted for {path}: {metadata}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             return metadata
         except Exception as e:
             self.logger.error(f"Failed to extract metadata with EXIFtool for {path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
             return {}
 
+    def read_exif_header(self, path):
+        '''The fast profile's tags parsed from a JPEG's own header, without exiftool, or None if exiftool is needed.'''
+        function_name = 'read_exif_header'
+        try:
+            if self.file_header is not None and self.file_header[0] == path and self.file_header[1] == file_signature(path):
+                header = self.file_header[2]  # Already read when the file was hashed
+            else:
+                with open(path, 'rb') as f:
+                    header = f.read(EXIF_HEADER_BYTES)
+        except OSError as e:
+            self.logger.warning(f"Could not read the header of {path}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            return None
+        metadata = parse_jpeg_exif(header, path)
+        if metadata is None:
+            self.logger.debug(f"No EXIF header parse for {path}; using exiftool", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        return metadata
+
+    def prefetch_image_metadata(self, paths):
+        '''Read the metadata of a batch of images in a few exiftool calls, ready for get_image_metadata_from_file.'''
+        function_name = 'prefetch_image_metadata'
+        start_time = time()
+        try:
+            if METADATA_PROFILE == 'fast':
+                # JPEGs are normally read from their own headers, so only the other formats are worth batching for exiftool
+                paths = [path for path in paths if self.identify_file_extension(path) != '.jpg']
+            count = ExifToolPool.get_instance().prefetch(paths, METADATA_PROFILE)
+            self.logger.debug(f"Prefetched metadata for {count} of {len(paths)} images in {time() - start_time:.2f} seconds", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        except Exception as e:
+            self.logger.error(f"Failed to prefetch metadata with EXIFtool: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+
     def get_file_create_date_for_image(self, file, metadata):
         function_name = 'get_file_create_date_for_image'
         self.logger.debug(f"Extracting file date for: {file}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
@@ -674,6 +786,21 @@ class Utilities:
         except Exception as e:
             self.logger.error(f"Error updating file in database: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
 
+    def update_dimensions(self, width, height, file_ID):
+        function_name = 'update_dimensions'
+
+        self.logger.debug(f"Updating dimensions of file ID {file_ID} to {width}x{height}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE tbl_media_objects SET width = %s, height = %s WHERE media_object_id = %s", (width, height, file_ID))
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error updating dimensions for file ID {file_ID}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
     def flatten_dict(self, d, parent_key='', sep='_'):
         function_name = 'flatten_dict'
 
@@ -714,6 +841,26 @@ class Utilities:
         finally:
             self.db_conn_instance.return_connection(conn)
 
+    def replace_metadata(self, metadata, file_ID):
+        '''Replace all of a media object's metadata rows in one transaction, as when a full extraction supersedes a fast one.'''
+        function_name = 'replace_metadata'
+
+        self.logger.debug(f"Replacing metadata for file ID {file_ID}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        conn = self.db_conn_instance.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM tbl_media_metadata WHERE media_object_id = %s", (file_ID,))
+                rows = [(file_ID, exif_tag, self.convert_list_to_string(exif_data) if isinstance(exif_data, list) else exif_data) for exif_tag, exif_data in metadata.items()]
+                cursor.executemany("INSERT INTO tbl_media_metadata (media_object_id, exif_tag, exif_data) VALUES (%s, %s, %s)", rows)
+            conn.commit()
+            return True
+        except Exception as e:
+            self.logger.error(f"Error replacing metadata for file ID {file_ID}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            conn.rollback()
+            return False
+        finally:
+            self.db_conn_instance.return_connection(conn)
+
     def convert_list_to_string(self, li):
         function_name = 'convert_list_to_string'
 
@@ -771,6 +918,10 @@ class Utilities:
             cur.execute(update_query, (tensor_id, media_object_id))
             conn.commit()
 
+            # Keep the memory-mapped copy used for library-wide scans in step
+            self.tensor_store.append(tensor_id, tensor_pil, tensor_cv2)
+            self.known_hashes.add(hash_pil, hash_cv2)
+
             return tensor_id
 
         except Exception as e:
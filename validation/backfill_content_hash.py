@@ -0,0 +1,56 @@
+'''
+Records the content hash of the images stored before content hashes were, so byte-identical copies of them are
+rejected before decoding.  The stored files are hashed as they are now; images that were converted (HEIC, PCD)
+will therefore only match copies of the converted JPEG, not of the original.
+
+Usage: python backfill_content_hash.py
+2024 Christopher Orr
+'''
+
+import os
+import sys
+from dotenv import load_dotenv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbconnection import DBConnection
+from utilities import Utilities
+from content_hash import ContentHashIndex
+
+load_dotenv()
+
+IMAGE_DIRECTORY = os.getenv('IMAGE_ROOT', '/mnt/MOM/Images')
+
+
+def backfill():
+    index = ContentHashIndex()
+    index.create_table()
+    util = Utilities()
+
+    db = DBConnection.get_instance()
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT mo.media_object_id, mo.new_name FROM tbl_media_objects mo
+            LEFT JOIN tbl_content_hashes ch ON ch.media_object_id = mo.media_object_id
+            WHERE mo.media_type = 'image' AND mo.new_name IS NOT NULL AND ch.media_object_id IS NULL
+            """)
+            media_files = cursor.fetchall()
+        conn.commit()
+    finally:
+        db.return_connection(conn)
+
+    for i, (media_object_id, new_name) in enumerate(media_files, start=1):
+        file_path = os.path.join(IMAGE_DIRECTORY, new_name)
+        if not os.path.exists(file_path):
+            print(f"Missing {i}/{len(media_files)}: {file_path}")
+            continue
+        _, content_hash = util.identify_file_and_hash(file_path)
+        index.record(content_hash, media_object_id, file_path)
+        if i % 1000 == 0:
+            print(f"Hashed {i}/{len(media_files)}")
+    print(f"Hashed {len(media_files)} images")
+
+
+if __name__ == "__main__":
+    backfill()
@@ -0,0 +1,62 @@
+'''
+Extracts the full metadata of the images ingested with METADATA_PROFILE=fast, which stored only the capture date
+and GPS tags plus a Cleo:MetadataProfile marker, and replaces their tbl_media_metadata rows with every tag.  Meant
+to run in the background, outside ingestion.  The stored files are read where they are now, so the File: tags
+describe the stored file rather than the original in the inbox.
+
+Usage: python backfill_full_metadata.py [limit]
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+from dotenv import load_dotenv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbconnection import DBConnection
+from utilities import Utilities
+from exiftool_session import ExifToolPool, EXIFTOOL_BATCH_SIZE
+
+load_dotenv()
+
+IMAGE_DIRECTORY = os.getenv('IMAGE_ROOT', '/mnt/MOM/Images')
+
+
+def backfill(limit=None):
+    util = Utilities()
+    pool = ExifToolPool.get_instance()
+
+    db = DBConnection.get_instance()
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT mo.media_object_id, mo.new_name FROM tbl_media_metadata mm
+            JOIN tbl_media_objects mo ON mo.media_object_id = mm.media_object_id
+            WHERE mm.exif_tag = 'Cleo:MetadataProfile' AND mm.exif_data = 'fast' AND mo.new_name IS NOT NULL
+            ORDER BY mo.media_object_id
+            """ + (" LIMIT %s" % int(limit) if limit else ""))
+            media_files = cursor.fetchall()
+        conn.commit()
+    finally:
+        db.return_connection(conn)
+
+    start_time = time.time()
+    replaced = 0
+    for start in range(0, len(media_files), EXIFTOOL_BATCH_SIZE):
+        batch = [(media_object_id, os.path.join(IMAGE_DIRECTORY, new_name)) for media_object_id, new_name in media_files[start:start + EXIFTOOL_BATCH_SIZE]]
+        present = [(media_object_id, path) for media_object_id, path in batch if os.path.exists(path)]
+        for media_object_id, path in batch:
+            if not os.path.exists(path):
+                print(f"Missing: {path}")
+        results = pool.get_metadata_batch([path for _, path in present], 'full')
+        for (media_object_id, path), metadata in zip(present, results):
+            if metadata and util.replace_metadata(util.flatten_dict(metadata), media_object_id):
+                replaced += 1
+        print(f"Extracted {min(start + EXIFTOOL_BATCH_SIZE, len(media_files))}/{len(media_files)}")
+    print(f"Replaced the metadata of {replaced} images in {time.time() - start_time:.1f} seconds")
+
+
+if __name__ == "__main__":
+    backfill(int(sys.argv[1]) if len(sys.argv) > 1 else None)
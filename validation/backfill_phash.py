@@ -0,0 +1,56 @@
+'''
+Fills tbl_image_phash for images stored before perceptual hashes, or canonical ones, were recorded.  The
+hashes are computed from the stored PIL tensor, so no image files are read.
+
+Usage: python backfill_phash.py
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import numpy as np
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbconnection import DBConnection
+from perceptual_hash import PerceptualHashIndex, INSERT_QUERY
+
+load_dotenv()
+
+BATCH_SIZE = 5000
+TENSOR_SHAPE = (50, 50, 3)
+
+
+def backfill():
+    index = PerceptualHashIndex()
+    index.create_table()
+    db = DBConnection.get_instance()
+    conn = db.get_connection()
+    total = 0
+    try:
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                SELECT t.id, t.tensor_pil FROM tbl_image_tensors t
+                LEFT JOIN tbl_image_phash p ON p.tensor_id = t.id
+                WHERE p.canonical IS NULL AND t.tensor_pil IS NOT NULL AND length(t.tensor_pil) = %s
+                ORDER BY t.id LIMIT %s
+                """, (int(np.prod(TENSOR_SHAPE)), BATCH_SIZE))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                values = [index.row(tensor_id, np.frombuffer(tensor_pil, dtype=np.uint8).reshape(TENSOR_SHAPE)) for tensor_id, tensor_pil in rows]
+                execute_values(cursor, INSERT_QUERY, values)
+            conn.commit()
+            total += len(rows)
+            print(f"Stored {total} perceptual hashes")
+    except Exception as e:
+        print(f"Error backfilling perceptual hashes: {e}")
+        conn.rollback()
+    finally:
+        db.return_connection(conn)
+
+
+if __name__ == "__main__":
+    backfill()
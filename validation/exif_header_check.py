@@ -0,0 +1,58 @@
+'''
+Compares the EXIF header parser (exif_header.py) with exiftool's fast profile over a directory of images: how many
+files the parser handles itself, whether its tags agree with exiftool's, and the time each takes.
+
+Usage: python exif_header_check.py <directory>
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exif_header import parse_jpeg_exif, EXIF_HEADER_BYTES
+from exiftool_session import ExifToolPool
+
+
+def same(native, exiftool_metadata):
+    for key, value in native.items():
+        other = exiftool_metadata.get(key)
+        if isinstance(value, float) and isinstance(other, (int, float)):
+            if abs(value - other) > 1e-6:
+                return False
+        elif value != other:
+            return False
+    return set(native) == set(exiftool_metadata) - {'Cleo:MetadataProfile'}
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    directory = sys.argv[1]
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+
+    start_time = time.time()
+    native = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            native[path] = parse_jpeg_exif(f.read(EXIF_HEADER_BYTES), path)
+    native_seconds = time.time() - start_time
+
+    pool = ExifToolPool()
+    start_time = time.time()
+    results = pool.get_metadata_batch(paths, 'fast')
+    exiftool_seconds = time.time() - start_time
+    pool.stop()
+
+    parsed = [path for path in paths if native[path] is not None]
+    mismatched = [path for path, metadata in zip(paths, results) if native[path] is not None and not same(native[path], metadata)]
+    print(f"{len(parsed)} of {len(paths)} files parsed natively in {native_seconds:.2f}s; exiftool took {exiftool_seconds:.2f}s for all")
+    print(f"{len(mismatched)} disagree with exiftool")
+    for path in mismatched[:20]:
+        print(f"  {path}: native {native[path]}, exiftool {results[paths.index(path)]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+'''
+Micro-benchmark of ExifTool.execute reading large outputs (MakerNotes, embedded previews, movie metadata).  A stand-in
+process answers each -execute with the requested number of bytes and the {ready} sentinel, and the time per MB of
+the current read path is compared with the original one (bytes concatenation, 4 KB reads), which is quadratic.
+
+Usage: python exiftool_read_benchmark.py [max_mb]
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+import subprocess
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exiftool
+
+LEGACY_MAX_MB = 8  # Larger outputs take too long to read the old way
+REPEATS = 3
+
+# Reads argument lines like exiftool -stay_open; on -execute, writes the size given by the last argument
+EMITTER = r'''
+import sys
+args = []
+out = sys.stdout.buffer
+chunk = b'x' * 65536
+for line in sys.stdin.buffer:
+    line = line.rstrip(b'\n')
+    if line == b'-execute':
+        size = int(args[-1])
+        for _ in range(size // len(chunk)):
+            out.write(chunk)
+        out.write(b'x' * (size % len(chunk)) + b'\n{ready}\n')
+        out.flush()
+        args = []
+    else:
+        args.append(line)
+'''
+
+
+def legacy_execute(et, *params):
+    '''ExifTool.execute as it was: the output is rebuilt on every 4 KB read.'''
+    et._process.stdin.write(b"\n".join(params + (b"-execute\n",)))
+    et._process.stdin.flush()
+    output = b""
+    fd = et._process.stdout.fileno()
+    while not output[-32:].strip().endswith(exiftool.sentinel):
+        output += os.read(fd, 4096)
+    return output.strip()[:-len(exiftool.sentinel)]
+
+
+def timed(execute, et, size):
+    best = None
+    for _ in range(REPEATS):
+        start_time = time.perf_counter()
+        output = execute(et, str(size).encode())
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    assert len(output.rstrip()) == size, f"read {len(output.rstrip())} bytes, expected {size}"
+    return best
+
+
+def main():
+    max_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    et = exiftool.ExifTool()
+    et._process = subprocess.Popen([sys.executable, '-c', EMITTER], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    et.running = True
+    try:
+        print(f"{'MB':>5} {'current ms':>11} {'ms/MB':>7} {'original ms':>12} {'ms/MB':>7}")
+        mb = 1
+        while mb <= max_mb:
+            size = mb * 1024 * 1024
+            current = timed(exiftool.ExifTool.execute, et, size)
+            line = f"{mb:5} {current * 1000:11.1f} {current * 1000 / mb:7.2f}"
+            if mb <= LEGACY_MAX_MB:
+                legacy = timed(legacy_execute, et, size)
+                line += f" {legacy * 1000:12.1f} {legacy * 1000 / mb:7.2f}"
+            print(line)
+            mb *= 2
+    finally:
+        et.kill()
+
+
+if __name__ == "__main__":
+    main()
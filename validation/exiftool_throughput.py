@@ -0,0 +1,58 @@
+'''
+Measures metadata extraction throughput over a directory of images: an exiftool process per file (as before the
+shared session), one shared session read file by file, and the batched pool (exiftool_session.py) with the full
+and the fast metadata profile.
+
+Usage: python exiftool_throughput.py <directory> [processes] [batch_size]
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exiftool
+from exiftool_session import ExifToolSession, ExifToolPool, EXIFTOOL_PROCESSES, EXIFTOOL_BATCH_SIZE, PROFILES
+
+PER_PROCESS_SAMPLE = 20  # Starting exiftool per file is slow, so only a sample is timed that way
+
+
+def report(label, count, seconds):
+    print(f"{label:28} {count:6} files  {seconds:7.2f}s  {seconds / max(count, 1) * 1000:8.1f} ms/file")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    directory = sys.argv[1]
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else EXIFTOOL_PROCESSES
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else EXIFTOOL_BATCH_SIZE
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+    print(f"{len(paths)} files in {directory}")
+
+    start_time = time.time()
+    for path in paths[:PER_PROCESS_SAMPLE]:
+        with exiftool.ExifTool() as et:
+            et.get_metadata(path)
+    report("Process per file", min(len(paths), PER_PROCESS_SAMPLE), time.time() - start_time)
+
+    session = ExifToolSession()
+    start_time = time.time()
+    for path in paths:
+        session.get_metadata(path)
+    report("Shared session", len(paths), time.time() - start_time)
+    session.stop()
+
+    pool = ExifToolPool(processes=processes, batch_size=batch_size)
+    for profile in PROFILES:
+        start_time = time.time()
+        results = pool.get_metadata_batch(paths, profile)
+        report(f"Pool, {profile} ({processes} x {batch_size})", len(results), time.time() - start_time)
+        print(f"{'':28} {sum(len(metadata) for metadata in results) / max(len(results), 1):6.1f} tags/file")
+    pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+'''
+Measures how far fast-mode fingerprints (FINGERPRINT_MODE=fast, 1/8 scale JPEG decodes) drift from the tensors
+already stored in tbl_image_tensors, to decide per library whether fast mode can be used.
+
+Duplicates are found by an exact hash lookup before any MSE comparison, so fast mode is only safe for a library
+whose stored tensors it reproduces exactly.  Otherwise new files will not be matched against the existing ones
+until the library has been fingerprinted again in fast mode.
+
+Usage: python fingerprint_drift.py [sample_size]
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+from PIL import ImageFile
+from dotenv import load_dotenv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbconnection import DBConnection
+from decoded_image import DecodedImage
+
+load_dotenv()
+
+SAMPLE_SIZE = 500
+TENSOR_SHAPE = (50, 50, 3)
+MSE_THRESHOLD = float(os.getenv('MSE_THRESHOLD', 0.01))
+
+# Enable loading of truncated images
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def fetch_sample(sample_size):
+    db = DBConnection.get_instance()
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT filename, tensor_pil, tensor_cv2, hash_pil, hash_cv2 FROM tbl_image_tensors
+            WHERE tensor_pil IS NOT NULL AND tensor_cv2 IS NOT NULL
+            ORDER BY random() LIMIT %s
+            """, (sample_size,))
+            return cursor.fetchall()
+    finally:
+        db.return_connection(conn)
+
+
+def mse(tensor_A, tensor_B):
+    return float(np.square(tensor_A.astype(np.float64) - tensor_B.astype(np.float64)).mean())
+
+
+def fingerprint(file, fast):
+    start_time = time.time()
+    decoded = DecodedImage(file, fast=fast)
+    tensors = (decoded.tensor_pil(), decoded.tensor_cv2())
+    return tensors, time.time() - start_time
+
+
+def summarise(name, values):
+    values = np.array(values) if values else np.zeros(1)
+    print(f"  {name:<10} mean {values.mean():9.3f}  p50 {np.percentile(values, 50):9.3f}  p95 {np.percentile(values, 95):9.3f}  max {values.max():9.3f}")
+
+
+def main():
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else SAMPLE_SIZE
+    rows = fetch_sample(sample_size)
+    print(f"Sampled {len(rows)} rows from tbl_image_tensors")
+
+    results = {'full': {'pil': [], 'cv2': [], 'hash': 0, 'seconds': 0.0}, 'fast': {'pil': [], 'cv2': [], 'hash': 0, 'seconds': 0.0}}
+    checked = 0
+    for filename, stored_pil, stored_cv2, hash_pil, hash_cv2 in rows:
+        if not os.path.exists(filename):
+            print(f"Missing: {filename}")
+            continue
+        stored_pil = np.frombuffer(stored_pil, dtype=np.uint8).reshape(TENSOR_SHAPE)
+        stored_cv2 = np.frombuffer(stored_cv2, dtype=np.uint8).reshape(TENSOR_SHAPE)
+        try:
+            computed = {mode: fingerprint(filename, mode == 'fast') for mode in results}
+        except Exception as e:
+            print(f"Error fingerprinting {filename}: {e}")
+            continue
+        checked += 1
+        for mode, ((tensor_pil, tensor_cv2), seconds) in computed.items():
+            result = results[mode]
+            result['seconds'] += seconds
+            result['pil'].append(mse(tensor_pil, stored_pil))
+            result['cv2'].append(mse(tensor_cv2, stored_cv2))
+            # The duplicate lookup matches on either hash
+            if hashlib.md5(tensor_pil.tobytes()).hexdigest() == hash_pil or hashlib.md5(tensor_cv2.tobytes()).hexdigest() == hash_cv2:
+                result['hash'] += 1
+
+    if not checked:
+        print("No files could be checked")
+        return
+
+    for mode, result in results.items():
+        within = sum(1 for pil, cv2 in zip(result['pil'], result['cv2']) if min(pil, cv2) <= MSE_THRESHOLD)
+        print(f"\n{mode} mode: {result['seconds'] / checked * 1000:.1f} ms per file")
+        print(f"  hash matches stored:   {result['hash']}/{checked} ({result['hash'] / checked:.1%})")
+        print(f"  within MSE {MSE_THRESHOLD}:      {within}/{checked} ({within / checked:.1%})")
+        print("  MSE against the stored tensors:")
+        summarise('pil', result['pil'])
+        summarise('cv2', result['cv2'])
+
+    full_rate = results['full']['hash'] / checked
+    fast_rate = results['fast']['hash'] / checked
+    print()
+    if fast_rate >= full_rate:
+        print("Fast mode reproduces the stored fingerprints as well as full mode; FINGERPRINT_MODE=fast is safe for this library.")
+    else:
+        print(f"Fast mode would miss {full_rate - fast_rate:.1%} of exact duplicates that full mode finds; keep "
+              "FINGERPRINT_MODE=full for this library, or regenerate its tensors in fast mode before switching.")
+
+
+if __name__ == "__main__":
+    main()
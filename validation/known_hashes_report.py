@@ -0,0 +1,56 @@
+'''
+Reports the memory use and false positive rate of the known-hash Bloom filter (known_hashes.py): the rate
+expected from its fill, and the rate measured on random hashes that are not in it.
+
+Usage: python known_hashes_report.py [synthetic_count]
+With synthetic_count the filter is built from that many random hashes instead of tbl_image_tensors.
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+import hashlib
+from dotenv import load_dotenv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from known_hashes import KnownHashes, BloomFilter, MIN_CAPACITY
+
+load_dotenv()
+
+PROBES = 200000
+
+
+def random_hashes(count, seed):
+    return [hashlib.md5(f"{seed}-{index}".encode()).hexdigest() for index in range(count)]
+
+
+def main():
+    synthetic_count = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    start_time = time.time()
+    if synthetic_count:
+        bloom = BloomFilter(max(MIN_CAPACITY, 2 * synthetic_count))
+        for value in random_hashes(synthetic_count, 'stored'):
+            bloom.add(value)
+    else:
+        known_hashes = KnownHashes(path=None)
+        known_hashes.build()
+        bloom = known_hashes.filter
+        if bloom is None:
+            print("Could not build the filter from tbl_image_tensors")
+            return
+    print(f"Built the filter over {bloom.count} hashes in {time.time() - start_time:.1f}s")
+    print(f"Capacity {bloom.capacity}, {bloom.size} bits, {bloom.hash_count} hash functions")
+    print(f"Memory: {bloom.bits.nbytes / 1024 / 1024:.2f} MB ({bloom.bits.nbytes * 8 / max(bloom.count, 1):.1f} bits per hash)")
+    print(f"Expected false positive rate: {bloom.false_positive_rate():.6f}")
+
+    probes = random_hashes(PROBES, 'absent')
+    start_time = time.time()
+    false_positives = sum(value in bloom for value in probes)
+    elapsed = time.time() - start_time
+    print(f"Measured false positive rate: {false_positives / PROBES:.6f} ({false_positives} of {PROBES} absent hashes)")
+    print(f"Lookup: {elapsed / PROBES * 1e6:.1f} microseconds per hash")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+'''
+Measures the recall and latency of the similarity index (similarity_index.py) against a brute-force scan.
+
+Usage: python similarity_benchmark.py [queries] [synthetic_count]
+With synthetic_count the benchmark runs on that many generated tensors in a temporary store instead of the
+library's tensor store.
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import cv2
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tensor_store import TensorStore, TENSOR_SHAPE, ROW_BYTES
+from tensor_comparator import TensorComparator
+from similarity_index import SimilarityIndex
+
+QUERIES = 200
+K = 10
+NPROBES = [1, 2, 4, 8, 16, 32]
+
+
+def synthetic_store(count, directory, seed=0):
+    '''A store of smooth images in loose groups, so that like real photos they have neighbours worth finding.'''
+    rng = np.random.default_rng(seed)
+    store = TensorStore(directory)
+    bases = rng.uniform(0, 255, (max(1, count // 50), 5, 5, 3)).astype(np.float32)
+    with store.locked():
+        for start in range(0, count, 10000):
+            batch = min(10000, count - start)
+            coarse = bases[rng.integers(0, len(bases), batch)] + rng.normal(0, 25, (batch, 5, 5, 3)).astype(np.float32)
+            tensors = np.stack([cv2.resize(image, TENSOR_SHAPE[:2], interpolation=cv2.INTER_CUBIC) for image in coarse])
+            tensors = np.clip(tensors + rng.normal(0, 4, tensors.shape), 0, 255).astype(np.uint8)
+            store.append_rows(np.arange(start, start + batch), tensors.tobytes(), tensors.tobytes())
+    return store
+
+
+def percentiles(values):
+    return f"p50 {np.percentile(values, 50) * 1000:7.2f} ms  p95 {np.percentile(values, 95) * 1000:7.2f} ms"
+
+
+def main():
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else QUERIES
+    synthetic_count = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    temp_directory = tempfile.TemporaryDirectory() if synthetic_count else None
+    store = synthetic_store(synthetic_count, temp_directory.name) if synthetic_count else TensorStore()
+
+    index = SimilarityIndex(store, path=os.path.join(temp_directory.name, 'similarity.npz') if temp_directory else None)
+    start_time = time.time()
+    count = index.rebuild()
+    if count == 0:
+        print("The tensor store is empty; run tensor_store_scan.py rebuild first, or pass a synthetic count")
+        return
+    print(f"Built the index over {count} tensors in {time.time() - start_time:.1f}s ({len(index.centroids)} clusters)")
+
+    ids, tensors, _ = store.open()
+    rng = np.random.default_rng(1)
+    # Queries are stored images with a little noise, as a re-encoded copy would be
+    query_rows = rng.choice(len(ids), size=min(queries, len(ids)), replace=False)
+    query_tensors = [np.clip(np.asarray(tensors[row], dtype=np.int16) + rng.integers(-3, 4, ROW_BYTES), 0, 255).astype(np.uint8).reshape(TENSOR_SHAPE) for row in query_rows]
+
+    comparator = TensorComparator()
+    truth = []
+    brute_force_times = []
+    for query in query_tensors:
+        start_time = time.time()
+        mse = comparator.mse(query, tensors, rotate=False)
+        truth.append(set(ids[np.argsort(mse)[:K]].tolist()))
+        brute_force_times.append(time.time() - start_time)
+    print(f"Brute force:  {percentiles(brute_force_times)}")
+
+    for nprobe in NPROBES:
+        if nprobe > len(index.centroids):
+            break
+        times = []
+        recalls = []
+        for query, expected in zip(query_tensors, truth):
+            start_time = time.time()
+            found = index.search(query, k=K, nprobe=nprobe)
+            times.append(time.time() - start_time)
+            recalls.append(len(expected & {tensor_id for tensor_id, _ in found}) / K)
+        print(f"nprobe {nprobe:3}:  recall@{K} {np.mean(recalls):.3f}  {percentiles(times)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+'''
+Library-wide scans over the memory-mapped tensor store (tensor_store.py) instead of tbl_image_tensors rows.
+
+Usage:
+    python tensor_store_scan.py rebuild   - recreate the store from tbl_image_tensors
+    python tensor_store_scan.py sync      - add the tensors the store is missing
+    python tensor_store_scan.py verify    - check every stored tensor against its hash in the database
+    python tensor_store_scan.py exact     - report groups of images with identical tensors
+    python tensor_store_scan.py index     - rebuild the similarity index (similarity_index.py)
+    python tensor_store_scan.py similar <tensor_id> [k] - the k images most similar to the given one
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+from dotenv import load_dotenv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbconnection import DBConnection
+from tensor_store import TensorStore, TENSOR_SHAPE
+from similarity_index import SimilarityIndex
+
+load_dotenv()
+
+
+def fetch_rows(query):
+    db = DBConnection.get_instance()
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            return cursor.fetchall()
+    finally:
+        db.return_connection(conn)
+
+
+def verify(store):
+    ids, tensors_pil, tensors_cv2 = store.open()
+    hashes = {tensor_id: (hash_pil, hash_cv2) for tensor_id, hash_pil, hash_cv2 in fetch_rows("SELECT id, hash_pil, hash_cv2 FROM tbl_image_tensors")}
+    mismatched = []
+    deleted = []
+    for index, tensor_id in enumerate(ids.tolist()):
+        if tensor_id not in hashes:
+            deleted.append(tensor_id)
+        elif (hashlib.md5(tensors_pil[index]).hexdigest(), hashlib.md5(tensors_cv2[index]).hexdigest()) != hashes[tensor_id]:
+            mismatched.append(tensor_id)
+    missing = len(set(hashes) - set(ids.tolist()))
+    print(f"{len(ids)} stored tensors: {len(mismatched)} differ from the database, {len(deleted)} no longer in it, {missing} missing")
+    for tensor_id in mismatched[:50]:
+        print(f"  Mismatched tensor id {tensor_id}")
+
+
+def exact(store):
+    ids, tensors_pil, _ = store.open()
+    # View each 7500 byte row as one opaque value so np.unique groups identical tensors in a single sort
+    rows = np.ascontiguousarray(tensors_pil).view(np.dtype((np.void, tensors_pil.shape[1]))).ravel()
+    _, inverse, counts = np.unique(rows, return_inverse=True, return_counts=True)
+    groups = {}
+    for index in np.flatnonzero(counts[inverse] > 1):
+        groups.setdefault(inverse[index], []).append(int(ids[index]))
+    filenames = dict(fetch_rows("SELECT id, filename FROM tbl_image_tensors")) if groups else {}
+    print(f"{len(groups)} groups of identical tensors among {len(ids)} images")
+    for members in groups.values():
+        print("  " + ", ".join(str(filenames.get(tensor_id, tensor_id)) for tensor_id in members))
+
+
+def similar(store, tensor_id, k):
+    index = SimilarityIndex(store)
+    if not index.load():
+        index.rebuild()
+    ids, tensors_pil, _ = store.open()
+    rows = np.flatnonzero(ids == tensor_id)
+    if len(rows) == 0:
+        print(f"Tensor id {tensor_id} is not in the tensor store")
+        return
+    found = index.search(np.asarray(tensors_pil[rows[0]]).reshape(TENSOR_SHAPE), k=k + 1)
+    filenames = dict(fetch_rows("SELECT id, filename FROM tbl_image_tensors"))
+    print(f"Most similar to {filenames.get(tensor_id, tensor_id)}:")
+    for found_id, mse in found:
+        if found_id != tensor_id:
+            print(f"  {mse:10.2f}  {filenames.get(found_id, found_id)}")
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'verify'
+    store = TensorStore()
+    start_time = time.time()
+    if command == 'rebuild':
+        print(f"Rebuilt the store with {store.rebuild()} tensors")
+    elif command == 'sync':
+        print(f"Added {store.sync()} tensors to the store")
+    elif command == 'verify':
+        verify(store)
+    elif command == 'exact':
+        exact(store)
+    elif command == 'index':
+        print(f"Indexed {SimilarityIndex(store).rebuild()} tensors")
+    elif command == 'similar' and len(sys.argv) > 2:
+        similar(store, int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 10)
+    else:
+        print(__doc__)
+        return
+    print(f"{command} took {time.time() - start_time:.1f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+'''
+A long-running worker for the cleo2 project.  The worker keeps its FileProcessor (and with it the
+known face encodings, imported models and database pool) warm while it pulls files from the controller.
+2024 Christopher Orr
+'''
+
+import os
+import signal
+import socket
+from dotenv import load_dotenv
+from file_processor import FileProcessor
+from job_queue import JobQueueClient, IngestJobQueue
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+class Worker:
+    def __init__(self, client, worker_id):
+        self.worker_id = worker_id
+        self.client = client
+        self.processor = FileProcessor()
+        self.running = True
+        self.busy = False
+        signal.signal(signal.SIGTERM, self.handle_exit)
+
+    def handle_exit(self, signum, frame):
+        # Finish the file in hand before exiting; an idle worker can stop straight away
+        self.running = False
+        if not self.busy:
+            raise SystemExit(0)
+
+    def run(self):
+        print(f"Worker {self.worker_id} ready")
+        while self.running:
+            file_info = self.client.get_job(self.worker_id)
+            if file_info is None:  # Shutdown sentinel sent by the controller
+                break
+            file_path, file_type = file_info
+            self.busy = True
+            self.client.report('started', self.worker_id, file_path)
+            success = self.processor.process((file_path, file_type))
+            self.client.report('finished', self.worker_id, file_path, success)
+            self.busy = False
+        print(f"Worker {self.worker_id} stopped")
+
+
+def main():
+    worker_id = os.getenv('WORKER_ID', socket.gethostname())
+    if os.getenv('QUEUE_BACKEND', 'memory') == 'db':
+        # Lease jobs straight from tbl_ingest_jobs, so the worker can run on any host
+        client = IngestJobQueue(lease_seconds=int(os.getenv('JOB_LEASE_SECONDS', 1800)), lane=os.getenv('WORKER_LANE') or None)
+    else:
+        host, port = os.getenv('CONTROLLER_ADDRESS', '127.0.0.1:50000').rsplit(':', 1)
+        client = JobQueueClient((host, int(port)), os.getenv('CONTROLLER_AUTHKEY', 'cleo').encode())
+    Worker(client, worker_id).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+'''
+A fork server (zygote) for cleo2.  It imports the heavy processing libraries and loads the known faces once,
+then forks a child per batch, so each child starts in milliseconds with the parent's memory shared
+copy-on-write.
+
+Protocol: one JSON request per line on stdin, {"id": ..., "batch": [[file_path, file_type], ...]}.  JSON lines
+are written back on stdout:
+    {"id": ..., "startup_seconds": s}                     once the child is ready to process
+    {"id": ..., "file": ..., "success": ..., "seconds": s} per file
+    {"id": ..., "done": true, "exit_code": n}              when the child has exited
+Anything the processing code prints goes to stderr.
+2024 Christopher Orr
+'''
+
+import os
+import sys
+import json
+import time
+import select
+import signal
+import importlib
+from dbconnection import DBConnection
+from exiftool_session import ExifToolPool
+from logger_config import get_logger
+
+PRELOAD_MODULES = ['face_recognition', 'dlib', 'cv2', 'wand.image', 'pillow_heif', 'geopy.geocoders', 'numpy', 'PIL.Image']
+
+
+class Zygote:
+    def __init__(self, output_fd):
+        self.logger = get_logger(self.__class__.__name__)
+        self.output_fd = output_fd
+        self.children = {}  # pid -> request id
+        self.import_seconds = {}
+        self.processor = None
+
+    def preload(self):
+        function_name = 'preload'
+        start_time = time.time()
+        for module in PRELOAD_MODULES:
+            module_start = time.time()
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                self.logger.warning(f"Could not preload {module}: {e}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+            self.import_seconds[module] = round(time.time() - module_start, 3)
+        from file_processor import FileProcessor
+        processor_start = time.time()
+        self.processor = FileProcessor()  # Loads the known face encodings
+        self.import_seconds['FileProcessor'] = round(time.time() - processor_start, 3)
+        # Children open their own connections; a PostgreSQL socket must never be shared across fork
+        DBConnection.get_instance().close_pool()
+        self.logger.info(f"Preloaded in {time.time() - start_time:.2f}s: {self.import_seconds}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+        self.send({'ready': True, 'preload_seconds': self.import_seconds})
+
+    def send(self, message):
+        # A single write of less than PIPE_BUF bytes is atomic, so lines from several children never interleave
+        os.write(self.output_fd, (json.dumps(message) + '\n').encode())
+
+    def fork_batch(self, request_id, batch):
+        requested_at = time.time()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = request_id
+            return
+        exit_code = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            DBConnection.get_instance().initialize_pool()
+            self.send({'id': request_id, 'startup_seconds': round(time.time() - requested_at, 4)})
+            self.processor.prefetch_metadata(batch)
+            for file_path, file_type in batch:
+                start_time = time.time()
+                success = self.processor.process((file_path, file_type))
+                self.send({'id': request_id, 'file': file_path, 'success': success, 'seconds': round(time.time() - start_time, 3)})
+            ExifToolPool.get_instance().stop()  # os._exit below skips the atexit hook
+            DBConnection.get_instance().close_pool()
+            exit_code = 0
+        except BaseException as e:
+            print(f"Batch {request_id} failed: {e}", file=sys.stderr)
+        finally:
+            os._exit(exit_code)  # Never run the zygote's own cleanup or atexit handlers in a child
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            request_id = self.children.pop(pid, None)
+            self.send({'id': request_id, 'done': True, 'exit_code': os.waitstatus_to_exitcode(status)})
+
+    def serve(self, input_file):
+        function_name = 'serve'
+        self.preload()
+        buffer = b''
+        while True:
+            ready, _, _ = select.select([input_file], [], [], 0.2)
+            if ready:
+                data = os.read(input_file.fileno(), 64 * 1024)
+                if not data:
+                    break  # The controller closed stdin
+                buffer += data
+                while b'\n' in buffer:
+                    line, buffer = buffer.split(b'\n', 1)
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        self.logger.error(f"Invalid request: {line[:200]}", extra={'class_name': self.__class__.__name__, 'function_name': function_name})
+                        continue
+                    self.fork_batch(request['id'], request['batch'])
+            self.reap()
+        # Let running children finish before exiting
+        while self.children:
+            time.sleep(0.2)
+            self.reap()
+
+
+if __name__ == "__main__":
+    # Keep the protocol on its own descriptor and send everything printed by the processing code to stderr
+    output_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The controller decides when to stop by closing stdin
+    Zygote(output_fd).serve(sys.stdin)